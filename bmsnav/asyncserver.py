@@ -0,0 +1,171 @@
+import asyncio
+import threading
+import socket
+import email.utils
+import email.parser
+import http.client
+
+from http import HTTPStatus
+
+from bmsnav.config import SERVER_NAME, KEEP_ALIVE_TIMEOUT, MAX_REQUEST_HEAD, EVENTS_MAX_BUFFER
+from bmsnav.server import Response, FileSegment
+from bmsnav.metrics import HTTP_CONNECTIONS
+
+# The asyncio serving engine; kept apart from the threading one so that asyncio is only imported
+# when it's actually configured.
+#
+# Author: Sean Eidemiller (seidemiller@gmail.com)
+
+class AsyncHTTPServer():
+  def __init__(self, server_address, router, events):
+    super(AsyncHTTPServer, self).__init__()
+    self.router = router
+    self.events = events
+    self.loop = None
+    self.stopping = None
+    self.stopped = threading.Event()
+    self.socket = socket.create_server(server_address)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.server_close()
+
+  def serve_forever(self):
+    try:
+      asyncio.run(self._serve())
+    finally:
+      self.stopped.set()
+
+  def shutdown(self):
+    if self.loop:
+      self.loop.call_soon_threadsafe(self.stopping.set)
+
+    self.stopped.wait()
+
+  def server_close(self):
+    self.socket.close()
+
+  async def _serve(self):
+    self.loop = asyncio.get_running_loop()
+    self.stopping = asyncio.Event()
+
+    server = await asyncio.start_server(self._handle_connection, sock=self.socket, limit=MAX_REQUEST_HEAD)
+
+    async with server:
+      await self.stopping.wait()
+
+  async def _handle_connection(self, reader, writer):
+    # Requests on a connection are handled strictly one after the other, so pipelined requests
+    # (already sitting in the reader's buffer) are answered in order.
+    HTTP_CONNECTIONS.inc()
+
+    try:
+      while True:
+        try:
+          head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEP_ALIVE_TIMEOUT)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError) as read_err:
+          break
+
+        request_line, _, header_block = head.lstrip(b'\r\n').partition(b'\r\n')
+        request = request_line.decode('latin-1').split()
+
+        if len(request) != 3 or not request[2].startswith('HTTP/'):
+          await self._send(writer, Response.error(HTTPStatus.BAD_REQUEST), False, False)
+          break
+
+        method, target, version = request
+        headers = email.parser.BytesParser(_class=http.client.HTTPMessage).parsebytes(header_block)
+        connection = (headers.get('Connection') or '').lower()
+        keep_alive = (version == 'HTTP/1.1' and connection != 'close') or connection == 'keep-alive'
+
+        # Nothing here takes a request body, but it still has to be consumed.
+        content_length = int(headers.get('Content-Length') or 0)
+
+        if content_length:
+          await reader.readexactly(content_length)
+
+        # Off the event loop, since a response may have to be produced first (e.g. a page variant).
+        response = await self.loop.run_in_executor(None, self.router.handle, method, target, headers)
+
+        try:
+          if response.events:
+            await self._stream_events(reader, writer, response)
+            break
+
+          await self._send(writer, response, method == 'HEAD', keep_alive)
+        finally:
+          response.close()
+
+        if not keep_alive:
+          break
+
+    except (ConnectionError, OSError, ValueError) as conn_err:
+      pass
+    finally:
+      HTTP_CONNECTIONS.dec()
+      writer.close()
+
+  async def _send(self, writer, response, head_only, keep_alive):
+    lines = [
+      f'HTTP/1.1 {response.status.value} {response.status.phrase}',
+      f'Server: {SERVER_NAME}',
+      f'Date: {email.utils.formatdate(usegmt=True)}'
+    ]
+    lines += [f'{k}: {v}' for k, v in response.headers]
+
+    # A 304 has no body, and its Content-Length would be taken for that of the cached response.
+    if response.events is None and response.status != HTTPStatus.NOT_MODIFIED:
+      lines.append(f'Content-Length: {response.get_length()}')
+
+    lines.append('Connection: ' + ('keep-alive' if keep_alive else 'close'))
+
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    if not head_only:
+      for part in response.parts:
+        if isinstance(part, FileSegment):
+          await writer.drain()
+
+          with open(part.path, 'rb') as f:
+            await self.loop.sendfile(writer.transport, f, part.offset, part.length)
+        else:
+          writer.write(part)
+
+    await writer.drain()
+
+  async def _stream_events(self, reader, writer, response):
+    queue = asyncio.Queue()
+
+    def on_event(message):
+      self.loop.call_soon_threadsafe(queue.put_nowait, message)
+
+    await self._send(writer, response, True, False)
+    writer.write(response.events)
+    self.events.subscribe(on_event)
+
+    # From here on it's counted as an event client (as with the threading engine).
+    HTTP_CONNECTIONS.dec()
+
+    # Clients never send anything after the request; a read completing means they've gone away.
+    closed = asyncio.ensure_future(reader.read())
+
+    try:
+      while not closed.done():
+        message = asyncio.ensure_future(queue.get())
+        await asyncio.wait([message, closed], return_when=asyncio.FIRST_COMPLETED)
+
+        if not message.done():
+          message.cancel()
+          break
+
+        if queue.qsize() * len(message.result()) > EVENTS_MAX_BUFFER:
+          break
+
+        writer.write(message.result())
+        await writer.drain()
+    finally:
+      HTTP_CONNECTIONS.inc()
+      self.events.unsubscribe(on_event)
+      closed.cancel()
@@ -0,0 +1,472 @@
+import os
+import json
+import re
+
+from enum import StrEnum
+from datetime import datetime
+
+# Constants, config file handling and locating the BMS installation; shared by the GUI and the
+# headless daemon, so nothing in here may import Qt (or anything else heavy).
+#
+# Author: Sean Eidemiller (seidemiller@gmail.com)
+
+# ======== Global ========
+
+def get_registry_key(version):
+  return rf'SOFTWARE\WOW6432Node\Benchmark Sims\Falcon BMS {version}'
+
+class LogLevel(StrEnum):
+  INFO = 'INFO'
+  WARN = 'WARN'
+  ERROR = 'ERROR'
+
+class ServerEngine(StrEnum):
+  THREADING = 'threading'
+  ASYNCIO = 'asyncio'
+
+SERVER_ROOT = 'serve'
+SERVER_NAME = 'BMSNavServer'
+CONFIG_FILE = 'config.json'
+THEATERS_DIR = os.path.join(SERVER_ROOT, 'theaters')
+CACHE_INDEX_NAME = 'cache.json'
+BLOBS_DIR = os.path.join(SERVER_ROOT, 'blobs')
+STAGING_DIR = os.path.join(SERVER_ROOT, 'staging')
+GENERATIONS_FILE = os.path.join(SERVER_ROOT, 'generations.json')
+DEFAULT_GENERATION_HISTORY = 10
+TILES_DIR = os.path.join(SERVER_ROOT, 'tiles')
+COMPRESSED_DIR = os.path.join(SERVER_ROOT, 'compressed')
+# Text files are compressed once (when published) in each of these encodings that's available, and
+# only kept if that makes them smaller by a worthwhile margin.
+COMPRESSIBLE_EXTENSIONS = ('.html', '.json', '.txt', '.css', '.js', '.svg')
+CONTENT_ENCODINGS = ['br', 'gzip']
+COMPRESSED_MIN_SIZE = 512
+COMPRESSED_MAX_RATIO = 0.9
+# Pages are first published with a fast (zlib level) encode and then re-encoded in the background;
+# only lossless, so neither invalidates the cache.
+DEFAULT_PNG_FAST_LEVEL = 1
+DEFAULT_PNG_OPTIMIZE_SECONDS = 10
+DEFAULT_PNG_OPTIMIZE_MIN_SAVINGS = 0.1
+PNG_PALETTE_COLORS = 256
+VARIANTS_DIR = os.path.join(SERVER_ROOT, 'variants')
+# What changed on each page since the previous conversion (and the deltas served from that); pages
+# are compared a block at a time.
+REGIONS_DIR = os.path.join(SERVER_ROOT, 'regions')
+REGION_BLOCK_SIZE = 32
+# Alternative encodings of the pages, produced on first request and kept for as long as the page.
+IMAGE_VARIANTS = {
+  'webp': { 'format': 'WEBP', 'contentType': 'image/webp', 'options': { 'lossless': True, 'method': 4 } },
+  'webp-lossy': { 'format': 'WEBP', 'contentType': 'image/webp', 'options': { 'quality': 80, 'method': 4 } },
+  'jpeg': { 'format': 'JPEG', 'contentType': 'image/jpeg', 'options': { 'quality': 85, 'optimize': True } }
+}
+# Color transforms for night flying, applied to the pages (in any of the formats above) the same
+# way; grayscale and invert come first, then each band is scaled by the tint and brightness.
+COLOR_TRANSFORMS = {
+  'invert': { 'invert': True },
+  'night': { 'grayscale': True, 'invert': True, 'tint': [255, 0, 0] },
+  'dim': { 'brightness': 0.5 }
+}
+
+# Anything that affects the generated images belongs in here; changing it invalidates the cache.
+DDS_OUTPUT_SETTINGS = {
+  'version': 1,
+  'format': 'png'
+}
+
+DEFAULT_BMS_VERSION = '4.38'
+DEFAULT_REGISTRY_KEY = get_registry_key(DEFAULT_BMS_VERSION)
+DEFAULT_SERVER_PORT = 2676
+DEFAULT_SERVER_ENGINE = ServerEngine.THREADING
+KEEP_ALIVE_TIMEOUT = 30
+MAX_REQUEST_HEAD = 64 * 1024
+# Requests for more ranges than this get the whole thing (no client needs that many).
+MAX_BYTE_RANGES = 16
+BYTE_RANGE = re.compile(r'^(\d*)-(\d*)$')
+DEFAULT_TILE_SIZE = 256
+TILE_ROUTE = re.compile(r'^/tiles/([lr]\d\d)/(?:(info\.json)|(\d+)/(\d+)/(\d+)(?:\.png)?)$')
+DELTA_ROUTE = re.compile(r'^/delta/([lr]\d\d)\.png$')
+CONTENT_HASH = re.compile(r'^[0-9a-f]{64}$')
+PAGE_ROUTE = re.compile(r'^/[lr]\d\d\.png$')
+METRICS_ROUTES = ['/', '/events', '/metrics', '/manifest.json', '/bundle.zip', '/briefing.html', '/briefings/']
+BUNDLE_BOARDS = {
+  'left': ['l'],
+  'right': ['r'],
+  'both': ['l', 'r']
+}
+EVENTS_HEARTBEAT_INTERVAL = 15
+EVENTS_MAX_BUFFER = 64 * 1024
+DEFAULT_WORKERS = os.cpu_count() or 1
+DEFAULT_QUIESCENCE_MS = 500
+DEFAULT_FRESH_PAGE_TIMEOUT_MS = 3000
+DDS_POLL_INTERVAL_MS = 100
+# Windows process priority class for the pre-conversion worker (nice 19 elsewhere).
+IDLE_PRIORITY_CLASS = 0x00000040
+PRECONVERT_WAIT_INTERVAL = 1
+DDS_MISSING_TIMEOUT = 10
+BRIEFING_PATTERN = '*briefing.html'
+BRIEFING_NAME = 'briefing.html'
+PAGE_NAMES = [f'{prefix}{page:02d}.png' for prefix in ('l', 'r') for page in range(1, 17)]
+# From before pages were published (and served) from the blob store; pages and the briefing used to
+# be written straight into the server root, along with the conversion cache's index.
+LEGACY_PATHS = [os.path.join(SERVER_ROOT, name) for name in PAGE_NAMES + [BRIEFING_NAME, CACHE_INDEX_NAME]]
+BRIEFINGS_PREFIX = 'briefings/'
+BRIEFING_READ_ATTEMPTS = 10
+BRIEFING_READ_RETRY_INTERVAL = 0.2
+# For opening briefings on Windows without denying BMS (which may still be writing them) anything.
+GENERIC_READ = 0x80000000
+FILE_SHARE_ALL = 0x00000001 | 0x00000002 | 0x00000004
+OPEN_EXISTING = 3
+WATCH_POLL_INTERVAL_MS = 250
+METRICS_SUMMARY_INTERVAL = 300
+DEFAULT_CONSOLE_LINES = 5000
+DEFAULT_LOG_FILE = 'bmsnavserver.log'
+LOG_FILE_MAX_BYTES = 1024 * 1024
+LOG_FILE_BACKUPS = 3
+BMS_HOME_ENV_VAR = 'BMS_HOME'
+DEFAULT_THEATERS = [
+  {
+    "name": "Korea",
+    "addOnDir": ""
+  },
+  {
+    "name": "Balkans",
+    "addOnDir": "Add-On Balkans"
+  },
+  {
+    "name": "Israel",
+    "addOnDir": "Add-On Israel"
+  },
+  {
+    "name": "Hellenic",
+    "addOnDir": "Add-On Hellas"
+  },
+  {
+    "name": "EMF",
+    "addOnDir": "Add-On EMF"
+  },
+  {
+    "name": "Georgia",
+    "addOnDir": "Add-On Georgia"
+  },
+  {
+    "name": "Nevada",
+    "addOnDir": "Add-On Nevada"
+  },
+  {
+    "name": "Nordic",
+    "addOnDir": "Add-On Nordic"
+  },
+  {
+    "name": "Gibraltar",
+    "addOnDir": "Add-On Gibraltar"
+  },
+  {
+    "name": "Mideast128",
+    "addOnDir": "Add-On Mideast128"
+  }
+]
+DEFAULT_SELECTED_THEATER = DEFAULT_THEATERS[0]
+
+def console_get_message(message, level = LogLevel.INFO):
+  now = datetime.now()
+  time = now.strftime('%H:%M:%S')
+  return f'[{level} {time}] {message}'
+
+def get_theater_dds_dir(bms_home_dir, theater):
+  addon_dir = theater['addOnDir']
+
+  if addon_dir:
+    return os.path.join(bms_home_dir, 'Data', addon_dir, 'Terrdata', 'Objects', 'KoreaObj')
+
+  return os.path.join(bms_home_dir, 'Data', 'TerrData', 'Objects', 'KoreaObj')
+
+def is_theater_installed(bms_home_dir, theater):
+  return os.path.exists(get_theater_dds_dir(bms_home_dir, theater))
+
+def get_dds_theater(bms_home_dir, theater):
+  # Theaters that aren't installed (or don't provide kneeboards) fall back to the default Korea.
+  if is_theater_installed(bms_home_dir, theater):
+    return theater
+
+  return DEFAULT_SELECTED_THEATER
+
+def get_dds_dir(bms_home_dir, theater):
+  return get_theater_dds_dir(bms_home_dir, get_dds_theater(bms_home_dir, theater))
+
+def get_theater_cache_dir(theater):
+  # Converted pages are kept per theater (by the theater providing the DDS files).
+  key = re.sub(r'[^a-z0-9]+', '-', theater['name'].lower()).strip('-')
+  return os.path.join(THEATERS_DIR, key or 'default')
+
+def get_dds_files(dds_dir):
+  return [os.path.join(dds_dir, f'{i}.dds') for i in range(7982, 7998)]
+
+def get_briefing_dir(bms_home_dir):
+  return os.path.join(bms_home_dir, 'User', 'Briefings')
+
+# ======== BMS Home ========
+
+# Each locator takes the config and returns a candidate BMS home directory (or None); the first one
+# that actually exists wins.
+
+def get_bms_home_from_config(config):
+  return config.bms_home
+
+def get_bms_home_from_registry(config):
+  try:
+    import winreg
+  except ImportError as import_err:
+    # Not on Windows.
+    return None
+
+  reg = winreg.ConnectRegistry(None, winreg.HKEY_LOCAL_MACHINE)
+
+  with winreg.OpenKey(reg, config.registry_key) as key:
+    return os.path.normpath(winreg.QueryValueEx(key, 'baseDir')[0])
+
+def get_bms_home_from_env(config):
+  return os.environ.get(BMS_HOME_ENV_VAR)
+
+BMS_HOME_LOCATORS = [
+  get_bms_home_from_config,
+  get_bms_home_from_registry,
+  get_bms_home_from_env
+]
+
+def locate_bms_home(config, locators=BMS_HOME_LOCATORS):
+  for locator in locators:
+    try:
+      bms_home = locator(config)
+    except Exception as locator_err:
+      continue
+
+    if bms_home and os.path.isdir(bms_home):
+      return bms_home
+
+  return None
+
+# ======== Config ========
+
+class Config():
+  def __init__(self, path=CONFIG_FILE):
+    super(Config, self).__init__()
+    self.path = path
+    self.port = DEFAULT_SERVER_PORT
+    self.server_engine = DEFAULT_SERVER_ENGINE
+    self.workers = DEFAULT_WORKERS
+    self.quiescence_ms = DEFAULT_QUIESCENCE_MS
+    self.fresh_page_timeout_ms = DEFAULT_FRESH_PAGE_TIMEOUT_MS
+    self.tile_size = DEFAULT_TILE_SIZE
+    self.deltas = True
+    self.console_lines = DEFAULT_CONSOLE_LINES
+    self.log_file = DEFAULT_LOG_FILE
+    self.preconvert_theaters = True
+    self.generation_history = DEFAULT_GENERATION_HISTORY
+    self.png_fast_level = DEFAULT_PNG_FAST_LEVEL
+    self.png_optimize = True
+    self.png_optimize_seconds = DEFAULT_PNG_OPTIMIZE_SECONDS
+    self.png_optimize_min_savings = DEFAULT_PNG_OPTIMIZE_MIN_SAVINGS
+    self.theaters = DEFAULT_THEATERS
+    self.theater_names = list(map(lambda t: t['name'], DEFAULT_THEATERS))
+    self.bms_home = None
+    self.bms_version = DEFAULT_BMS_VERSION
+    self.registry_key = DEFAULT_REGISTRY_KEY
+    self.selected_theater = DEFAULT_SELECTED_THEATER
+
+  def load(self, log):
+    config_file = None
+
+    try:
+      config_file = open(self.path, 'r')
+      config = json.loads(config_file.read())
+
+      try:
+        bms_home = config['bmsHome']
+
+        if bms_home:
+          if os.path.exists(bms_home):
+            self.bms_home = bms_home
+          else:
+            log('BMS home directory specified in config file does not exist; reverting to registry entry.', LogLevel.WARN)
+      except Exception as bms_home_err:
+        pass
+
+      try:
+        bms_version = config['bmsVersion']
+
+        if bms_version:
+          self.bms_version = bms_version
+          self.registry_key = get_registry_key(bms_version)
+      except Exception as bms_version_err:
+        pass
+
+      log('BMS version: ' + self.bms_version)
+
+      try:
+        port = config['port']
+
+        if port > 1024 and port <= 65535:
+          self.port = port
+        else:
+          log('Invalid port in config file; reverting to default.', LogLevel.WARN)
+      except Exception as port_err:
+        pass
+
+      try:
+        server_engine = config['serverEngine']
+
+        if server_engine in list(ServerEngine):
+          self.server_engine = ServerEngine(server_engine)
+        else:
+          log('Invalid server engine in config file; reverting to default.', LogLevel.WARN)
+      except Exception as server_engine_err:
+        pass
+
+      try:
+        workers = config['workers']
+
+        if isinstance(workers, int) and workers >= 1:
+          self.workers = workers
+        else:
+          log('Invalid number of workers in config file; reverting to default.', LogLevel.WARN)
+      except Exception as workers_err:
+        pass
+
+      try:
+        quiescence_ms = config['quiescenceMs']
+
+        if isinstance(quiescence_ms, int) and quiescence_ms >= 0:
+          self.quiescence_ms = quiescence_ms
+        else:
+          log('Invalid quiescence period in config file; reverting to default.', LogLevel.WARN)
+      except Exception as quiescence_err:
+        pass
+
+      try:
+        fresh_page_timeout_ms = config['freshPageTimeoutMs']
+
+        if isinstance(fresh_page_timeout_ms, int) and fresh_page_timeout_ms >= 0:
+          self.fresh_page_timeout_ms = fresh_page_timeout_ms
+        else:
+          log('Invalid fresh page timeout in config file; reverting to default.', LogLevel.WARN)
+      except Exception as fresh_page_timeout_err:
+        pass
+
+      try:
+        if config['tiles'] is False:
+          self.tile_size = None
+      except Exception as tiles_err:
+        pass
+
+      try:
+        if config['deltas'] is False:
+          self.deltas = False
+      except Exception as deltas_err:
+        pass
+
+      try:
+        console_lines = config['consoleLines']
+
+        if isinstance(console_lines, int) and console_lines >= 100:
+          self.console_lines = console_lines
+        else:
+          log('Invalid number of console lines in config file; reverting to default.', LogLevel.WARN)
+      except Exception as console_lines_err:
+        pass
+
+      try:
+        log_file = config['logFile']
+
+        if log_file is False:
+          self.log_file = None
+        elif isinstance(log_file, str) and log_file:
+          self.log_file = log_file
+        else:
+          log('Invalid log file in config file; reverting to default.', LogLevel.WARN)
+      except Exception as log_file_err:
+        pass
+
+      try:
+        if config['preconvertTheaters'] is False:
+          self.preconvert_theaters = False
+      except Exception as preconvert_err:
+        pass
+
+      try:
+        generation_history = config['generationHistory']
+
+        if isinstance(generation_history, int) and generation_history >= 1:
+          self.generation_history = generation_history
+        else:
+          log('Invalid generation history in config file; reverting to default.', LogLevel.WARN)
+      except Exception as generation_history_err:
+        pass
+
+      try:
+        png_fast_level = config['pngFastLevel']
+
+        if isinstance(png_fast_level, int) and 0 <= png_fast_level <= 9:
+          self.png_fast_level = png_fast_level
+        else:
+          log('Invalid PNG fast level in config file; reverting to default.', LogLevel.WARN)
+      except Exception as png_fast_level_err:
+        pass
+
+      try:
+        if config['pngOptimize'] is False:
+          self.png_optimize = False
+      except Exception as png_optimize_err:
+        pass
+
+      try:
+        png_optimize_seconds = config['pngOptimizeSeconds']
+
+        if isinstance(png_optimize_seconds, (int, float)) and png_optimize_seconds > 0:
+          self.png_optimize_seconds = png_optimize_seconds
+        else:
+          log('Invalid PNG optimization time budget in config file; reverting to default.', LogLevel.WARN)
+      except Exception as png_optimize_seconds_err:
+        pass
+
+      try:
+        png_optimize_min_savings = config['pngOptimizeMinSavings']
+
+        if isinstance(png_optimize_min_savings, (int, float)) and 0 <= png_optimize_min_savings < 1:
+          self.png_optimize_min_savings = png_optimize_min_savings
+        else:
+          log('Invalid PNG optimization minimum savings in config file; reverting to default.', LogLevel.WARN)
+      except Exception as png_optimize_min_savings_err:
+        pass
+
+      try:
+        selected_theater = self.get_theater(config['selectedTheater'])
+
+        if selected_theater:
+          self.selected_theater = selected_theater
+      except Exception as selected_theater_err:
+        pass
+
+    except Exception as err:
+      log('Unable to read config file; using default values.', LogLevel.INFO)
+
+    finally:
+      if config_file:
+        config_file.close()
+
+  def get_theater(self, theater_name):
+    for theater in self.theaters:
+      if theater['name'] == theater_name:
+        return theater
+
+    return None
+
+  def save_selected_theater(self, theater_name):
+    try:
+      with open(self.path, 'r') as config_file:
+        config = json.loads(config_file.read())
+    except Exception as json_read_err:
+      config = {}
+
+    config['selectedTheater'] = theater_name
+
+    with open(self.path, 'w+') as config_file:
+      config_file.write(json.dumps(config, indent=2))
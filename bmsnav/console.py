@@ -0,0 +1,68 @@
+import threading
+import collections
+
+from bmsnav.config import LogLevel, DEFAULT_CONSOLE_LINES, LOG_FILE_MAX_BYTES, LOG_FILE_BACKUPS, console_get_message
+
+# The console log: a bounded buffer of recent messages that views (the window, stdout) follow
+# incrementally, mirrored to a rotating file on disk. Messages may come from any thread.
+#
+# Author: Sean Eidemiller (seidemiller@gmail.com)
+
+# ======== Classes ========
+
+class ConsoleLog():
+  def __init__(self, max_lines=DEFAULT_CONSOLE_LINES):
+    super(ConsoleLog, self).__init__()
+    self.lock = threading.Lock()
+    self.lines = collections.deque(maxlen=max_lines)
+    self.listeners = []
+    self.file_logger = None
+
+  def set_max_lines(self, max_lines):
+    with self.lock:
+      self.lines = collections.deque(self.lines, maxlen=max_lines)
+
+  def open_file(self, path, max_bytes=LOG_FILE_MAX_BYTES, backups=LOG_FILE_BACKUPS):
+    import logging
+    import logging.handlers
+
+    handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+
+    logger = logging.getLogger('bmsnav.console')
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(handler)
+
+    with self.lock:
+      # Whatever was logged before the file could be opened (i.e. while reading the config).
+      for line in self.lines:
+        logger.info(line)
+
+      self.file_logger = logger
+
+  def add_listener(self, listener):
+    # Listeners are called with each new line, in order, while the lock is held; they should only
+    # hand the line off (e.g. to another thread) rather than do anything slow.
+    with self.lock:
+      self.listeners.append(listener)
+
+  def append(self, message, level = LogLevel.INFO):
+    line = console_get_message(message, level)
+
+    with self.lock:
+      self.lines.append(line)
+
+      if self.file_logger:
+        self.file_logger.info(line)
+
+      for listener in self.listeners:
+        listener(line)
+
+  def clear(self):
+    with self.lock:
+      self.lines.clear()
+
+  def get_lines(self):
+    with self.lock:
+      return list(self.lines)
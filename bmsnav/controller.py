@@ -0,0 +1,524 @@
+import os
+import time
+import threading
+
+from bmsnav.config import (
+  LogLevel,
+  TILES_DIR,
+  VARIANTS_DIR,
+  COMPRESSED_DIR,
+  REGIONS_DIR,
+  DDS_OUTPUT_SETTINGS,
+  DDS_POLL_INTERVAL_MS,
+  PRECONVERT_WAIT_INTERVAL,
+  METRICS_SUMMARY_INTERVAL,
+  BMS_HOME_ENV_VAR,
+  locate_bms_home,
+  is_theater_installed,
+  get_theater_dds_dir,
+  get_dds_theater,
+  get_theater_cache_dir,
+  get_dds_files
+)
+from bmsnav.conversion import (
+  ConversionCache,
+  DDSConverter,
+  PageScheduler,
+  PNGOptimizer,
+  BriefingIndex,
+  BriefingConverter,
+  ChangeCoalescer,
+  create_conversion_pool,
+  get_page_paths
+)
+from bmsnav.publishing import BlobStore, Publisher
+from bmsnav.monitors import DDSMonitor, BriefingMonitor
+from bmsnav.server import Server
+from bmsnav.metrics import CHANGE_TO_PUBLISH_SECONDS, PAGE_WAIT_SECONDS, get_summary_snapshot, format_summary
+
+# Ties the monitors, converters and server together. Everything in here runs on plain threads and
+# reports back through callbacks (which may be invoked from any thread), so that the very same
+# controller drives both the GUI and the headless daemon.
+#
+# Author: Sean Eidemiller (seidemiller@gmail.com)
+
+# ======== Classes ========
+
+class Controller():
+  def __init__(self, config, watcher, log, on_progress=None, on_busy=None):
+    super(Controller, self).__init__()
+    self.config = config
+    self.watcher = watcher
+    self.log = log
+    self.on_progress = on_progress
+    self.on_busy = on_busy
+    self.lock = threading.Lock()
+    self.running = False
+    self.bms_home = None
+
+    self.dds_monitor = None
+    self.dds_dir = None
+    self.dds_batch_thread = None
+    self.dds_queued_files = set()
+    self.dds_queued_changed_at = None
+    self.dds_changed_at = None
+    self.dds_change_coalescer = ChangeCoalescer(config.quiescence_ms / 1000)
+    self.dds_change_pending = threading.Event()
+    self.dds_change_thread = None
+    self.conversion_settings = { **DDS_OUTPUT_SETTINGS, 'tileSize': config.tile_size }
+    self.conversion_caches = {}
+    self.conversion_caches_lock = threading.Lock()
+    self.conversion_pool = None
+    self.page_scheduler = PageScheduler(config.workers)
+    # A single idle priority worker for everything done in the background (pre-conversion and
+    # optimizing), so that none of it ever competes with BMS.
+    self.background_pool = None
+    self.optimize_thread = None
+    self.optimize_queued = False
+    self.briefing_monitor = None
+    self.briefing_dir = None
+    self.briefing_index = None
+    self.briefing_thread = None
+    self.briefing_queued = False
+    self.briefing_changed_at = None
+    self.server = None
+    self.stopping = threading.Event()
+
+    self.store = BlobStore()
+    self.store.add_derived_dir(TILES_DIR)
+    self.store.add_derived_dir(VARIANTS_DIR)
+    self.store.add_derived_dir(COMPRESSED_DIR)
+    self.store.add_derived_dir(REGIONS_DIR)
+    self.publisher = Publisher(self.store, history=config.generation_history)
+
+  def start(self):
+    self.running = True
+    self.bms_home = locate_bms_home(self.config)
+
+    if not self.bms_home:
+      self.log(f'Error locating BMS directory; specify with "bmsHome" in config.json file (or the {BMS_HOME_ENV_VAR} environment variable).', LogLevel.ERROR)
+      return False
+
+    # Pages converted for any installed theater are kept, published or not; everything else that
+    # nothing refers to anymore goes.
+    for theater in self._get_installed_theaters():
+      self._get_conversion_cache(theater)
+
+    self.store.collect()
+
+    # Whatever was published last time can be served while everything else starts up.
+    self.server = Server(
+      self.config.port,
+      self.publisher,
+      self.config.server_engine,
+      self._on_server_started,
+      self._on_server_error,
+      self._on_page_request,
+      self._on_request_error
+    )
+
+    if not self.server.start():
+      return False
+
+    try:
+      self.briefing_monitor = BriefingMonitor(self.bms_home, self._on_briefing_change, self.watcher)
+      self.briefing_dir = self.briefing_monitor.start()
+      self.briefing_index = BriefingIndex(self.briefing_dir)
+      self.log('Monitoring briefings directory for changes.')
+    except Exception as briefing_monitor_err:
+      self.log('Error monitoring briefings directory for changes: ' + str(briefing_monitor_err), LogLevel.ERROR)
+      return False
+
+    self._start_briefing_conversion()
+    self._check_for_dds_dir_and_warn(self.config.selected_theater)
+
+    try:
+      self.dds_monitor = DDSMonitor(self.bms_home, self._on_dds_change, self.watcher)
+      self.dds_dir = self.dds_monitor.start(self.config.selected_theater)
+      self.log('Monitoring kneeboard DDS files for changes.')
+    except Exception as dds_monitor_err:
+      self.log('Error monitoring kneeboard DDS files for changes: ' + str(dds_monitor_err), LogLevel.ERROR)
+      return False
+
+    self.dds_change_thread = threading.Thread(target=self._run_dds_change_poll, daemon=True)
+    self.dds_change_thread.start()
+
+    self.log('Generating kneeboard images...')
+    self._start_batch_conversion()
+
+    if self.config.preconvert_theaters:
+      threading.Thread(target=self._run_theater_preconversion, daemon=True).start()
+
+    threading.Thread(target=self._run_metrics_summary, daemon=True).start()
+
+    self.log('Initialization complete.')
+
+    return True
+
+  def stop(self):
+    with self.lock:
+      self.running = False
+
+    self.stopping.set()
+    self.dds_change_pending.set()
+
+    for pool in (self.conversion_pool, self.background_pool):
+      if pool:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    if self.server:
+      self.server.stop()
+
+  def set_theater(self, theater_name):
+    theater = self.config.get_theater(theater_name)
+
+    if not theater:
+      self.log('Invalid theater: ' + theater_name, LogLevel.ERROR)
+      return
+
+    if theater == self.config.selected_theater:
+      return
+
+    self.log('Theater changed; generating kneeboard images...')
+
+    with self.lock:
+      self.config.selected_theater = theater
+
+      if self.dds_monitor:
+        self.dds_dir = self.dds_monitor.restart(theater)
+
+      # Changes to the previous theater's files (still settling, or queued) no longer matter.
+      self.dds_change_coalescer = ChangeCoalescer(self.config.quiescence_ms / 1000)
+      self.dds_changed_at = None
+      self.dds_queued_files = set()
+      self.dds_queued_changed_at = None
+
+    self._check_for_dds_dir_and_warn(theater)
+
+    try:
+      self.config.save_selected_theater(theater_name)
+    except Exception as config_err:
+      self.log('Error writing selected theater to config file: ' + str(config_err), LogLevel.WARN)
+
+    self._start_batch_conversion()
+
+  def rollback(self):
+    try:
+      generation = self.publisher.rollback()
+    except Exception as rollback_err:
+      self.log('Error rolling back kneeboard images: ' + str(rollback_err), LogLevel.ERROR)
+      return
+
+    if generation:
+      self.log(f'Rolled back to the previous kneeboard images ({generation.theater or "no theater"}).')
+    else:
+      self.log('No previous kneeboard images to roll back to.', LogLevel.WARN)
+
+  def _check_for_dds_dir_and_warn(self, theater):
+    if theater['addOnDir'] and not is_theater_installed(self.bms_home, theater):
+      self.log('Selected theater not installed or does not provide kneeboards; using default Korea.', LogLevel.WARN)
+
+  def _on_dds_change(self, path):
+    with self.lock:
+      if self.dds_change_coalescer.is_idle():
+        self.log('Kneeboard DDS file(s) changed; waiting for writes to finish...')
+        self.dds_changed_at = time.monotonic()
+
+      # WDP rewrites the files one after the other (and not always quickly), so changes are
+      # collected until every changed file has stopped changing and then converted as one batch.
+      self.dds_change_coalescer.add(path, time.monotonic())
+      self.dds_change_pending.set()
+
+  def _run_dds_change_poll(self):
+    while self.running:
+      self.dds_change_pending.wait()
+      time.sleep(DDS_POLL_INTERVAL_MS / 1000)
+
+      with self.lock:
+        dds_files = self._get_current_dds_files(self.dds_change_coalescer.poll(time.monotonic()))
+        changed_at = self.dds_changed_at
+
+        if self.dds_change_coalescer.is_idle():
+          self.dds_change_pending.clear()
+
+      if dds_files and self.running:
+        self.log('Regenerating kneeboard images...')
+
+        # Replaced files drop out of native watchers, so watch them again before converting;
+        # anything written from here on starts the next batch.
+        self.dds_monitor.restart(None, dds_files)
+        self._start_batch_conversion(dds_files, changed_at)
+
+  def _get_current_dds_files(self, dds_files):
+    # Only the selected theater's files; changes to another theater's may still come in from before
+    # the theater was switched. Called with the lock held.
+    current = set(get_dds_files(self.dds_dir))
+    return [f for f in dds_files or [] if f in current]
+
+  def _start_batch_conversion(self, dds_files=None, changed_at=None):
+    with self.lock:
+      if dds_files is None:
+        # A full batch (e.g. a theater change) supersedes anything still queued.
+        dds_files = get_dds_files(self.dds_dir)
+        self.dds_queued_files = set(dds_files)
+      else:
+        self.dds_queued_files |= set(dds_files)
+
+      # Requests for these pages wait (for a moment) for them to be converted from here on.
+      self.page_scheduler.add(get_page_paths(f, '')[0] for f in dds_files)
+
+      if changed_at is not None:
+        self.dds_queued_changed_at = min(changed_at, self.dds_queued_changed_at or changed_at)
+
+      # Only one batch runs at a time; the next one starts when it finishes.
+      if self.dds_batch_thread:
+        return
+
+      if self.on_busy:
+        self.on_busy(True)
+
+      self.dds_batch_thread = threading.Thread(target=self._run_dds_conversions, daemon=True)
+      self.dds_batch_thread.start()
+
+  def _run_dds_conversions(self):
+    while True:
+      with self.lock:
+        self.dds_queued_files = set(self._get_current_dds_files(self.dds_queued_files))
+
+        if not (self.dds_queued_files and self.running):
+          self.dds_batch_thread = None
+
+          if self.on_busy:
+            self.on_busy(False)
+
+          break
+
+        if not self.conversion_pool:
+          self.conversion_pool = create_conversion_pool(self.config.workers)
+
+        dds_files = sorted(self.dds_queued_files)
+        changed_at = self.dds_queued_changed_at
+        self.dds_queued_files = set()
+        self.dds_queued_changed_at = None
+
+        converter = DDSConverter(
+          self.dds_dir,
+          self.publisher,
+          self._get_conversion_cache(get_dds_theater(self.bms_home, self.config.selected_theater)),
+          dds_files,
+          self.conversion_pool,
+          self.config.selected_theater['name'],
+          self.config.tile_size,
+          self.on_progress,
+          self.config.png_fast_level,
+          self.page_scheduler,
+          self.config.deltas
+        )
+
+      try:
+        start = time.monotonic()
+        converter.run()
+        self._log_conversion_errors(converter, LogLevel.ERROR)
+        self.log(f'Kneeboard images generated in {time.monotonic() - start:.2f} s ({len(converter.converted)} converted, {converter.skipped} unchanged, {len(converter.errors)} failed).')
+
+        if converter.published and changed_at is not None:
+          CHANGE_TO_PUBLISH_SECONDS.observe(time.monotonic() - changed_at, 'dds')
+      except Exception as dds_converter_err:
+        self.log('Error generating kneeboard image(s): ' + str(dds_converter_err), LogLevel.ERROR)
+
+    # Whatever was just published (with the fast encode) gets optimized in the background.
+    self._start_png_optimization()
+
+  def _log_conversion_errors(self, converter, level):
+    for dds_file, convert_err in sorted(converter.errors.items()):
+      self.log(f'Error converting {os.path.basename(dds_file)}: {convert_err}', level)
+
+  def _get_installed_theaters(self):
+    return [t for t in self.config.theaters if is_theater_installed(self.bms_home, t)]
+
+  def _get_conversion_cache(self, theater):
+    with self.conversion_caches_lock:
+      cache = self.conversion_caches.get(theater['name'])
+
+      if not cache:
+        cache = ConversionCache(get_theater_cache_dir(theater), self.store, self.conversion_settings)
+        self.conversion_caches[theater['name']] = cache
+
+      return cache
+
+  def _run_theater_preconversion(self):
+    # Every other installed theater is kept converted in the background, so that a theater change
+    # only has to publish (link) pages that already exist. Files are converted one at a time by a
+    # single idle priority worker, and only while nothing is being converted for the selected theater.
+    converted = 0
+
+    try:
+      pool = self._get_background_pool()
+
+      for theater in self._get_installed_theaters():
+        dds_dir = get_theater_dds_dir(self.bms_home, theater)
+        cache = self._get_conversion_cache(theater)
+
+        for dds_file in get_dds_files(dds_dir):
+          while self.running and self.dds_batch_thread:
+            self.stopping.wait(PRECONVERT_WAIT_INTERVAL)
+
+          if not self.running:
+            return
+
+          # The selected theater is kept current by its own batches, which wait for the files to
+          # settle (and shouldn't have to wait for an idle priority worker for its cache either).
+          with self.lock:
+            selected = dds_dir == self.dds_dir
+
+          if selected:
+            break
+
+          if os.path.exists(dds_file):
+            converter = DDSConverter(dds_dir, None, cache, [dds_file], pool, None, self.config.tile_size, None, self.config.png_fast_level, None, self.config.deltas)
+            converter.run()
+            self._log_conversion_errors(converter, LogLevel.WARN)
+            converted += len(converter.converted)
+
+      if converted:
+        self.log(f'Kneeboard images for installed theaters converted ahead of time ({converted} converted).')
+        self._start_png_optimization()
+    except Exception as preconvert_err:
+      if self.running:
+        self.log('Error converting kneeboard images ahead of time: ' + str(preconvert_err), LogLevel.WARN)
+
+  def _get_background_pool(self):
+    with self.lock:
+      if not self.background_pool:
+        self.background_pool = create_conversion_pool(1, low_priority=True)
+
+      return self.background_pool
+
+  def _start_png_optimization(self):
+    if not self.config.png_optimize:
+      return
+
+    with self.lock:
+      # Pages converted while optimizing are picked up by another round once it's done.
+      if self.optimize_thread:
+        self.optimize_queued = True
+        return
+
+      self.optimize_thread = threading.Thread(target=self._run_png_optimizations, daemon=True)
+      self.optimize_thread.start()
+
+  def _run_png_optimizations(self):
+    # Pages are re-encoded one at a time (selected theater first) while nothing is being converted
+    # for the selected theater, and swapped in theater by theater.
+    while True:
+      try:
+        selected = get_dds_theater(self.bms_home, self.config.selected_theater)
+        theaters = [selected] + [t for t in self._get_installed_theaters() if t['name'] != selected['name']]
+
+        for theater in theaters:
+          optimizer = PNGOptimizer(
+            self._get_conversion_cache(theater),
+            self.publisher,
+            self._get_background_pool(),
+            self.config.tile_size,
+            self.config.png_optimize_min_savings,
+            self.config.png_optimize_seconds,
+            self.config.deltas
+          )
+
+          try:
+            for page in optimizer.cache.get_unoptimized():
+              while self.running and self.dds_batch_thread:
+                self.stopping.wait(PRECONVERT_WAIT_INTERVAL)
+
+              if not self.running:
+                return
+
+              optimizer.optimize(page)
+          finally:
+            optimizer.publish()
+
+          if optimizer.optimized:
+            self.log(f'Kneeboard images optimized in the background ({theater["name"]}: {optimizer.optimized} pages, {optimizer.saved / 1024:.0f} KB smaller).')
+      except Exception as optimize_err:
+        if self.running:
+          self.log('Error optimizing kneeboard images: ' + str(optimize_err), LogLevel.WARN)
+
+      with self.lock:
+        if not (self.optimize_queued and self.running):
+          self.optimize_thread = None
+          return
+
+        self.optimize_queued = False
+
+  def _on_briefing_change(self, path):
+    self.log('Briefing(s) changed; checking HTML files...')
+    self._start_briefing_conversion(time.monotonic())
+
+  def _start_briefing_conversion(self, changed_at=None):
+    with self.lock:
+      if changed_at is not None and self.briefing_changed_at is None:
+        self.briefing_changed_at = changed_at
+
+      # A change while copying means the copy may already be stale; go again once it's done.
+      if self.briefing_thread:
+        self.briefing_queued = True
+        return
+
+      self.briefing_thread = threading.Thread(target=self._run_briefing_conversions, daemon=True)
+      self.briefing_thread.start()
+
+  def _run_briefing_conversions(self):
+    while True:
+      with self.lock:
+        changed_at = self.briefing_changed_at
+        self.briefing_changed_at = None
+
+      try:
+        converter = BriefingConverter(self.briefing_index, self.publisher)
+        converter.run()
+
+        if converter.published:
+          self.log(f'Published briefing HTML file(s) ({len(converter.changed)} changed).')
+
+        if converter.published and changed_at is not None:
+          CHANGE_TO_PUBLISH_SECONDS.observe(time.monotonic() - changed_at, 'briefing')
+      except Exception as briefing_converter_err:
+        self.log('Error publishing briefing HTML file(s): ' + str(briefing_converter_err), LogLevel.ERROR)
+
+      with self.lock:
+        if not (self.briefing_queued and self.running):
+          self.briefing_thread = None
+          return
+
+        self.briefing_queued = False
+
+  def _run_metrics_summary(self):
+    previous = get_summary_snapshot()
+
+    while not self.stopping.wait(METRICS_SUMMARY_INTERVAL):
+      current = get_summary_snapshot()
+      summary = format_summary(previous, current, METRICS_SUMMARY_INTERVAL)
+      previous = current
+
+      if summary:
+        self.log(summary)
+
+  def _on_page_request(self, page):
+    # A client asking for a page that's about to change gets the new one, if it takes no longer than
+    # the timeout; its DDS file is converted (and published) ahead of the rest of the batch.
+    if not (self.config.fresh_page_timeout_ms and self.page_scheduler.is_stale(page[1:])):
+      return
+
+    start = time.monotonic()
+    fresh = self.page_scheduler.wait(page[1:], self.config.fresh_page_timeout_ms / 1000)
+    PAGE_WAIT_SECONDS.observe(time.monotonic() - start, 'fresh' if fresh else 'timeout')
+
+  def _on_server_started(self):
+    self.log(f'Server started on port {self.config.port}: waiting for requests.')
+
+  def _on_server_error(self, err):
+    self.log('Error initializing server: ' + str(err), LogLevel.ERROR)
+
+  def _on_request_error(self, err):
+    self.log('Error handling request: ' + str(err), LogLevel.ERROR)
@@ -0,0 +1,1022 @@
+import io
+import os
+import json
+import ntpath
+import fnmatch
+import hashlib
+import threading
+import shutil
+import math
+import time
+
+from bmsnav.config import (
+  CACHE_INDEX_NAME,
+  TILES_DIR,
+  REGIONS_DIR,
+  IDLE_PRIORITY_CLASS,
+  DDS_OUTPUT_SETTINGS,
+  DEFAULT_TILE_SIZE,
+  DEFAULT_PNG_FAST_LEVEL,
+  DEFAULT_PNG_OPTIMIZE_SECONDS,
+  DEFAULT_PNG_OPTIMIZE_MIN_SAVINGS,
+  PNG_PALETTE_COLORS,
+  DDS_MISSING_TIMEOUT,
+  BRIEFING_PATTERN,
+  BRIEFING_NAME,
+  BRIEFINGS_PREFIX,
+  BRIEFING_READ_ATTEMPTS,
+  BRIEFING_READ_RETRY_INTERVAL,
+  GENERIC_READ,
+  FILE_SHARE_ALL,
+  OPEN_EXISTING,
+  get_dds_files
+)
+from bmsnav.publishing import hash_file
+from bmsnav.regions import record_changed_regions, inherit_regions
+from bmsnav.metrics import DDS_CONVERSION_SECONDS, PNG_OPTIMIZATION_SECONDS, PNG_OPTIMIZATION_BYTES_TOTAL, BRIEFING_COPY_SECONDS, CONVERSION_CACHE_TOTAL
+
+# Converting the kneeboard DDS files (into the blob store, by theater) and publishing them (and
+# copying the briefing) as a staged generation, then optimizing the published pages in the
+# background. None of this depends on Qt; the GUI and the daemon each run the
+# converters on threads of their own.
+#
+# Author: Sean Eidemiller (seidemiller@gmail.com)
+
+# ======== Conversion ========
+
+# These are plain functions (rather than DDSConverter methods) so that they can be shipped off to
+# the worker processes in the conversion pool.
+
+def get_dds_digest(data, settings_key):
+  hasher = hashlib.sha256(settings_key)
+  hasher.update(data)
+  return hasher.hexdigest()
+
+def read_shared(path, attempts=BRIEFING_READ_ATTEMPTS, interval=BRIEFING_READ_RETRY_INTERVAL):
+  # BMS may still have the file open (for writing); it's opened without denying BMS anything (as
+  # copy does) and retried for a moment if that still fails.
+  for attempt in range(attempts):
+    try:
+      with open_shared(path) as f:
+        return f.read()
+    except FileNotFoundError as missing_err:
+      raise missing_err
+    except OSError as read_err:
+      if attempt == attempts - 1:
+        raise read_err
+
+      time.sleep(interval)
+
+def open_shared(path):
+  if os.name != 'nt':
+    return open(path, 'rb')
+
+  import ctypes
+  import msvcrt
+
+  from ctypes import wintypes
+
+  kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+  kernel32.CreateFileW.restype = wintypes.HANDLE
+  kernel32.CreateFileW.argtypes = [
+    wintypes.LPCWSTR, wintypes.DWORD, wintypes.DWORD, wintypes.LPVOID, wintypes.DWORD, wintypes.DWORD, wintypes.HANDLE
+  ]
+
+  handle = kernel32.CreateFileW(path, GENERIC_READ, FILE_SHARE_ALL, None, OPEN_EXISTING, 0, None)
+
+  if handle is None or handle == wintypes.HANDLE(-1).value:
+    raise ctypes.WinError(ctypes.get_last_error())
+
+  return os.fdopen(msvcrt.open_osfhandle(handle, os.O_RDONLY | os.O_BINARY), 'rb')
+
+def get_page_paths(dds_file, out_dir):
+  dds_index = int(ntpath.basename(dds_file).split('.')[0])
+  page = f'{(dds_index - 7982) + 1:02d}'
+
+  out_left_path = os.path.join(out_dir, f'l{page}.png')
+  out_right_path = os.path.join(out_dir, f'r{page}.png')
+
+  return page, out_left_path, out_right_path
+
+def write_png(img, out_path, level=DEFAULT_PNG_FAST_LEVEL, optimize=False):
+  if optimize:
+    reduce_png_colors(img).save(out_path, 'png', optimize=True)
+  else:
+    img.save(out_path, 'png', compress_level=level)
+
+def reduce_png_colors(img):
+  # Kneeboards are mostly flat colors, so most pages (and tiles) fit a palette. Only ever lossless:
+  # opaque alpha is dropped, and the palette is checked pixel for pixel since quantizing to as many
+  # colors as there are isn't guaranteed to be exact.
+  from PIL import Image
+
+  if img.mode == 'RGBA' and img.getextrema()[3] == (255, 255):
+    img = img.convert('RGB')
+
+  if img.mode not in ('RGB', 'RGBA'):
+    return img
+
+  colors = img.getcolors(PNG_PALETTE_COLORS)
+
+  if not colors:
+    return img
+
+  # Pillow only quantizes RGBA approximately, so the palette is built from the colors and each gets
+  # its alpha back (as long as no color comes with more than one).
+  palette_img = img.convert('RGB').quantize(colors=len(colors), method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+
+  if img.mode == 'RGBA':
+    alphas = {}
+
+    for count, color in colors:
+      if alphas.setdefault(color[:3], color[3]) != color[3]:
+        return img
+
+    palette = palette_img.getpalette()
+    rgba = []
+
+    for index in range(0, len(palette), 3):
+      rgb = tuple(palette[index:index + 3])
+      rgba += [*rgb, alphas.get(rgb, 255)]
+
+    palette_img.putpalette(rgba, 'RGBA')
+
+  if palette_img.convert(img.mode).tobytes() != img.tobytes():
+    return img
+
+  return palette_img
+
+def add_timing(timings, stage, start):
+  # Only stages that actually ran are timed (and observed), so that skipping one (e.g. no tiles)
+  # doesn't add samples of nothing.
+  timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+def write_page(page_img, out_path, timings, tiles_dir=None, tile_size=DEFAULT_TILE_SIZE, level=DEFAULT_PNG_FAST_LEVEL, regions_dir=None, base=None):
+  start = time.perf_counter()
+  write_png(page_img, out_path, level)
+  content_hash, crc = hash_file(out_path)
+  add_timing(timings, 'encode', start)
+
+  if tiles_dir:
+    start = time.perf_counter()
+    write_tiles(page_img, content_hash, tiles_dir, tile_size, level)
+    add_timing(timings, 'tiles', start)
+
+  # Compared against the page as it was (content hash and path) while its pixels are at hand.
+  if regions_dir and base and base[0] != content_hash:
+    start = time.perf_counter()
+
+    try:
+      record_changed_regions(page_img, content_hash, base[0], base[1], regions_dir)
+    except Exception as regions_err:
+      # Clients just get the whole page instead.
+      pass
+
+    add_timing(timings, 'diff', start)
+
+  return out_path, content_hash, crc
+
+def get_tile_levels(size, tile_size):
+  # Level 0 fits the whole page in a single tile; the last level is full resolution.
+  return max(0, math.ceil(math.log2(max(size) / tile_size))) + 1
+
+def write_tiles(page_img, content_hash, tiles_dir, tile_size, level=DEFAULT_PNG_FAST_LEVEL, optimize=False):
+  # Tiles are stored by the page's content hash, so an unchanged page never needs new tiles and
+  # every generation showing it shares them.
+  out_dir = os.path.join(tiles_dir, content_hash)
+
+  if os.path.isdir(out_dir):
+    return
+
+  tmp_dir = f'{out_dir}.{os.getpid()}.tmp'
+  levels = get_tile_levels(page_img.size, tile_size)
+  level_img = page_img
+
+  for z in reversed(range(levels)):
+    if z < levels - 1:
+      level_img = level_img.reduce(2)
+
+    os.makedirs(os.path.join(tmp_dir, str(z)))
+
+    for x in range(math.ceil(level_img.size[0] / tile_size)):
+      for y in range(math.ceil(level_img.size[1] / tile_size)):
+        dims = (x * tile_size, y * tile_size, min((x + 1) * tile_size, level_img.size[0]), min((y + 1) * tile_size, level_img.size[1]))
+        write_png(level_img.crop(dims), os.path.join(tmp_dir, str(z), f'{x}_{y}.png'), level, optimize)
+
+  info = {
+    'width': page_img.size[0],
+    'height': page_img.size[1],
+    'tileSize': tile_size,
+    'levels': levels
+  }
+
+  with open(os.path.join(tmp_dir, 'info.json'), 'w') as info_file:
+    info_file.write(json.dumps(info))
+
+  try:
+    os.replace(tmp_dir, out_dir)
+  except OSError as replace_err:
+    # Another worker got there first with the very same tiles.
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def convert_dds(dds_file, out_dir, settings_key=None, tiles_dir=None, tile_size=DEFAULT_TILE_SIZE, level=DEFAULT_PNG_FAST_LEVEL, regions_dir=None, bases=None):
+  page, out_left_path, out_right_path = get_page_paths(dds_file, out_dir)
+
+  with open(dds_file, 'rb') as f:
+    data = f.read()
+
+  # Pillow is only imported by whatever actually converts, so that serving never waits on it.
+  from PIL import Image
+  from bmsnav.dds import open_dds
+
+  # Stage timings go back to the parent process along with the result (for the metrics).
+  timings = {}
+  outputs = []
+  bases = bases or [None, None]
+  decoder = open_dds(data)
+
+  if decoder:
+    # Each page is decoded on its own, straight from the file's data (nothing to crop).
+    for index, out_path in enumerate((out_left_path, out_right_path)):
+      start = time.perf_counter()
+      page_img = decoder.get_page(index)
+      add_timing(timings, 'decode', start)
+
+      outputs.append(write_page(page_img, out_path, timings, tiles_dir, tile_size, level, regions_dir, bases[index]))
+  else:
+    with Image.open(io.BytesIO(data)) as img:
+      start = time.perf_counter()
+      img.load()
+      add_timing(timings, 'decode', start)
+
+      left_dims = (0 ,0, int(img.size[0] / 2), img.size[1])
+      right_dims = int(img.size[0] / 2), 0, img.size[0], img.size[1]
+
+      for index, (out_path, dims) in enumerate(((out_left_path, left_dims), (out_right_path, right_dims))):
+        start = time.perf_counter()
+        cropped = img.crop(dims)
+        add_timing(timings, 'crop', start)
+
+        outputs.append(write_page(cropped, out_path, timings, tiles_dir, tile_size, level, regions_dir, bases[index]))
+
+  # The digest is taken from the bytes that were actually converted, in case WDP rewrote the file
+  # in the meantime.
+  digest = get_dds_digest(data, settings_key) if settings_key else None
+
+  # The pages are left where they were written, to be moved into the blob store by the parent.
+  return page, digest, timings, outputs
+
+def optimize_page(in_paths, out_paths, min_savings=DEFAULT_PNG_OPTIMIZE_MIN_SAVINGS, max_seconds=None, tiles_dir=None, tile_size=DEFAULT_TILE_SIZE, regions_dir=None, in_hashes=None):
+  # The second (background) encode of a DDS file's pages. A page is only re-encoded if that makes it
+  # smaller by at least the given fraction; the time budget is checked before each page, so the last
+  # one may overrun it. Pages that aren't re-encoded come back as None.
+  from PIL import Image
+
+  start = time.perf_counter()
+  outputs = []
+
+  for index, (in_path, out_path) in enumerate(zip(in_paths, out_paths)):
+    if max_seconds and time.perf_counter() - start > max_seconds:
+      outputs.append(None)
+      continue
+
+    with Image.open(in_path) as page_img:
+      page_img.load()
+      write_png(page_img, out_path, optimize=True)
+
+      in_size = os.path.getsize(in_path)
+      out_size = os.path.getsize(out_path)
+
+      if out_size > in_size * (1 - min_savings):
+        os.remove(out_path)
+        outputs.append(None)
+        continue
+
+      content_hash, crc = hash_file(out_path)
+
+      if tiles_dir:
+        write_tiles(page_img, content_hash, tiles_dir, tile_size, optimize=True)
+
+      if regions_dir and in_hashes:
+        inherit_regions(regions_dir, content_hash, in_hashes[index], page_img.size)
+
+      outputs.append((out_path, content_hash, crc, in_size, out_size))
+
+  return outputs, time.perf_counter() - start
+
+def lower_process_priority():
+  # Runs in each worker of a low priority pool before anything is converted, so that converting
+  # only ever uses CPU time that BMS (and serving) leave over.
+  try:
+    if os.name == 'nt':
+      import ctypes
+
+      kernel32 = ctypes.windll.kernel32
+      kernel32.SetPriorityClass(kernel32.GetCurrentProcess(), IDLE_PRIORITY_CLASS)
+    else:
+      os.nice(19)
+  except Exception as priority_err:
+    pass
+
+def create_conversion_pool(workers, low_priority=False):
+  # A low priority pool makes sense even with a single worker; it's the process priority that counts.
+  if workers <= 1 and not low_priority:
+    return None
+
+  import multiprocessing
+  import concurrent.futures
+
+  # Always spawn (rather than fork) so that workers never inherit the Qt event loop or its threads.
+  return concurrent.futures.ProcessPoolExecutor(
+    max_workers=workers,
+    mp_context=multiprocessing.get_context('spawn'),
+    initializer=lower_process_priority if low_priority else None
+  )
+
+# ======== Classes ========
+
+class ConversionCache():
+  def __init__(self, path, store, settings=DDS_OUTPUT_SETTINGS):
+    super(ConversionCache, self).__init__()
+    # The pages themselves are in the blob store (which the cache holds references to); the
+    # directory (one per theater) only holds the index and pages while they're being converted.
+    self.path = path
+    self.store = store
+    self.index_path = os.path.join(path, CACHE_INDEX_NAME)
+    self.settings_key = json.dumps(settings, sort_keys=True).encode('utf-8')
+    self.entries = {}
+    self.hashes = {}
+    # Pages that have been through the background encode (whether or not that made them smaller).
+    self.optimized = set()
+    self.lock = threading.Lock()
+    # Held while converting for (or publishing from) the cache, since both the batches for the
+    # selected theater and the background pre-conversion may use it.
+    self.write_lock = threading.Lock()
+    self.dirty = False
+
+    os.makedirs(self.path, exist_ok=True)
+
+    # Anything but the index is left over from a conversion that never finished.
+    with os.scandir(self.path) as entries:
+      leftovers = [entry.path for entry in entries if entry.is_file() and entry.name != CACHE_INDEX_NAME]
+
+    for leftover in leftovers:
+      os.remove(leftover)
+
+    self.load()
+
+  def load(self):
+    try:
+      with open(self.index_path, 'r') as index_file:
+        index = json.loads(index_file.read())
+
+      if index.get('settings') == self.settings_key.decode('utf-8'):
+        self.entries = index.get('entries', {})
+        self.hashes = index.get('hashes', {})
+        self.optimized = set(index.get('optimized', []))
+    except Exception as load_err:
+      # Missing or corrupt index; everything simply gets reconverted.
+      self.entries = {}
+      self.hashes = {}
+      self.optimized = set()
+
+    self.store.ref(self.get_hashes())
+
+  def save(self):
+    with self.lock:
+      if not self.dirty:
+        return
+
+      index = {
+        'settings': self.settings_key.decode('utf-8'),
+        'entries': self.entries,
+        'hashes': self.hashes,
+        'optimized': sorted(self.optimized)
+      }
+
+      tmp_path = self.index_path + '.tmp'
+
+      with open(tmp_path, 'w') as index_file:
+        index_file.write(json.dumps(index, indent=2))
+
+      os.replace(tmp_path, self.index_path)
+      self.dirty = False
+
+  def digest(self, data):
+    return get_dds_digest(data, self.settings_key)
+
+  def is_current(self, key, digest):
+    with self.lock:
+      if self.entries.get(key) != digest:
+        return False
+
+      hashes = self.hashes.get(key, [])
+
+    return bool(hashes) and all(self.store.exists(h) for h in hashes)
+
+  def update(self, key, digest, hashes):
+    with self.lock:
+      previous = self.hashes.get(key, [])
+      self.entries[key] = digest
+      self.hashes[key] = hashes
+      self.optimized.discard(key)
+      self.dirty = True
+
+    # Referenced before the previous pages are let go of, in case they're the very same content.
+    self.store.ref(hashes)
+    self.store.unref(previous)
+
+  def set_optimized(self, key, previous, hashes):
+    # Swaps in the background encode of a page; unless it was reconverted in the meantime.
+    with self.lock:
+      if self.hashes.get(key) != previous:
+        return False
+
+      self.hashes[key] = hashes
+      self.optimized.add(key)
+      self.dirty = True
+
+    self.store.ref(hashes)
+    self.store.unref(previous)
+
+    return True
+
+  def get_unoptimized(self):
+    with self.lock:
+      return sorted(key for key in self.hashes if key not in self.optimized)
+
+  def get_hashes(self, key=None):
+    # Content hashes of the converted pages; for one DDS file or for all of them.
+    with self.lock:
+      if key:
+        return list(self.hashes.get(key, []))
+
+      return [h for hashes in self.hashes.values() for h in hashes]
+
+class DDSConverter():
+  def __init__(self, dds_dir, publisher, cache, dds_files=None, pool=None, theater=None, tile_size=None, on_progress=None, png_level=DEFAULT_PNG_FAST_LEVEL, scheduler=None, deltas=False):
+    super(DDSConverter, self).__init__()
+    self.dds_dir = dds_dir
+    self.dds_files = dds_files or get_dds_files(dds_dir)
+    # Without a publisher the pages are only converted into the cache (i.e. ahead of time).
+    self.publisher = publisher
+    self.theater = theater
+    self.cache = cache
+    self.pool = pool
+    self.tile_size = tile_size
+    self.on_progress = on_progress
+    self.png_level = png_level
+    # Decides which file goes next (i.e. what clients are waiting for) and learns which pages are
+    # fresh once they've been published.
+    self.scheduler = scheduler
+    self.marks = scheduler.get_marks(get_page_paths(f, cache.path)[0] for f in self.dds_files) if scheduler else None
+    # Whether to record what changed on each page (for serving deltas).
+    self.deltas = deltas
+    self.converted = {}
+    self.skipped = 0
+    # Files that couldn't be converted (by path), and why; the rest of the batch is published anyway.
+    self.errors = {}
+    self.published = False
+    self.fresh = set()
+    # What clients were last shown (pinned while converting), for the pages to be compared against.
+    self.base_generation = None
+
+  def run(self):
+    try:
+      if self.publisher and self.deltas:
+        self.base_generation = self.publisher.acquire()
+
+      with self.cache.write_lock:
+        try:
+          self.convert_batch(self.dds_files)
+        finally:
+          self.cache.save()
+
+        self.publish()
+
+    finally:
+      if self.base_generation:
+        self.publisher.release(self.base_generation)
+        self.base_generation = None
+
+      if self.scheduler:
+        # Fresh or not (e.g. after an error), nobody should wait for this batch any longer.
+        self.scheduler.remove((get_page_paths(f, self.cache.path)[0] for f in self.dds_files), self.marks)
+
+  def publish(self, partial=False):
+    if not self.publisher:
+      return
+
+    staging = self.publisher.begin()
+
+    try:
+      changed = self.set_pages(staging)
+
+      if self.theater and self.theater != staging.theater:
+        staging.theater = self.theater
+        changed = True
+
+      # Pages published ahead of the rest of the batch don't make a set of their own in the history;
+      # the rest of the batch takes their place (even if that turns out to change nothing else).
+      if partial != staging.partial:
+        staging.partial = partial
+        changed = True
+
+      if changed:
+        self.publisher.commit(staging)
+        self.published = True
+      else:
+        self.publisher.abort(staging)
+
+      staging = None
+
+    finally:
+      if staging:
+        self.publisher.abort(staging)
+
+    if self.scheduler:
+      self.scheduler.remove(self.fresh, self.marks)
+
+  def convert_batch(self, dds_files):
+    total = len(dds_files)
+    pending = []
+
+    for dds_file in dds_files:
+      # Nothing to convert for a file that isn't there (e.g. a theater without some of the pages);
+      # set_pages leaves its page out.
+      if not os.path.isfile(dds_file):
+        continue
+
+      try:
+        if not self.is_current(dds_file):
+          pending.append(dds_file)
+      except Exception as read_err:
+        self.errors[dds_file] = read_err
+
+    done = total - len(pending)
+
+    if done:
+      self._progress(done, total)
+
+    # Even a single file goes to the pool (if there is one), so that converting never competes with
+    # serving for the GIL and so that pre-conversion runs at the pool's priority.
+    if self.pool and pending:
+      import concurrent.futures
+
+      # Only as many files as the scheduler allows are handed to the pool at a time, so that a file
+      # a client asks for in the meantime can still go next.
+      futures = {}
+
+      while pending or futures:
+        while pending and len(futures) < self._get_max_in_flight():
+          dds_file = self._get_next(pending)
+          futures[self.pool.submit(convert_dds, dds_file, self.cache.path, *self._get_convert_args(dds_file))] = dds_file
+
+        finished, unfinished = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+        waited_for = False
+
+        for future in finished:
+          dds_file = futures.pop(future)
+
+          try:
+            self._on_converted(*future.result())
+            waited_for = waited_for or self._is_waited_for(dds_file)
+          except Exception as page_err:
+            self.errors[dds_file] = page_err
+
+          done += 1
+          self._progress(done, total)
+
+        if waited_for:
+          self.publish(partial=True)
+    else:
+      while pending:
+        dds_file = self._get_next(pending)
+
+        waited_for = False
+
+        try:
+          self._on_converted(*convert_dds(dds_file, self.cache.path, *self._get_convert_args(dds_file)))
+          waited_for = self._is_waited_for(dds_file)
+        except Exception as page_err:
+          self.errors[dds_file] = page_err
+
+        done += 1
+        self._progress(done, total)
+
+        if waited_for:
+          self.publish(partial=True)
+
+  def set_pages(self, staging):
+    # Pages are published by content hash, so publishing never copies (or converts) anything;
+    # switching to a theater that was converted ahead of time is just this.
+    changed = False
+
+    for dds_file in get_dds_files(self.dds_dir):
+      page = get_page_paths(dds_file, self.cache.path)[0]
+      hashes = self.cache.get_hashes(page) if os.path.isfile(dds_file) else None
+
+      for index, name in enumerate((f'l{page}.png', f'r{page}.png')):
+        content_hash = hashes[index] if hashes else None
+
+        if staging.get_hash(name) == content_hash:
+          continue
+
+        if content_hash:
+          staging.set_file(name, content_hash)
+        else:
+          # Never converted, or no such DDS file (anymore); don't leave another theater's page in place.
+          staging.remove_file(name)
+
+        changed = True
+
+    return changed
+
+  def is_current(self, dds_file):
+    page = get_page_paths(dds_file, self.cache.path)[0]
+
+    with open(dds_file, 'rb') as f:
+      digest = self.cache.digest(f.read())
+
+    current = self.cache.is_current(page, digest)
+
+    if current and self.tile_size:
+      current = all(os.path.isdir(os.path.join(TILES_DIR, h)) for h in self.cache.get_hashes(page))
+
+    if current:
+      CONVERSION_CACHE_TOTAL.inc('hit')
+      self.skipped += 1
+      self.fresh.add(page)
+      return True
+
+    CONVERSION_CACHE_TOTAL.inc('miss')
+    return False
+
+  def _get_convert_args(self, dds_file):
+    tile_args = (TILES_DIR, self.tile_size) if self.tile_size else (None, DEFAULT_TILE_SIZE)
+
+    if not self.deltas:
+      return (self.cache.settings_key, *tile_args, self.png_level)
+
+    # The pages are compared against what clients were shown before, rather than whatever the cache
+    # has since (e.g. an optimized encode that was never published, and that goes away along with
+    # whatever changed from it). Ahead of time there's only the cache, which still references them.
+    page = get_page_paths(dds_file, self.cache.path)[0]
+
+    if self.base_generation:
+      hashes = [h for h in (self.base_generation.get_hash(f'l{page}.png'), self.base_generation.get_hash(f'r{page}.png')) if h]
+    else:
+      hashes = self.cache.get_hashes(page)
+
+    bases = [(h, self.cache.store.get_path(h)) for h in hashes] if len(hashes) == 2 else None
+
+    return (self.cache.settings_key, *tile_args, self.png_level, REGIONS_DIR, bases)
+
+  def _get_next(self, pending):
+    dds_file = self.scheduler.get_next(pending) if self.scheduler else pending[0]
+    pending.remove(dds_file)
+    return dds_file
+
+  def _get_max_in_flight(self):
+    return self.scheduler.max_in_flight if self.scheduler else len(self.dds_files)
+
+  def _is_waited_for(self, dds_file):
+    # Published right away (rather than with the rest of the batch) if a client is waiting for it.
+    return bool(self.scheduler) and self.scheduler.is_waited_for(get_page_paths(dds_file, self.cache.path)[0])
+
+  def _progress(self, done, total):
+    if self.on_progress:
+      self.on_progress(done, total)
+
+  def _on_converted(self, page, digest, timings, outputs):
+    hashes = [content_hash for out_path, content_hash, crc in outputs]
+
+    # Identical pages (within the batch, across theaters or from earlier) are only stored once.
+    for out_path, content_hash, crc in outputs:
+      self.cache.store.add(out_path, content_hash, crc)
+
+    self.cache.update(page, digest, hashes)
+    self.cache.store.unref(hashes)
+    self.converted[page] = digest
+    self.fresh.add(page)
+
+    for stage, seconds in timings.items():
+      DDS_CONVERSION_SECONDS.observe(seconds, stage)
+
+class PageScheduler():
+  def __init__(self, max_in_flight=1):
+    super(PageScheduler, self).__init__()
+    self.max_in_flight = max_in_flight
+    self.condition = threading.Condition()
+    # Pages (e.g. '04', for both boards) that are queued or being converted but not yet published,
+    # and those of them that clients are waiting for (in the order they asked).
+    self.stale = set()
+    self.waited_for = []
+    # How many times each page has been marked stale, so that a batch only clears the pages nothing
+    # has marked since it started (e.g. a page edited again while it was being converted).
+    self.marks = {}
+
+  def add(self, pages):
+    with self.condition:
+      for page in pages:
+        self.stale.add(page)
+        self.marks[page] = self.marks.get(page, 0) + 1
+
+  def get_marks(self, pages):
+    with self.condition:
+      return { page: self.marks.get(page, 0) for page in pages }
+
+  def remove(self, pages, marks=None):
+    with self.condition:
+      self.stale -= set(p for p in pages if marks is None or marks.get(p) == self.marks.get(p, 0))
+      self.waited_for = [p for p in self.waited_for if p in self.stale]
+      self.condition.notify_all()
+
+  def is_stale(self, page):
+    with self.condition:
+      return page in self.stale
+
+  def wait(self, page, timeout):
+    # Returns whether the page is fresh, i.e. whether the current generation shows what's on disk.
+    with self.condition:
+      if page not in self.stale:
+        return True
+
+      if page not in self.waited_for:
+        self.waited_for.append(page)
+
+      return self.condition.wait_for(lambda: page not in self.stale, timeout)
+
+  def is_waited_for(self, page):
+    with self.condition:
+      return page in self.waited_for
+
+  def get_next(self, dds_files):
+    with self.condition:
+      for page in self.waited_for:
+        for dds_file in dds_files:
+          if get_page_paths(dds_file, '')[0] == page:
+            return dds_file
+
+    return dds_files[0]
+
+class PNGOptimizer():
+  def __init__(self, cache, publisher=None, pool=None, tile_size=None, min_savings=DEFAULT_PNG_OPTIMIZE_MIN_SAVINGS, max_seconds=DEFAULT_PNG_OPTIMIZE_SECONDS, deltas=False):
+    super(PNGOptimizer, self).__init__()
+    self.cache = cache
+    self.publisher = publisher
+    self.pool = pool
+    self.tile_size = tile_size
+    self.min_savings = min_savings
+    self.max_seconds = max_seconds
+    self.deltas = deltas
+    # Fast encodes (content hashes) that have been swapped for their optimized encodes.
+    self.replaced = {}
+    self.optimized = 0
+    self.saved = 0
+    self.published = False
+
+  def optimize(self, page):
+    store = self.cache.store
+    hashes = self.cache.get_hashes(page)
+
+    if not hashes:
+      return
+
+    # Held on to while being read, in case the page is reconverted (and let go of) in the meantime.
+    store.ref(hashes)
+    added = []
+
+    try:
+      in_paths = [store.get_path(h) for h in hashes]
+      out_paths = [os.path.join(self.cache.path, f'{h}.{index}.png') for index, h in enumerate(hashes)]
+      args = (in_paths, out_paths, self.min_savings, self.max_seconds, TILES_DIR if self.tile_size else None, self.tile_size or DEFAULT_TILE_SIZE, REGIONS_DIR if self.deltas else None, hashes)
+
+      if self.pool:
+        outputs, seconds = self.pool.submit(optimize_page, *args).result()
+      else:
+        outputs, seconds = optimize_page(*args)
+
+      PNG_OPTIMIZATION_SECONDS.observe(seconds)
+      optimized_hashes = list(hashes)
+
+      for index, output in enumerate(outputs):
+        if output:
+          out_path, content_hash, crc, in_size, out_size = output
+          store.add(out_path, content_hash, crc)
+          added.append(content_hash)
+          optimized_hashes[index] = content_hash
+
+      if self.cache.set_optimized(page, hashes, optimized_hashes):
+        for index, output in enumerate(outputs):
+          if output:
+            self.replaced[hashes[index]] = optimized_hashes[index]
+            self.optimized += 1
+            self.saved += output[3] - output[4]
+            PNG_OPTIMIZATION_BYTES_TOTAL.inc('fast', amount=output[3])
+            PNG_OPTIMIZATION_BYTES_TOTAL.inc('optimized', amount=output[4])
+    finally:
+      store.unref(added)
+      store.unref(hashes)
+
+  def publish(self):
+    # The optimized pages replace the current generation (rather than adding to the history), since
+    # they look exactly the same; rolling back still goes to whatever was published before.
+    self.cache.save()
+
+    if not (self.publisher and self.replaced):
+      return
+
+    staging = self.publisher.begin()
+
+    try:
+      changed = False
+
+      for name in list(staging.files):
+        content_hash = self.replaced.get(staging.get_hash(name))
+
+        if content_hash:
+          staging.set_file(name, content_hash)
+          changed = True
+
+      if changed:
+        self.publisher.commit(staging, replace=True)
+        self.published = True
+      else:
+        self.publisher.abort(staging)
+
+      staging = None
+
+    finally:
+      if staging:
+        self.publisher.abort(staging)
+
+class ChangeCoalescer():
+  def __init__(self, quiescence, missing_timeout=DDS_MISSING_TIMEOUT):
+    super(ChangeCoalescer, self).__init__()
+    self.quiescence = quiescence
+    self.missing_timeout = missing_timeout
+    self.pending = {}
+
+  def add(self, path, now):
+    # Any new event for a file restarts its quiet period.
+    self.pending[path] = [self._get_signature(path), now]
+
+  def is_idle(self):
+    return not self.pending
+
+  def poll(self, now):
+    # Returns the whole set of changed files once every one of them has existed, with the same
+    # size and mtime, for the quiescence window; None while any of them is still being written.
+    for path, state in list(self.pending.items()):
+      signature = self._get_signature(path)
+
+      if signature != state[0]:
+        state[0] = signature
+        state[1] = now
+      elif signature is None and now - state[1] >= self.missing_timeout:
+        # Deleted and never recreated; nothing to convert.
+        del self.pending[path]
+
+    if not self.pending:
+      return None
+
+    if all(state[0] is not None and now - state[1] >= self.quiescence for state in self.pending.values()):
+      ready = sorted(self.pending)
+      self.pending = {}
+      return ready
+
+    return None
+
+  def _get_signature(self, path):
+    try:
+      stat = os.stat(path)
+      return (stat.st_size, stat.st_mtime_ns)
+    except OSError as stat_err:
+      return None
+
+class BriefingIndex():
+  def __init__(self, briefing_dir):
+    super(BriefingIndex, self).__init__()
+    self.briefing_dir = briefing_dir
+    # Name -> (mtime, size, content hash) of every briefing seen so far.
+    self.entries = {}
+
+  def refresh(self):
+    # Only briefings that are new or have been written to since are read (and hashed); returns
+    # those (name -> contents), the names of briefings that have gone away and any read errors (the
+    # briefings in question are simply read again next time).
+    changed = {}
+    errors = []
+    seen = set()
+
+    with os.scandir(self.briefing_dir) as entries:
+      briefings = [entry for entry in entries if entry.is_file() and fnmatch.fnmatch(entry.name, BRIEFING_PATTERN)]
+
+    for entry in briefings:
+      seen.add(entry.name)
+
+      try:
+        stat = entry.stat()
+        indexed = self.entries.get(entry.name)
+
+        if indexed and indexed[:2] == (stat.st_mtime_ns, stat.st_size):
+          continue
+
+        data = read_shared(entry.path)
+        self.entries[entry.name] = (stat.st_mtime_ns, stat.st_size, hashlib.sha256(data).hexdigest())
+        changed[entry.name] = data
+      except FileNotFoundError as missing_err:
+        seen.discard(entry.name)
+      except OSError as read_err:
+        errors.append(read_err)
+
+    removed = [name for name in self.entries if name not in seen]
+
+    for name in removed:
+      del self.entries[name]
+
+    return changed, removed, errors
+
+  def forget(self, names):
+    # For briefings that were read but never published.
+    for name in names:
+      self.entries.pop(name, None)
+
+  def get_hash(self, name):
+    entry = self.entries.get(name)
+    return entry[2] if entry else None
+
+  def get_newest(self):
+    return max(self.entries, key=lambda name: self.entries[name][0], default=None)
+
+class BriefingConverter():
+  def __init__(self, index, publisher):
+    super(BriefingConverter, self).__init__()
+    self.index = index
+    self.publisher = publisher
+    self.changed = []
+    self.published = False
+
+  def run(self):
+    start = time.perf_counter()
+    changed, removed, errors = self.index.refresh()
+
+    try:
+      if changed or removed:
+        self._publish(changed, removed, start)
+    except Exception as publish_err:
+      self.index.forget(changed)
+      raise publish_err
+
+    if errors:
+      raise errors[0]
+
+  def _publish(self, changed, removed, start):
+    staging = self.publisher.begin()
+
+    try:
+      # Every briefing under its own name, plus the newest one as briefing.html (for clients that
+      # only know about that one); content that's already published isn't even written.
+      files = { BRIEFINGS_PREFIX + name: name for name in changed }
+      newest = self.index.get_newest()
+
+      if newest:
+        files[BRIEFING_NAME] = newest
+
+      for name, briefing in files.items():
+        if staging.get_hash(name) == self.index.get_hash(briefing):
+          continue
+
+        data = changed.get(briefing)
+
+        if data is None:
+          staging.set_file(name, self.index.get_hash(briefing))
+        else:
+          with open(staging.get_staging_path(name), 'wb') as out_file:
+            out_file.write(data)
+
+        self.changed.append(name)
+
+      # Anything published that isn't there anymore goes (whether it was removed just now or not).
+      for name in list(staging.files):
+        if name.startswith(BRIEFINGS_PREFIX) and not self.index.get_hash(name[len(BRIEFINGS_PREFIX):]):
+          staging.remove_file(name)
+          self.changed.append(name)
+
+      if not newest and staging.get_hash(BRIEFING_NAME):
+        staging.remove_file(BRIEFING_NAME)
+        self.changed.append(BRIEFING_NAME)
+
+      if self.changed:
+        BRIEFING_COPY_SECONDS.observe(time.perf_counter() - start)
+        self.publisher.commit(staging)
+        self.published = True
+      else:
+        self.publisher.abort(staging)
+
+      staging = None
+
+    finally:
+      if staging:
+        self.publisher.abort(staging)
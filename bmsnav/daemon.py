@@ -0,0 +1,58 @@
+import os
+import signal
+import threading
+
+from bmsnav.config import LogLevel, SERVER_ROOT, Config
+from bmsnav.console import ConsoleLog
+from bmsnav.controller import Controller
+from bmsnav.monitors import PollingWatcher
+
+# Runs the server without a window (e.g. as a background service, or on a machine without BMS and
+# a fake BMS tree). Logs go to stdout and the process runs until it is interrupted or terminated.
+#
+# Author: Sean Eidemiller (seidemiller@gmail.com)
+
+# ======== Main ========
+
+def main():
+  if not os.path.exists(SERVER_ROOT):
+    os.makedirs(SERVER_ROOT)
+
+  console_log = ConsoleLog()
+  console_log.add_listener(lambda line: print(line, flush=True))
+  log = console_log.append
+
+  log('Welcome to BMSNavServer! Initializing (headless)...')
+
+  stopping = threading.Event()
+  signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+  signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+
+  config = Config()
+  config.load(log)
+  console_log.set_max_lines(config.console_lines)
+
+  if config.log_file:
+    try:
+      console_log.open_file(config.log_file)
+    except Exception as log_file_err:
+      log('Unable to open log file: ' + str(log_file_err), LogLevel.WARN)
+
+  watcher = PollingWatcher()
+  watcher.start()
+  controller = Controller(config, watcher, log)
+
+  try:
+    if not controller.start():
+      log('Initialization failed.', LogLevel.ERROR)
+      return 1
+
+    # Woken up regularly so that signals are handled promptly on Windows as well.
+    while not stopping.wait(1):
+      pass
+
+    log('Shutting down...')
+    return 0
+  finally:
+    controller.stop()
+    watcher.stop()
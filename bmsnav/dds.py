@@ -0,0 +1,138 @@
+import io
+import struct
+
+# Decoding the DDS formats that kneeboards actually come in (uncompressed BGRA/BGR, DXT1/3/5) one
+# page (i.e. one half of the surface) at a time, straight into an image of its own. The whole
+# surface is never decoded (nor cropped), and uncompressed files skip Pillow's DDS plugin, which
+# decodes them pixel by pixel in Python. Anything else is left to Pillow as a whole.
+#
+# Author: Sean Eidemiller (seidemiller@gmail.com)
+
+# ======== Global ========
+
+DDS_MAGIC = b'DDS '
+DDS_HEADER_SIZE = 124
+DDS_DATA_OFFSET = 4 + DDS_HEADER_SIZE
+DDSD_PITCH = 0x8
+DDSD_MIPMAPCOUNT = 0x20000
+DDSD_LINEARSIZE = 0x80000
+DDPF_ALPHAPIXELS = 0x1
+DDPF_FOURCC = 0x4
+DDPF_RGB = 0x40
+BLOCK_SIZES = {
+  b'DXT1': 8,
+  b'DXT3': 16,
+  b'DXT5': 16
+}
+# Byte orders (first byte first) that Pillow can unpack without any help.
+RGB_RAW_MODES = {
+  'RGBA': ['RGBA', 'BGRA', 'ARGB', 'ABGR'],
+  'RGB': ['RGB', 'BGR', 'RGBX', 'BGRX', 'XRGB', 'XBGR']
+}
+
+def open_dds(data):
+  # Returns a decoder for the file's pages, or None if it has to be left to Pillow.
+  if len(data) < DDS_DATA_OFFSET or data[:4] != DDS_MAGIC:
+    return None
+
+  size, flags, height, width, pitch = struct.unpack_from('<5I', data, 4)
+  pf_flags, fourcc, bit_count = struct.unpack_from('<I4sI', data, 80)
+  masks = struct.unpack_from('<4I', data, 92)
+
+  # Both pages have to be whole blocks wide (and the surface whole blocks high).
+  if size != DDS_HEADER_SIZE or not width or not height or width % 8 or height % 4:
+    return None
+
+  if pf_flags & DDPF_FOURCC and fourcc in BLOCK_SIZES:
+    decoder = BlockDecoder(data, width, height, BLOCK_SIZES[fourcc])
+  elif pf_flags & DDPF_RGB and bit_count in (24, 32):
+    mode = 'RGBA' if pf_flags & DDPF_ALPHAPIXELS else 'RGB'
+    raw_mode = get_raw_mode(masks[:len(mode)], bit_count // 8)
+
+    if raw_mode not in RGB_RAW_MODES[mode]:
+      return None
+
+    row_size = width * bit_count // 8
+    pitch = pitch if flags & DDSD_PITCH and pitch >= row_size else row_size
+    decoder = RGBDecoder(data, width, height, mode, raw_mode, pitch, bit_count // 8)
+  else:
+    return None
+
+  # Truncated (e.g. still being written); Pillow reports that properly.
+  if len(data) < DDS_DATA_OFFSET + decoder.get_data_size():
+    return None
+
+  return decoder
+
+def get_raw_mode(masks, pixel_size):
+  # E.g. BGRA for masks R 0x00ff0000, G 0x0000ff00, B 0x000000ff, A 0xff000000.
+  raw_mode = ['X'] * pixel_size
+
+  for channel, mask in zip('RGBA', masks):
+    byte = next((b for b in range(pixel_size) if mask == 0xff << (8 * b)), None)
+
+    if byte is None or raw_mode[byte] != 'X':
+      return None
+
+    raw_mode[byte] = channel
+
+  return ''.join(raw_mode)
+
+# ======== Classes ========
+
+class BlockDecoder():
+  def __init__(self, data, width, height, block_size):
+    super(BlockDecoder, self).__init__()
+    self.data = data
+    self.width = width
+    self.height = height
+    self.block_size = block_size
+
+  def get_data_size(self):
+    return (self.width // 4) * (self.height // 4) * self.block_size
+
+  def get_page(self, index):
+    from PIL import Image
+
+    # Just the page's blocks (the left or right half of each row of blocks) behind a header for a
+    # surface half as wide and without mipmaps; Pillow's own decoder does the rest.
+    page_size = (self.width // 8) * self.block_size
+    row_size = (self.width // 4) * self.block_size
+    start = DDS_DATA_OFFSET + index * page_size
+    view = memoryview(self.data)
+    blocks = b''.join(view[start + row * row_size:start + row * row_size + page_size] for row in range(self.height // 4))
+
+    header = bytearray(view[:DDS_DATA_OFFSET])
+    flags = (struct.unpack_from('<I', header, 8)[0] | DDSD_LINEARSIZE) & ~(DDSD_PITCH | DDSD_MIPMAPCOUNT)
+    struct.pack_into('<I', header, 8, flags)
+    struct.pack_into('<2I', header, 16, self.width // 2, len(blocks))
+    struct.pack_into('<I', header, 28, 0)
+
+    page_img = Image.open(io.BytesIO(bytes(header) + blocks))
+    page_img.load()
+
+    return page_img
+
+class RGBDecoder():
+  def __init__(self, data, width, height, mode, raw_mode, pitch, pixel_size):
+    super(RGBDecoder, self).__init__()
+    self.data = data
+    self.width = width
+    self.height = height
+    self.mode = mode
+    self.raw_mode = raw_mode
+    self.pitch = pitch
+    self.pixel_size = pixel_size
+
+  def get_data_size(self):
+    return self.pitch * self.height
+
+  def get_page(self, index):
+    from PIL import Image
+
+    # Unpacked row by row, starting halfway into each row for the right page and skipping the rest
+    # of it (i.e. the other page) by way of the stride.
+    start = DDS_DATA_OFFSET + index * (self.width // 2) * self.pixel_size
+    view = memoryview(self.data)[start:DDS_DATA_OFFSET + self.get_data_size()]
+
+    return Image.frombytes(self.mode, (self.width // 2, self.height), view, 'raw', self.raw_mode, self.pitch, 1)
@@ -0,0 +1,251 @@
+import sys
+import os
+import threading
+
+from PySide6.QtCore import QFileSystemWatcher, QObject, QUrl, Signal
+from PySide6.QtGui import QDesktopServices, QFont
+from PySide6.QtWidgets import (
+  QApplication,
+  QHBoxLayout,
+  QVBoxLayout,
+  QComboBox,
+  QLabel,
+  QMainWindow,
+  QPlainTextEdit,
+  QPushButton,
+  QScrollBar,
+  QWidget
+)
+
+from bmsnav.config import LogLevel, SERVER_ROOT, Config
+from bmsnav.console import ConsoleLog
+from bmsnav.controller import Controller
+
+# The Qt window; only imported when running with the GUI.
+#
+# Author: Sean Eidemiller (seidemiller@gmail.com)
+
+# ======== Window and UI Elements ========
+
+class QtWatcher(QObject):
+  watch_requested = Signal(list, object)
+  unwatch_requested = Signal(list)
+
+  def __init__(self):
+    super(QtWatcher, self).__init__()
+    self.callbacks = {}
+    self.fs_watcher = QFileSystemWatcher()
+    self.fs_watcher.fileChanged.connect(self._on_change)
+    self.fs_watcher.directoryChanged.connect(self._on_change)
+    self.watch_requested.connect(self._watch)
+    self.unwatch_requested.connect(self._unwatch)
+
+  def watch(self, paths, on_change):
+    # May be called from any thread; the file system watcher itself is only ever touched from the
+    # UI thread.
+    self.watch_requested.emit(list(paths), on_change)
+
+  def unwatch(self, paths):
+    self.unwatch_requested.emit(list(paths))
+
+  def _watch(self, paths, on_change):
+    self._unwatch(paths)
+    self.fs_watcher.addPaths(paths)
+
+    for path in paths:
+      self.callbacks[path] = on_change
+
+  def _unwatch(self, paths):
+    watched = set(self.fs_watcher.files()) | set(self.fs_watcher.directories())
+    removed = [p for p in paths if p in watched]
+
+    if removed:
+      self.fs_watcher.removePaths(removed)
+
+    for path in paths:
+      self.callbacks.pop(path, None)
+
+  def _on_change(self, path):
+    on_change = self.callbacks.get(path)
+
+    if on_change:
+      on_change(path)
+
+class Window(QMainWindow):
+  # The controller reports from its own threads; these hand everything over to the UI thread.
+  console_lines_ready = Signal()
+  dds_progress = Signal(int, int)
+  dds_busy = Signal(bool)
+
+  def __init__(self):
+    super(Window, self).__init__()
+
+    self.console_log = ConsoleLog()
+    self.console_pending_lines = []
+    self.console_pending_lock = threading.Lock()
+
+    self.setWindowTitle("BMSNavServer")
+    self.setGeometry(0, 0, 800, 400)
+
+    central_widget = QWidget()
+    central_widget.setObjectName('central')
+
+    central_layout = QVBoxLayout()
+    central_widget.setLayout(central_layout)
+
+    controls = QWidget()
+    controls.setObjectName('controls')
+
+    controls_layout = QHBoxLayout()
+    controls.setLayout(controls_layout)
+
+    theater_selection = QWidget()
+    theater_selection.setObjectName('theater_selection')
+
+    theater_selection_layout = QHBoxLayout()
+    theater_selection.setLayout(theater_selection_layout)
+
+    theater_label = QLabel()
+    theater_label.setObjectName('theater_label')
+    theater_label.setText('Theater:')
+
+    theater_combobox = QComboBox()
+    self.theater_combobox = theater_combobox
+
+    theater_selection_layout.addWidget(theater_label)
+    theater_selection_layout.addStretch(1)
+    theater_selection_layout.addWidget(theater_combobox)
+    theater_selection_layout.setContentsMargins(4, 0, 0, 0)
+
+    doc_button = QPushButton()
+    doc_button.setObjectName('doc_button')
+    doc_button.setText('Documentation')
+    doc_button.clicked.connect(self.doc_open)
+
+    rollback_button = QPushButton()
+    rollback_button.setObjectName('rollback_button')
+    rollback_button.setText('Roll Back')
+    self.rollback_button = rollback_button
+
+    clear_button = QPushButton()
+    clear_button.setObjectName('clear_button')
+    clear_button.setText('Clear Console')
+    clear_button.clicked.connect(self.console_clear)
+
+    controls_layout.addWidget(theater_selection)
+    controls_layout.addStretch(1)
+    controls_layout.addWidget(doc_button)
+    controls_layout.addWidget(rollback_button)
+    controls_layout.addWidget(clear_button)
+    controls_layout.setContentsMargins(0, 0, 0, 0)
+
+    self.console_output = QPlainTextEdit()
+    self.console_output.setObjectName('console_output')
+    self.console_output.setReadOnly(True)
+    self.console_output.setMaximumBlockCount(self.console_log.lines.maxlen)
+    self.console_output.setFont(QFont('Courier New'))
+
+    self.console_output_scrollbar = QScrollBar()
+    self.console_output.setVerticalScrollBar(self.console_output_scrollbar)
+
+    central_layout.addWidget(controls)
+    central_layout.addWidget(self.console_output)
+
+    self.setCentralWidget(central_widget)
+
+    self.console_lines_ready.connect(self._on_console_lines_ready)
+    self.console_log.add_listener(self._on_console_line)
+    self.dds_progress.connect(self._on_dds_conversion_progress)
+    self.dds_busy.connect(self._on_dds_conversion_busy)
+
+    self.console_append('Welcome to BMSNavServer! Initializing...')
+
+    self.config = Config()
+    self.config.load(self.log)
+    self.console_log.set_max_lines(self.config.console_lines)
+    self.console_output.setMaximumBlockCount(self.config.console_lines)
+
+    if self.config.log_file:
+      try:
+        self.console_log.open_file(self.config.log_file)
+      except Exception as log_file_err:
+        self.console_append('Unable to open log file: ' + str(log_file_err), LogLevel.WARN)
+
+    self.watcher = QtWatcher()
+    self.controller = Controller(self.config, self.watcher, self.log, self.dds_progress.emit, self.dds_busy.emit)
+
+    init_failed = not self.controller.start()
+
+    theater_combobox.addItems(self.config.theater_names)
+    theater_combobox.setCurrentText(self.config.selected_theater['name'])
+    theater_combobox.currentTextChanged.connect(self.controller.set_theater)
+    rollback_button.clicked.connect(self.controller.rollback)
+
+    if init_failed:
+      self.console_append('Initialization failed.', LogLevel.ERROR)
+
+  def closeEvent(self, event):
+    self.controller.stop()
+
+    super(Window, self).closeEvent(event)
+
+  def log(self, message, level = LogLevel.INFO):
+    self.console_log.append(message, level)
+
+  def console_append(self, message, level = LogLevel.INFO):
+    self.console_log.append(message, level)
+
+  def console_clear(self):
+    self.console_log.clear()
+    self.console_output.clear()
+    self.console_append('Console cleared.')
+
+  def _on_console_line(self, line):
+    # Called from whichever thread logged the line. Lines are collected until the UI thread gets
+    # around to them, so a burst of messages costs one (incremental) update rather than one each.
+    with self.console_pending_lock:
+      self.console_pending_lines.append(line)
+      first = len(self.console_pending_lines) == 1
+
+    if first:
+      self.console_lines_ready.emit()
+
+  def _on_console_lines_ready(self):
+    with self.console_pending_lock:
+      lines = self.console_pending_lines
+      self.console_pending_lines = []
+
+    if lines:
+      self.console_output.appendPlainText('\n'.join(lines))
+      self.console_output_scrollbar.setValue(self.console_output_scrollbar.maximum())
+
+  def doc_open(self):
+    try:
+      QDesktopServices.openUrl(QUrl('https://rsedev.net/bmsnav'))
+    except Exception as doc_err:
+      self.console_append('Unable to open documentation website: ' + str(doc_err))
+
+  def _on_dds_conversion_progress(self, done, total):
+    if done < total:
+      self.setWindowTitle(f'BMSNavServer (generating kneeboards: {done}/{total})')
+    else:
+      self.setWindowTitle('BMSNavServer')
+
+  def _on_dds_conversion_busy(self, busy):
+    if not busy:
+      self.setWindowTitle('BMSNavServer')
+
+    self.theater_combobox.setEnabled(not busy)
+    self.rollback_button.setEnabled(not busy)
+
+# ======== Main ========
+
+def main():
+  if not os.path.exists(SERVER_ROOT):
+    os.makedirs(SERVER_ROOT)
+
+  app = QApplication(sys.argv)
+  window = Window()
+  window.show()
+
+  return app.exec()
@@ -0,0 +1,289 @@
+import bisect
+import threading
+
+# Counters, gauges and histograms for conversion and serving, rendered in the Prometheus text format
+# (see /metrics). Recording is a lock and a couple of additions, so it stays on all the time.
+#
+# Author: Sean Eidemiller (seidemiller@gmail.com)
+
+# ======== Global ========
+
+# Seconds; covers everything from a 304 to converting an uncompressed DDS file.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+def format_labels(names, values, extra=None):
+  pairs = list(zip(names, values)) + (extra or [])
+
+  if not pairs:
+    return ''
+
+  escaped = [(n, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for n, v in pairs]
+  return '{' + ','.join(f'{n}="{v}"' for n, v in escaped) + '}'
+
+def format_value(value):
+  if value == float('inf'):
+    return '+Inf'
+
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+# ======== Classes ========
+
+class Metric():
+  kind = None
+
+  def __init__(self, name, description, labels=()):
+    super(Metric, self).__init__()
+    self.name = name
+    self.description = description
+    self.labels = tuple(labels)
+    self.lock = threading.Lock()
+    self.values = {}
+
+    # Unlabeled metrics are always rendered, even before anything has been recorded.
+    if not self.labels:
+      self.values[()] = self._get_empty()
+
+  def render(self):
+    lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}']
+
+    with self.lock:
+      for key, value in sorted(self.values.items()):
+        lines += self._render_value(key, value)
+
+    return lines
+
+  def _get_empty(self):
+    return 0
+
+  def _render_value(self, key, value):
+    return [f'{self.name}{format_labels(self.labels, key)} {format_value(value)}']
+
+class Counter(Metric):
+  kind = 'counter'
+
+  def inc(self, *labels, amount=1):
+    with self.lock:
+      self.values[labels] = self.values.get(labels, 0) + amount
+
+  def get(self, *labels):
+    with self.lock:
+      return self.values.get(labels, 0)
+
+  def get_total(self):
+    with self.lock:
+      return sum(self.values.values())
+
+class Gauge(Metric):
+  kind = 'gauge'
+
+  def __init__(self, name, description, labels=(), function=None):
+    super(Gauge, self).__init__(name, description, labels)
+    # Gauges that are cheaper to read when rendering than to keep up to date.
+    self.function = function
+
+  def inc(self, *labels, amount=1):
+    with self.lock:
+      self.values[labels] = self.values.get(labels, 0) + amount
+
+  def dec(self, *labels, amount=1):
+    self.inc(*labels, amount=-amount)
+
+  def set(self, value, *labels):
+    with self.lock:
+      self.values[labels] = value
+
+  def get(self, *labels):
+    if self.function:
+      return self.function()
+
+    with self.lock:
+      return self.values.get(labels, 0)
+
+  def render(self):
+    if self.function:
+      return [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} {self.kind}', f'{self.name} {format_value(self.function())}']
+
+    return super(Gauge, self).render()
+
+class Histogram(Metric):
+  kind = 'histogram'
+
+  def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+    self.buckets = tuple(buckets)
+    super(Histogram, self).__init__(name, description, labels)
+
+  def observe(self, value, *labels):
+    index = bisect.bisect_left(self.buckets, value)
+
+    with self.lock:
+      state = self.values.get(labels)
+
+      if state is None:
+        state = self.values[labels] = self._get_empty()
+
+      state[0][index] += 1
+      state[1] += value
+      state[2] += 1
+
+  def snapshot(self):
+    # Everything merged across labels, for summaries.
+    counts = [0] * (len(self.buckets) + 1)
+    total = 0.0
+
+    with self.lock:
+      for state in self.values.values():
+        counts = [a + b for a, b in zip(counts, state[0])]
+        total += state[1]
+
+    return counts, total
+
+  def get_quantile(self, counts, quantile):
+    # The upper bound of the bucket the quantile falls in (as precise as the buckets allow).
+    target = sum(counts) * quantile
+    seen = 0
+
+    for index, count in enumerate(counts):
+      seen += count
+
+      if count and seen >= target:
+        return self.buckets[index] if index < len(self.buckets) else float('inf')
+
+    return None
+
+  def _get_empty(self):
+    # Per-bucket (not cumulative) counts, the sum and the count.
+    return [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+  def _render_value(self, key, value):
+    counts, total, count = value
+    labels = format_labels(self.labels, key)
+    lines = []
+    cumulative = 0
+
+    for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+      cumulative += bucket_count
+      lines.append(f'{self.name}_bucket{format_labels(self.labels, key, [("le", format_value(bound))])} {cumulative}')
+
+    lines.append(f'{self.name}_sum{labels} {format_value(total)}')
+    lines.append(f'{self.name}_count{labels} {count}')
+
+    return lines
+
+class Registry():
+  def __init__(self):
+    super(Registry, self).__init__()
+    self.metrics = []
+
+  def add(self, metric):
+    self.metrics.append(metric)
+    return metric
+
+  def render(self):
+    lines = []
+
+    for metric in self.metrics:
+      lines += metric.render()
+
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+# ======== Metrics ========
+
+REGISTRY = Registry()
+
+DDS_CONVERSION_SECONDS = REGISTRY.add(Histogram(
+  'bmsnav_dds_conversion_seconds',
+  'Time spent converting one kneeboard DDS file (both pages), by stage.',
+  ['stage']
+))
+PNG_OPTIMIZATION_SECONDS = REGISTRY.add(Histogram(
+  'bmsnav_png_optimization_seconds',
+  'Time spent re-encoding the pages of one kneeboard DDS file in the background.'
+))
+PNG_OPTIMIZATION_BYTES_TOTAL = REGISTRY.add(Counter(
+  'bmsnav_png_optimization_bytes_total',
+  'Size of the pages swapped for background re-encodes, by encoding (fast before, optimized after).',
+  ['encoding']
+))
+VARIANT_ENCODE_SECONDS = REGISTRY.add(Histogram(
+  'bmsnav_variant_encode_seconds',
+  'Time spent producing an alternative encoding or color transform of a page (on its first request), by variant.',
+  ['variant']
+))
+PAGE_WAIT_SECONDS = REGISTRY.add(Histogram(
+  'bmsnav_page_wait_seconds',
+  'Time page requests spent waiting for the page to be reconverted, by result (fresh or timeout).',
+  ['result']
+))
+BRIEFING_COPY_SECONDS = REGISTRY.add(Histogram(
+  'bmsnav_briefing_copy_seconds',
+  'Time spent copying the briefing into a generation.'
+))
+CHANGE_TO_PUBLISH_SECONDS = REGISTRY.add(Histogram(
+  'bmsnav_change_to_publish_seconds',
+  'Time from the first file system event of a change to the generation containing it being published.',
+  ['source']
+))
+CONVERSION_CACHE_TOTAL = REGISTRY.add(Counter(
+  'bmsnav_conversion_cache_total',
+  'DDS files checked against the conversion cache, by result (hit means no conversion was needed).',
+  ['result']
+))
+HTTP_REQUESTS_TOTAL = REGISTRY.add(Counter(
+  'bmsnav_http_requests_total',
+  'HTTP requests handled, by route and status.',
+  ['route', 'status']
+))
+HTTP_RESPONSE_BYTES_TOTAL = REGISTRY.add(Counter(
+  'bmsnav_http_response_bytes_total',
+  'HTTP response body bytes sent, by route.',
+  ['route']
+))
+HTTP_REQUEST_SECONDS = REGISTRY.add(Histogram(
+  'bmsnav_http_request_seconds',
+  'Time from routing an HTTP request to its response having been written, by route.',
+  ['route']
+))
+HTTP_CONNECTIONS = REGISTRY.add(Gauge(
+  'bmsnav_http_connections',
+  'Open HTTP connections (not counting event stream subscribers).'
+))
+EVENT_CLIENTS = REGISTRY.add(Gauge(
+  'bmsnav_event_clients',
+  'Clients subscribed to the /events stream.'
+))
+
+# ======== Summary ========
+
+def get_summary_snapshot():
+  counts, total = HTTP_REQUEST_SECONDS.snapshot()
+
+  return {
+    'requests': HTTP_REQUESTS_TOTAL.get_total(),
+    'bytes': HTTP_RESPONSE_BYTES_TOTAL.get_total(),
+    'latency': counts
+  }
+
+def format_summary(previous, current, interval):
+  # One line for the console covering the time since the previous snapshot; None if it was idle.
+  requests = current['requests'] - previous['requests']
+
+  if not requests:
+    return None
+
+  megabytes = (current['bytes'] - previous['bytes']) / (1024 * 1024)
+  latency = [a - b for a, b in zip(current['latency'], previous['latency'])]
+  p99 = HTTP_REQUEST_SECONDS.get_quantile(latency, 0.99)
+  hits = CONVERSION_CACHE_TOTAL.get('hit')
+  checked = hits + CONVERSION_CACHE_TOTAL.get('miss')
+
+  message = f'Served {requests} requests ({megabytes:.1f} MB) in the last {interval / 60:g} min'
+
+  if p99 is not None:
+    message += ', p99 latency ' + (f'under {p99 * 1000:g} ms' if p99 != float('inf') else f'over {HTTP_REQUEST_SECONDS.buckets[-1]:g} s')
+
+  message += f'; {HTTP_CONNECTIONS.get()} connections, {EVENT_CLIENTS.get()} event clients'
+
+  if checked:
+    message += f'; conversion cache hit ratio {hits / checked:.0%}'
+
+  return message + '.'
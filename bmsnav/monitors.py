@@ -0,0 +1,115 @@
+import os
+import threading
+
+from bmsnav.config import WATCH_POLL_INTERVAL_MS, get_dds_dir, get_dds_files, get_briefing_dir
+
+# Watching the kneeboard DDS files and the briefings directory. The monitors work with any watcher
+# that has watch(paths, on_change) and unwatch(paths); the GUI uses Qt's and the daemon polls.
+#
+# Author: Sean Eidemiller (seidemiller@gmail.com)
+
+# ======== Watching ========
+
+def get_path_signature(path):
+  try:
+    if os.path.isdir(path):
+      with os.scandir(path) as entries:
+        return tuple(sorted((e.name, e.stat().st_size, e.stat().st_mtime_ns) for e in entries))
+
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+  except OSError as stat_err:
+    return None
+
+# ======== Classes ========
+
+class PollingWatcher():
+  def __init__(self, interval=WATCH_POLL_INTERVAL_MS / 1000):
+    super(PollingWatcher, self).__init__()
+    self.interval = interval
+    self.lock = threading.Lock()
+    self.watched = {}
+    self.stopping = threading.Event()
+    self.thread = None
+
+  def start(self):
+    self.thread = threading.Thread(target=self._run, daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    self.stopping.set()
+
+    if self.thread:
+      self.thread.join()
+
+  def watch(self, paths, on_change):
+    with self.lock:
+      for path in paths:
+        # A path that's already watched keeps what it was last seen as, so that a change made in
+        # the meantime is still reported.
+        if path in self.watched:
+          self.watched[path][1] = on_change
+        else:
+          self.watched[path] = [get_path_signature(path), on_change]
+
+  def unwatch(self, paths):
+    with self.lock:
+      for path in paths:
+        self.watched.pop(path, None)
+
+  def _run(self):
+    while not self.stopping.wait(self.interval):
+      changed = []
+
+      with self.lock:
+        for path, state in self.watched.items():
+          signature = get_path_signature(path)
+
+          if signature != state[0]:
+            state[0] = signature
+            changed.append((path, state[1]))
+
+      for path, on_change in changed:
+        on_change(path)
+
+class DDSMonitor():
+  def __init__(self, bms_home_dir, on_change, watcher):
+    super(DDSMonitor, self).__init__()
+    self.bms_home_dir = bms_home_dir
+    self.on_change = on_change
+    self.watcher = watcher
+    self.dds_dir = None
+    self.dds_files = []
+
+  def start(self, selected_theater):
+    self.dds_dir = get_dds_dir(self.bms_home_dir, selected_theater)
+    self.dds_files = get_dds_files(self.dds_dir)
+    self.watcher.watch(self.dds_files, self.on_change)
+
+    return self.dds_dir
+
+  def restart(self, selected_theater=None, dds_files=None):
+    # Either switches to another theater's files or (with native watchers, which lose track of
+    # files that are replaced) watches the given ones again.
+    if selected_theater:
+      self.watcher.unwatch(self.dds_files)
+      self.dds_dir = get_dds_dir(self.bms_home_dir, selected_theater)
+      self.dds_files = get_dds_files(self.dds_dir)
+
+    self.watcher.watch(dds_files or self.dds_files, self.on_change)
+
+    return self.dds_dir
+
+class BriefingMonitor():
+  def __init__(self, bms_home_dir, on_change, watcher):
+    super(BriefingMonitor, self).__init__()
+    self.bms_home_dir = bms_home_dir
+    self.on_change = on_change
+    self.watcher = watcher
+    self.briefing_dir = None
+
+  def start(self):
+    self.briefing_dir = get_briefing_dir(self.bms_home_dir)
+    self.watcher.watch([self.briefing_dir], self.on_change)
+
+    return self.briefing_dir
@@ -0,0 +1,593 @@
+import os
+import json
+import hashlib
+import threading
+import shutil
+import zlib
+
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+from bmsnav.config import (
+  BLOBS_DIR,
+  STAGING_DIR,
+  GENERATIONS_FILE,
+  LEGACY_PATHS,
+  DEFAULT_GENERATION_HISTORY,
+  BRIEFING_NAME,
+  BRIEFINGS_PREFIX,
+  PAGE_NAMES,
+  COMPRESSED_DIR,
+  COMPRESSIBLE_EXTENSIONS,
+  CONTENT_ENCODINGS,
+  COMPRESSED_MIN_SIZE,
+  COMPRESSED_MAX_RATIO
+)
+
+# Publishing converted files as immutable, numbered generations. Files are stored once, by content
+# (in the blob store); a generation just maps names to content hashes.
+#
+# Author: Sean Eidemiller (seidemiller@gmail.com)
+
+# ======== Publishing ========
+
+def hash_file(path):
+  # One pass for both the content hash (ETags, manifest) and the CRC-32 (zip bundles).
+  hasher = hashlib.sha256()
+  crc = 0
+
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(1024 * 1024), b''):
+      hasher.update(chunk)
+      crc = zlib.crc32(chunk, crc)
+
+  return hasher.hexdigest(), crc
+
+def get_png_dims(path):
+  # Straight from the IHDR chunk; far cheaper than having Pillow open the image.
+  try:
+    with open(path, 'rb') as f:
+      header = f.read(24)
+
+    if header[:8] == b'\x89PNG\r\n\x1a\n' and header[12:16] == b'IHDR':
+      return int.from_bytes(header[16:20], 'big'), int.from_bytes(header[20:24], 'big')
+  except OSError as png_err:
+    pass
+
+  return None, None
+
+def get_iso_time(timestamp):
+  return datetime.fromtimestamp(timestamp, timezone.utc).isoformat(timespec='seconds')
+
+def describe_blob(path, crc=None):
+  # Everything the manifest and the zip bundles need to know about a stored file; the file is only
+  # read if its CRC isn't known already (i.e. from when it was hashed).
+  if crc is None:
+    crc = 0
+
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(1024 * 1024), b''):
+        crc = zlib.crc32(chunk, crc)
+
+  stat = os.stat(path)
+  width, height = get_png_dims(path)
+  info = { 'crc32': crc, 'size': stat.st_size, 'mtime': stat.st_mtime }
+
+  # Only images have dimensions (rather than null ones).
+  if width is not None:
+    info.update(width=width, height=height)
+
+  return info
+
+def is_compressible(name):
+  return name.lower().endswith(COMPRESSIBLE_EXTENSIONS)
+
+def compress_bytes(data):
+  # Encoding -> compressed data, for every encoding that's available (brotli is optional) and worth
+  # it; compressed as hard as possible, since it only ever happens once per content.
+  if len(data) < COMPRESSED_MIN_SIZE:
+    return {}
+
+  encoded = {}
+
+  for encoding in CONTENT_ENCODINGS:
+    try:
+      if encoding == 'br':
+        import brotli
+        compressed = brotli.compress(data, quality=11)
+      else:
+        import gzip
+        compressed = gzip.compress(data, 9, mtime=0)
+    except ImportError as encoding_err:
+      continue
+
+    if len(compressed) <= len(data) * COMPRESSED_MAX_RATIO:
+      encoded[encoding] = compressed
+
+  return encoded
+
+def write_compressed(path, out_dir):
+  # One file per encoding, in a directory named after the content hash (which may end up empty if
+  # nothing was worth it, meaning there's nothing to do the next time around either).
+  with open(path, 'rb') as f:
+    encoded = compress_bytes(f.read())
+
+  tmp_dir = f'{out_dir}.{os.getpid()}.tmp'
+  os.makedirs(tmp_dir, exist_ok=True)
+
+  for encoding, data in encoded.items():
+    with open(os.path.join(tmp_dir, encoding), 'wb') as out_file:
+      out_file.write(data)
+
+  try:
+    os.replace(tmp_dir, out_dir)
+  except OSError as replace_err:
+    # Somebody else got there first.
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def get_compressed_paths(content_hash, compressed_dir=COMPRESSED_DIR):
+  # Encoding -> path of whatever was compressed for the content when it was published.
+  out_dir = os.path.join(compressed_dir, content_hash)
+
+  try:
+    with os.scandir(out_dir) as entries:
+      return { entry.name: entry.path for entry in entries if entry.name in CONTENT_ENCODINGS }
+  except OSError as scan_err:
+    return {}
+
+# ======== Classes ========
+
+class BlobStore():
+  def __init__(self, path=BLOBS_DIR):
+    super(BlobStore, self).__init__()
+    self.path = path
+    self.lock = threading.Lock()
+    self.counts = {}
+    # CRCs of the blobs added this session, taken along with their hashes.
+    self.crcs = {}
+    self.derived_dirs = []
+
+    os.makedirs(self.path, exist_ok=True)
+
+  def get_path(self, content_hash):
+    return os.path.join(self.path, content_hash)
+
+  def exists(self, content_hash):
+    return os.path.exists(self.get_path(content_hash))
+
+  def add(self, path, content_hash, crc=None):
+    # Moves a new file into the store (unless the very same content is already there). The caller
+    # gets a reference to the blob, to be released once something else refers to it.
+    blob_path = self.get_path(content_hash)
+
+    with self.lock:
+      if os.path.exists(blob_path):
+        os.remove(path)
+      else:
+        os.replace(path, blob_path)
+
+      self.counts[content_hash] = self.counts.get(content_hash, 0) + 1
+
+      if crc is not None:
+        self.crcs[content_hash] = crc
+
+  def get_crc(self, content_hash):
+    with self.lock:
+      return self.crcs.get(content_hash)
+
+  def ref(self, hashes):
+    with self.lock:
+      for content_hash in hashes:
+        self.counts[content_hash] = self.counts.get(content_hash, 0) + 1
+
+  def unref(self, hashes):
+    with self.lock:
+      for content_hash in hashes:
+        count = self.counts.get(content_hash, 0) - 1
+
+        if count > 0:
+          self.counts[content_hash] = count
+        else:
+          # Removed while holding the lock, so that the same content can't be added back meanwhile.
+          self.counts.pop(content_hash, None)
+          self._remove(content_hash)
+
+  def add_derived_dir(self, path):
+    # A directory of content derived from stored files (e.g. tiles), with one entry per content
+    # hash; entries are removed along with the blob they were derived from.
+    os.makedirs(path, exist_ok=True)
+    self.derived_dirs.append(path)
+
+  def collect(self):
+    # Removes anything nothing refers to (i.e. left over from a previous session); only called once
+    # everything that refers to blobs has taken its references.
+    with self.lock:
+      for directory in [self.path] + self.derived_dirs:
+        with os.scandir(directory) as entries:
+          stale = [entry.name for entry in entries if entry.name not in self.counts]
+
+        for name in stale:
+          self._remove_path(os.path.join(directory, name))
+
+  def _remove(self, content_hash):
+    self.crcs.pop(content_hash, None)
+
+    for directory in [self.path] + self.derived_dirs:
+      self._remove_path(os.path.join(directory, content_hash))
+
+  def _remove_path(self, path):
+    try:
+      if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+      elif os.path.exists(path):
+        os.remove(path)
+    except OSError as remove_err:
+      # E.g. still open elsewhere (on Windows); collected on the next start instead.
+      pass
+
+class Generation():
+  def __init__(self, gen_id, store, files=None, theater=None):
+    super(Generation, self).__init__()
+    self.id = gen_id
+    self.store = store
+    self.theater = theater
+    self.refs = 0
+    self.files = dict(files or {})
+    # Whether only some of the pages are in yet (e.g. the ones clients were waiting for); a partial
+    # generation is no set to roll back to, and whatever is published next takes its place.
+    self.partial = False
+    self.manifest = None
+    self.manifest_hash = None
+    self.manifest_encoded = {}
+    self.briefings = None
+    self.briefings_hash = None
+    self.briefings_encoded = {}
+    # Only set while staged; new files are written in here and stored on commit.
+    self.path = None
+
+  def get_path(self, name):
+    return self.store.get_path(self.files[name]['hash'])
+
+  def get_staging_path(self, name):
+    # Names may include a directory (e.g. briefings/...), which is staged as such.
+    path = os.path.join(self.path, *name.split('/'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    return path
+
+  def get_hash(self, name):
+    entry = self.files.get(name)
+    return entry['hash'] if entry else None
+
+  def get_hashes(self):
+    return [entry['hash'] for entry in self.files.values()]
+
+  def get_page_hashes(self):
+    return { name: self.files[name]['hash'] for name in PAGE_NAMES if name in self.files }
+
+  def set_file(self, name, content_hash):
+    if self.get_hash(name) != content_hash:
+      self.files[name] = { 'hash': content_hash }
+
+  def remove_file(self, name):
+    self.files.pop(name, None)
+
+  def index_files(self, known_entries):
+    # Describes whatever is new in the generation, reusing what's already known about the very same
+    # content (e.g. under another name, or in an earlier generation).
+    for name, entry in self.files.items():
+      if 'crc32' in entry:
+        continue
+
+      known = known_entries.get(entry['hash'])
+
+      if known:
+        info = { k: known[k] for k in ('crc32', 'size', 'width', 'height', 'mtime') if k in known }
+      else:
+        info = describe_blob(self.store.get_path(entry['hash']), self.store.get_crc(entry['hash']))
+
+      self.files[name] = {
+        'hash': entry['hash'],
+        **info,
+        'generation': self.id,
+        'converted': get_iso_time(info['mtime'])
+      }
+
+    self.build_manifest()
+
+  def build_manifest(self):
+    # Built once per generation (and served from memory) so that clients can diff against what
+    # they already have with a single small request.
+    pages = { 'left': [], 'right': [] }
+
+    for side, prefix in (('left', 'l'), ('right', 'r')):
+      for page in range(1, 17):
+        name = f'{prefix}{page:02d}.png'
+        entry = self.files.get(name)
+
+        if entry:
+          pages[side].append({ 'page': page, 'name': name, **self._describe(entry) })
+
+    briefing = self.files.get(BRIEFING_NAME)
+
+    manifest = {
+      'generation': self.id,
+      'theater': self.theater,
+      'pages': pages,
+      'briefing': { 'name': BRIEFING_NAME, **self._describe(briefing) } if briefing else None,
+      'briefings': self.get_briefings()
+    }
+
+    self.manifest = json.dumps(manifest, indent=2).encode('utf-8')
+    self.manifest_hash = hashlib.sha256(self.manifest).hexdigest()
+    self.manifest_encoded = compress_bytes(self.manifest)
+
+    self.briefings = json.dumps({ 'briefings': manifest['briefings'] }, indent=2).encode('utf-8')
+    self.briefings_hash = hashlib.sha256(self.briefings).hexdigest()
+    self.briefings_encoded = compress_bytes(self.briefings)
+
+  def get_briefings(self):
+    # Every briefing in the briefings directory (e.g. one per flight member), by name.
+    return [
+      { 'name': name[len(BRIEFINGS_PREFIX):], 'url': quote('/' + name), **self._describe(entry) }
+      for name, entry in sorted(self.files.items()) if name.startswith(BRIEFINGS_PREFIX)
+    ]
+
+  def _describe(self, entry):
+    return { k: v for k, v in entry.items() if k not in ('mtime', 'crc32') }
+
+class Publisher():
+  def __init__(self, store, state_file=GENERATIONS_FILE, staging_dir=STAGING_DIR, history=DEFAULT_GENERATION_HISTORY, compressed_dir=COMPRESSED_DIR):
+    super(Publisher, self).__init__()
+    self.store = store
+    # Where text files are compressed into when published (a derived directory of the store).
+    self.compressed_dir = compressed_dir
+    self.state_file = state_file
+    self.staging_dir = staging_dir
+    self.history = history
+    self.lock = threading.Lock()
+    self.publish_lock = threading.Lock()
+    # Every generation still around (kept for rolling back, or still being served) and the ids of
+    # the most recent ones, oldest first; the current generation is always the last of those.
+    self.generations = {}
+    self.retained = []
+    # Generations that were replaced (by one that looks exactly the same), by id, and the ids of
+    # what replaced them; clients may still know a page by the generation they got it from.
+    self.replaced = {}
+    self.current = None
+    self.last_id = 0
+    self.listeners = []
+
+    for path in LEGACY_PATHS:
+      try:
+        if os.path.isfile(path):
+          os.remove(path)
+      except OSError as remove_err:
+        # E.g. still open elsewhere (on Windows); tried again on the next start.
+        pass
+
+    # Anything staged is left over from a previous session.
+    shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+    try:
+      with open(self.state_file, 'r') as state_file:
+        state = json.loads(state_file.read())
+
+      for gen_state in state['generations']:
+        generation = Generation(int(gen_state['id']), self.store, gen_state['files'], gen_state.get('theater'))
+        generation.partial = gen_state.get('partial', False)
+        self.last_id = max(self.last_id, generation.id)
+
+        # Anything with content missing (e.g. after a crash) can neither be served nor rolled back to.
+        if all(self.store.exists(h) for h in generation.get_hashes()):
+          generation.build_manifest()
+          self._add(generation)
+    except Exception as state_err:
+      pass
+
+    if self.retained:
+      self.current = self.generations[self.retained[-1]]
+    else:
+      # Nothing (valid) published yet; start with an empty generation.
+      self.last_id += 1
+      self.current = Generation(self.last_id, self.store)
+      self.current.build_manifest()
+      self._add(self.current)
+      self._write_state()
+
+  def begin(self):
+    # Only one generation is staged at a time; it starts out with the current generation's files so
+    # that the converters only need to set (or write) what actually changed.
+    self.publish_lock.acquire()
+
+    try:
+      current = self.get_current()
+      staging = Generation(self.last_id + 1, self.store, current.files, current.theater)
+      staging.partial = current.partial
+      staging.path = self.staging_dir
+
+      shutil.rmtree(staging.path, ignore_errors=True)
+      os.makedirs(staging.path)
+
+      return staging
+    except Exception as begin_err:
+      self.publish_lock.release()
+      raise begin_err
+
+  def commit(self, staging, replace=False):
+    try:
+      added = []
+
+      try:
+        # Files written while staged are stored by content; everything else is already stored.
+        new_files = []
+
+        for directory, dir_names, file_names in os.walk(staging.path):
+          for file_name in file_names:
+            path = os.path.join(directory, file_name)
+            new_files.append((os.path.relpath(path, staging.path).replace(os.sep, '/'), path))
+
+        for name, path in new_files:
+          content_hash, crc = hash_file(path)
+          self.store.add(path, content_hash, crc)
+          added.append(content_hash)
+          staging.set_file(name, content_hash)
+
+        previous = self.get_current()
+        generation = Generation(staging.id, self.store, staging.files, staging.theater)
+        generation.partial = staging.partial
+        generation.index_files(self._get_known_entries())
+        self._compress(generation)
+        self._add(generation, replace)
+      finally:
+        self.store.unref(added)
+
+      with self.lock:
+        self.current = generation
+
+      self.last_id = generation.id
+      self._collect()
+      self._write_state()
+      shutil.rmtree(staging.path, ignore_errors=True)
+
+      changed = sorted(
+        name for name in set(previous.files) | set(generation.files)
+        if previous.get_hash(name) != generation.get_hash(name)
+      )
+
+      for listener in self.listeners:
+        try:
+          listener(generation, changed)
+        except Exception as listener_err:
+          # A misbehaving listener must not undo (or block) the publish itself.
+          pass
+
+      return generation
+    finally:
+      self.publish_lock.release()
+
+  def abort(self, staging):
+    try:
+      shutil.rmtree(staging.path, ignore_errors=True)
+    finally:
+      self.publish_lock.release()
+
+  def rollback(self):
+    # Publishes the kneeboards from before the current ones again (skipping generations that only
+    # changed the briefings), as a new generation so that clients simply see another change; the
+    # briefings stay as they are. Rolling back twice in a row undoes the first one.
+    with self.lock:
+      pages = self.current.get_page_hashes()
+      previous = None
+
+      for gen_id in reversed(self.retained[:-1]):
+        if self.generations[gen_id].get_page_hashes() != pages:
+          previous = self.generations[gen_id]
+          break
+
+    if not previous:
+      return None
+
+    staging = self.begin()
+    staging.theater = previous.theater
+    staging.partial = False
+
+    for name in PAGE_NAMES:
+      if name in previous.files:
+        staging.set_file(name, previous.get_hash(name))
+      else:
+        staging.remove_file(name)
+
+    return self.commit(staging)
+
+  def add_listener(self, listener):
+    self.listeners.append(listener)
+
+  def get_current(self):
+    with self.lock:
+      return self.current
+
+  def get_generation(self, gen_id):
+    # Any generation still around (not necessarily one that can be rolled back to), or what replaced
+    # it if it's gone.
+    with self.lock:
+      return self.generations.get(self._get_replacement(gen_id))
+
+  def acquire(self):
+    with self.lock:
+      self.current.refs += 1
+      return self.current
+
+  def release(self, generation):
+    with self.lock:
+      generation.refs -= 1
+
+    self._collect()
+
+  def _add(self, generation, replace=False):
+    self.store.ref(generation.get_hashes())
+
+    with self.lock:
+      self.generations[generation.id] = generation
+
+      # A replacement takes the current generation's place in the history rather than adding to it,
+      # and so does whatever comes after a partial generation.
+      if replace and self.retained:
+        self.replaced[self.retained.pop()] = generation.id
+      elif self.retained and self.generations[self.retained[-1]].partial:
+        self.retained.pop()
+
+      self.retained.append(generation.id)
+
+  def _compress(self, generation):
+    # Done once per content rather than per request; serving then just picks an encoding.
+    for name, entry in generation.files.items():
+      out_dir = os.path.join(self.compressed_dir, entry['hash'])
+
+      if is_compressible(name) and not os.path.isdir(out_dir):
+        os.makedirs(self.compressed_dir, exist_ok=True)
+        write_compressed(self.store.get_path(entry['hash']), out_dir)
+
+  def _get_known_entries(self):
+    with self.lock:
+      return { e['hash']: e for g in self.generations.values() for e in g.files.values() if 'crc32' in e }
+
+  def _collect(self):
+    stale = []
+
+    with self.lock:
+      # Only the most recent generations are kept (for rolling back); anything older goes as soon as
+      # nothing is serving it anymore.
+      del self.retained[:-self.history]
+
+      for gen_id, generation in list(self.generations.items()):
+        if gen_id not in self.retained and generation.refs <= 0:
+          del self.generations[gen_id]
+          stale.append(generation)
+
+      for gen_id in list(self.replaced):
+        if self._get_replacement(gen_id) not in self.generations:
+          del self.replaced[gen_id]
+
+    for generation in stale:
+      self.store.unref(generation.get_hashes())
+
+  def _get_replacement(self, gen_id):
+    # Follows the replacements of a generation that is gone. Called with the lock held.
+    while gen_id not in self.generations and gen_id in self.replaced:
+      gen_id = self.replaced[gen_id]
+
+    return gen_id
+
+  def _write_state(self):
+    with self.lock:
+      generations = [self.generations[gen_id] for gen_id in self.retained]
+
+    tmp_path = self.state_file + '.tmp'
+
+    with open(tmp_path, 'w') as state_file:
+      state_file.write(json.dumps({
+        'generations': [{ 'id': g.id, 'theater': g.theater, 'partial': g.partial, 'files': g.files } for g in generations]
+      }))
+
+    os.replace(tmp_path, self.state_file)
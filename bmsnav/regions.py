@@ -0,0 +1,241 @@
+import os
+import io
+import json
+import math
+import base64
+import threading
+
+from bmsnav.config import REGIONS_DIR, REGION_BLOCK_SIZE
+
+# Which parts of a page changed from one conversion to the next, as rectangles of whole blocks, so
+# that clients can be sent just those parts (a delta) rather than the whole page. They're found while
+# converting, by comparing against the page that was published before, and kept next to the blob
+# store (as a derived directory, by the new page's content hash) along with the deltas served from
+# them.
+#
+# Author: Sean Eidemiller (seidemiller@gmail.com)
+
+# ======== Regions ========
+
+def find_changed_regions(base_img, page_img, block_size=REGION_BLOCK_SIZE):
+  # None if the pages can't be compared at all (i.e. the whole page changed).
+  from PIL import ImageChops
+
+  if base_img.size != page_img.size:
+    return None
+
+  # Any difference in any band marks the pixel...
+  bands = ImageChops.difference(base_img.convert('RGBA'), page_img.convert('RGBA')).split()
+  changed = bands[0]
+
+  for band in bands[1:]:
+    changed = ImageChops.lighter(changed, band)
+
+  if not changed.getbbox():
+    return []
+
+  # ...then the mask is halved until there's one pixel per block, marking again after each step so
+  # that a single changed pixel survives the averaging.
+  changed = changed.point(lambda v: 255 if v else 0)
+
+  for step in range(int(math.log2(block_size))):
+    changed = changed.reduce(2).point(lambda v: 255 if v else 0)
+
+  return get_block_regions(changed.tobytes(), changed.size[0], changed.size[1], block_size, page_img.size)
+
+def get_block_regions(blocks, columns, rows, block_size, size):
+  # Runs of changed blocks in each row of blocks, each one merged with the run right above it if
+  # that spans the very same columns; as [x, y, width, height] in pixels.
+  regions = []
+  above = {}
+
+  for y in range(rows):
+    runs = {}
+    x = 0
+
+    while x < columns:
+      if blocks[y * columns + x]:
+        start = x
+
+        while x < columns and blocks[y * columns + x]:
+          x += 1
+
+        region = above.get((start, x))
+
+        if region:
+          region[3] += block_size
+        else:
+          region = [start * block_size, y * block_size, (x - start) * block_size, block_size]
+          regions.append(region)
+
+        runs[(start, x)] = region
+
+      x += 1
+
+    above = runs
+
+  # The last row and column of blocks may be partial.
+  for region in regions:
+    region[2] = min(region[2], size[0] - region[0])
+    region[3] = min(region[3], size[1] - region[1])
+
+  return regions
+
+def merge_regions(region_lists, size, block_size=REGION_BLOCK_SIZE):
+  columns, rows = math.ceil(size[0] / block_size), math.ceil(size[1] / block_size)
+  blocks = bytearray(columns * rows)
+
+  for regions in region_lists:
+    for x, y, width, height in regions:
+      for row in range(y // block_size, math.ceil((y + height) / block_size)):
+        for column in range(x // block_size, math.ceil((x + width) / block_size)):
+          blocks[row * columns + column] = 1
+
+  return get_block_regions(blocks, columns, rows, block_size, size)
+
+def write_regions(regions_dir, content_hash, base_hash, regions, size, block_size=REGION_BLOCK_SIZE):
+  # One file per page it changed from, since the very same page may come from more than one (e.g.
+  # blank pages, or a page changed back).
+  out_dir = os.path.join(regions_dir, content_hash)
+  out_path = os.path.join(out_dir, f'{base_hash}.json')
+  tmp_path = f'{out_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+
+  record = {
+    'base': base_hash,
+    'width': size[0],
+    'height': size[1],
+    'blockSize': block_size,
+    'regions': regions
+  }
+
+  os.makedirs(out_dir, exist_ok=True)
+
+  with open(tmp_path, 'w') as out_file:
+    out_file.write(json.dumps(record))
+
+  os.replace(tmp_path, out_path)
+
+def record_changed_regions(page_img, content_hash, base_hash, base_path, regions_dir, block_size=REGION_BLOCK_SIZE):
+  from PIL import Image
+
+  with Image.open(base_path) as base_img:
+    base_img.load()
+    regions = find_changed_regions(base_img, page_img, block_size)
+
+  if regions is not None:
+    write_regions(regions_dir, content_hash, base_hash, regions, page_img.size, block_size)
+
+def inherit_regions(regions_dir, content_hash, base_hash, size):
+  # For a page that was re-encoded but looks exactly the same; it changed from whatever its previous
+  # encode changed from (which goes away along with that encode), and not at all from that encode.
+  for record in read_regions(base_hash, regions_dir):
+    write_regions(regions_dir, content_hash, record['base'], record['regions'], size, record['blockSize'])
+
+  write_regions(regions_dir, content_hash, base_hash, [], size)
+
+def read_regions(content_hash, regions_dir=REGIONS_DIR):
+  records = []
+
+  try:
+    with os.scandir(os.path.join(regions_dir, content_hash)) as entries:
+      paths = [entry.path for entry in entries if entry.name.endswith('.json')]
+  except OSError as scan_err:
+    return records
+
+  for path in paths:
+    try:
+      with open(path, 'r') as record_file:
+        records.append(json.loads(record_file.read()))
+    except Exception as read_err:
+      pass
+
+  return records
+
+def get_changed_regions(content_hash, base_hash, regions_dir=REGIONS_DIR):
+  # Follows the recorded changes back from the page to the given base page, through however many
+  # conversions there were in between, and merges them; None if there's no way back.
+  queue = [(content_hash, [])]
+  visited = set([content_hash])
+
+  while queue:
+    current, records = queue.pop(0)
+
+    for record in read_regions(current, regions_dir):
+      if record['base'] == base_hash:
+        records = records + [record]
+        first = records[0]
+
+        # E.g. the block size was changed in between.
+        if any((r['width'], r['height'], r['blockSize']) != (first['width'], first['height'], first['blockSize']) for r in records):
+          return None
+
+        size = (first['width'], first['height'])
+        return merge_regions([r['regions'] for r in records], size, first['blockSize']), size
+
+      if record['base'] not in visited:
+        visited.add(record['base'])
+        queue.append((record['base'], records + [record]))
+
+  return None
+
+# ======== Classes ========
+
+class DeltaCache():
+  def __init__(self, store, path=REGIONS_DIR):
+    super(DeltaCache, self).__init__()
+    self.store = store
+    self.path = path
+
+  def get_path(self, content_hash, base_hash):
+    return os.path.join(self.path, content_hash, f'{base_hash}.delta')
+
+  def get(self, content_hash, base_hash):
+    # Returns the path of the delta from the base page to the page, producing it if need be (or None
+    # if there's no way to); like variants, the caller must have pinned the generation showing the
+    # page.
+    out_path = self.get_path(content_hash, base_hash)
+
+    if os.path.isfile(out_path):
+      return out_path
+
+    # Nothing changed at all if the client already has the page.
+    changed = get_changed_regions(content_hash, base_hash, self.path) if content_hash != base_hash else ([], None)
+
+    if changed is None:
+      return None
+
+    from PIL import Image
+
+    regions = changed[0]
+    patches = []
+
+    with Image.open(self.store.get_path(content_hash)) as page_img:
+      size = page_img.size
+
+      if changed[1] not in (None, size):
+        return None
+
+      for x, y, width, height in regions:
+        patch = io.BytesIO()
+        page_img.crop((x, y, x + width, y + height)).save(patch, 'PNG', optimize=True)
+        data = base64.b64encode(patch.getvalue()).decode('ascii')
+        patches.append({ 'x': x, 'y': y, 'width': width, 'height': height, 'data': f'data:image/png;base64,{data}' })
+
+    delta = {
+      'baseHash': base_hash,
+      'hash': content_hash,
+      'width': size[0],
+      'height': size[1],
+      'patches': patches
+    }
+
+    # Concurrent requests may each produce it; they all come up with the same thing.
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    tmp_path = f'{out_path}.{threading.get_ident()}.tmp'
+
+    with open(tmp_path, 'w') as out_file:
+      out_file.write(json.dumps(delta))
+
+    os.replace(tmp_path, out_path)
+
+    return out_path
@@ -0,0 +1,1002 @@
+import os
+import time
+import json
+import hashlib
+import threading
+import email.utils
+import selectors
+import socket
+import html
+import mimetypes
+import struct
+import secrets
+
+from http import HTTPStatus
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, unquote, parse_qs
+
+from bmsnav.config import (
+  ServerEngine,
+  SERVER_NAME,
+  TILES_DIR,
+  DEFAULT_SERVER_ENGINE,
+  KEEP_ALIVE_TIMEOUT,
+  TILE_ROUTE,
+  BUNDLE_BOARDS,
+  EVENTS_HEARTBEAT_INTERVAL,
+  EVENTS_MAX_BUFFER,
+  PAGE_ROUTE,
+  DELTA_ROUTE,
+  CONTENT_HASH,
+  METRICS_ROUTES,
+  IMAGE_VARIANTS,
+  COLOR_TRANSFORMS,
+  CONTENT_ENCODINGS,
+  MAX_BYTE_RANGES,
+  BYTE_RANGE
+)
+from bmsnav.publishing import is_compressible, get_compressed_paths
+from bmsnav.variants import VariantCache
+from bmsnav.regions import DeltaCache
+from bmsnav.metrics import (
+  REGISTRY,
+  HTTP_REQUESTS_TOTAL,
+  HTTP_RESPONSE_BYTES_TOTAL,
+  HTTP_REQUEST_SECONDS,
+  HTTP_CONNECTIONS,
+  EVENT_CLIENTS
+)
+
+# Serving the current generation over HTTP, plus the event stream that announces new ones.
+#
+# Author: Sean Eidemiller (seidemiller@gmail.com)
+
+# ======== HTTP ========
+
+def get_content_type(name):
+  return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+def is_not_modified(headers, etag, mtime=None):
+  if_none_match = headers.get('If-None-Match')
+
+  if if_none_match:
+    # If-None-Match uses weak comparison and takes precedence over If-Modified-Since.
+    tags = [t.strip() for t in if_none_match.split(',')]
+    return '*' in tags or etag in [t[2:] if t.startswith('W/') else t for t in tags]
+
+  if_modified_since = headers.get('If-Modified-Since')
+
+  if if_modified_since and mtime is not None:
+    try:
+      since = email.utils.parsedate_to_datetime(if_modified_since)
+      return int(mtime) <= since.timestamp()
+    except Exception as date_err:
+      pass
+
+  return False
+
+def get_byte_ranges(header, size):
+  # The satisfiable ranges (start and end, exclusive) in the order asked for; None if the header is
+  # to be ignored altogether (i.e. the whole thing is served).
+  unit, _, spec = header.partition('=')
+
+  if unit.strip().lower() != 'bytes':
+    return None
+
+  ranges = []
+
+  for byte_range in spec.split(','):
+    match = BYTE_RANGE.match(byte_range.strip())
+
+    if not match or not any(match.groups()):
+      return None
+
+    first, last = match.groups()
+
+    if first:
+      start, end = int(first), int(last) + 1 if last else size
+
+      if last and end <= start:
+        return None
+    else:
+      # Suffix range, i.e. the last n bytes.
+      start, end = max(0, size - int(last)), size
+
+    if start < min(end, size):
+      ranges.append((start, min(end, size)))
+
+  return ranges if len(ranges) <= MAX_BYTE_RANGES else None
+
+def is_range_current(headers, etag, last_modified=None):
+  # If-Range only ever matches exactly (i.e. a strong ETag or the very same date); otherwise the
+  # client's partial copy is out of date and it gets the whole thing instead.
+  if_range = (headers.get('If-Range') or '').strip()
+
+  if not if_range:
+    return True
+
+  if if_range.startswith('"'):
+    return if_range == etag
+
+  if if_range.startswith('W/') or not last_modified:
+    return False
+
+  try:
+    return email.utils.parsedate_to_datetime(if_range) == email.utils.parsedate_to_datetime(last_modified)
+  except Exception as date_err:
+    return False
+
+def get_accepted_variant(headers, variants):
+  # Only an explicit image/webp counts (e.g. Android's WebView sends it); wildcards say nothing about
+  # what a client would prefer. Lossy variants have to be asked for by name.
+  for media_range in (headers.get('Accept') or '').split(','):
+    media_type, *params = [p.strip() for p in media_range.split(';')]
+
+    if media_type.lower() != 'image/webp' or 'webp' not in variants:
+      continue
+
+    try:
+      quality = next((float(p[2:]) for p in params if p.lower().startswith('q=')), 1)
+    except ValueError as quality_err:
+      quality = 0
+
+    if quality > 0:
+      return 'webp'
+
+  return None
+
+def get_accepted_encoding(headers, available):
+  # The first of our encodings (best first) that the client accepts with a non-zero q-value, either
+  # by name or by way of *; identity is always acceptable, so there's no need to look at it.
+  qualities = {}
+
+  for coding in (headers.get('Accept-Encoding') or '').split(','):
+    name, *params = [p.strip() for p in coding.split(';')]
+
+    try:
+      qualities[name.lower()] = next((float(p[2:]) for p in params if p.lower().startswith('q=')), 1)
+    except ValueError as quality_err:
+      qualities[name.lower()] = 0
+
+  for encoding in CONTENT_ENCODINGS:
+    if encoding in available and qualities.get(encoding, qualities.get('*', 0)) > 0:
+      return encoding
+
+  return None
+
+def format_event(event, data, event_id=None):
+  message = ''
+
+  if event_id is not None:
+    message += f'id: {event_id}\n'
+
+  message += f'event: {event}\ndata: {json.dumps(data)}\n\n'
+
+  return message.encode('utf-8')
+
+def get_route(path):
+  # A small, fixed set of labels for the metrics, whatever clients ask for.
+  if path in METRICS_ROUTES:
+    return path
+
+  if path.startswith('/tiles/'):
+    return '/tiles'
+
+  if path.startswith('/briefings/'):
+    return '/briefings/'
+
+  if path.startswith('/delta/'):
+    return '/delta'
+
+  if PAGE_ROUTE.match(path):
+    return '/pages'
+
+  return 'other'
+
+def get_page_name(path):
+  # E.g. r04 for the page itself (in whatever format), any of its tiles and its deltas.
+  if PAGE_ROUTE.match(path):
+    return path[1:4]
+
+  match = TILE_ROUTE.match(path) or DELTA_ROUTE.match(path)
+
+  return match.group(1) if match else None
+
+def get_dos_time(timestamp):
+  t = time.localtime(timestamp)
+  dos_time = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+  dos_date = (max(t.tm_year, 1980) - 1980) << 9 | (t.tm_mon << 5) | t.tm_mday
+  return dos_time, dos_date
+
+def get_zip_headers(name, crc, size, mtime, offset):
+  # Stored (uncompressed) entries with the CRC and sizes known up front, so a bundle can be
+  # streamed straight from the published files with an exact Content-Length.
+  name = name.encode('utf-8')
+  dos_time, dos_date = get_dos_time(mtime)
+
+  local = struct.pack('<IHHHHHIIIHH', 0x04034b50, 10, 0, 0, dos_time, dos_date, crc, size, size, len(name), 0) + name
+  central = struct.pack(
+    '<IHHHHHHIIIHHHHHII',
+    0x02014b50, 20, 10, 0, 0, dos_time, dos_date, crc, size, size, len(name), 0, 0, 0, 0, 0, offset
+  ) + name
+
+  return local, central
+
+def get_zip_end(count, central_size, central_offset):
+  return struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, central_size, central_offset, 0)
+
+# ======== Classes ========
+
+class EventBroker():
+  def __init__(self, heartbeat_interval=EVENTS_HEARTBEAT_INTERVAL, max_buffer=EVENTS_MAX_BUFFER):
+    super(EventBroker, self).__init__()
+    self.heartbeat_interval = heartbeat_interval
+    self.max_buffer = max_buffer
+    self.lock = threading.Lock()
+    self.clients = {}
+    self.subscribers = []
+    self.masks = {}
+    self.selector = None
+    self.wake_recv = None
+    self.wake_send = None
+    self.thread = None
+    self.running = False
+
+  def start(self):
+    # One thread multiplexes every connected client, so idle subscribers cost a socket and a
+    # buffer rather than a blocked handler thread each.
+    self.selector = selectors.DefaultSelector()
+    self.wake_recv, self.wake_send = socket.socketpair()
+    self.wake_recv.setblocking(False)
+    self.wake_send.setblocking(False)
+    self.selector.register(self.wake_recv, selectors.EVENT_READ)
+    self.running = True
+    self.thread = threading.Thread(target=self._run, daemon=True)
+    self.thread.start()
+
+  def stop(self):
+    if not self.running:
+      return
+
+    self.running = False
+    self._wake()
+    self.thread.join()
+
+    with self.lock:
+      for sock in list(self.clients):
+        self._drop(sock)
+
+    self.selector.close()
+    self.wake_recv.close()
+    self.wake_send.close()
+
+  def add(self, sock, initial=b''):
+    sock.setblocking(False)
+
+    with self.lock:
+      self.clients[sock] = bytearray(initial)
+
+    self._wake()
+
+  def publish(self, event, data, event_id=None):
+    message = format_event(event, data, event_id)
+    self._broadcast(message)
+
+  def subscribe(self, callback):
+    # For clients that manage their own connection (i.e. the asyncio engine); the callback is
+    # invoked with each message from whichever thread publishes it.
+    with self.lock:
+      self.subscribers.append(callback)
+
+  def unsubscribe(self, callback):
+    with self.lock:
+      if callback in self.subscribers:
+        self.subscribers.remove(callback)
+
+  def get_client_count(self):
+    with self.lock:
+      return len(self.clients) + len(self.subscribers)
+
+  def _broadcast(self, message):
+    with self.lock:
+      for buf in self.clients.values():
+        buf += message
+
+      subscribers = list(self.subscribers)
+
+    for callback in subscribers:
+      callback(message)
+
+    self._wake()
+
+  def _wake(self):
+    try:
+      self.wake_send.send(b'\0')
+    except OSError as wake_err:
+      # Buffer full means a wake-up is already pending.
+      pass
+
+  def _run(self):
+    next_heartbeat = time.monotonic() + self.heartbeat_interval
+
+    while self.running:
+      self._update_registrations()
+
+      timeout = max(0, next_heartbeat - time.monotonic())
+
+      for key, mask in self.selector.select(timeout):
+        if key.fileobj is self.wake_recv:
+          try:
+            while self.wake_recv.recv(1024):
+              pass
+          except OSError as drain_err:
+            pass
+        else:
+          self._service(key.fileobj, mask)
+
+      if time.monotonic() >= next_heartbeat:
+        # Comments keep idle connections (and any NAT/Wi-Fi state in between) alive, and flush
+        # out clients that have gone away without closing.
+        self._broadcast(b': keepalive\n\n')
+        next_heartbeat = time.monotonic() + self.heartbeat_interval
+
+  def _update_registrations(self):
+    with self.lock:
+      for sock, buf in list(self.clients.items()):
+        if len(buf) > self.max_buffer:
+          self._drop(sock)
+          continue
+
+        mask = selectors.EVENT_READ | (selectors.EVENT_WRITE if buf else 0)
+        current_mask = self.masks.get(sock)
+
+        if current_mask is None:
+          self.selector.register(sock, mask)
+        elif current_mask != mask:
+          self.selector.modify(sock, mask)
+
+        self.masks[sock] = mask
+
+  def _service(self, sock, mask):
+    with self.lock:
+      if sock not in self.clients:
+        return
+
+      try:
+        if mask & selectors.EVENT_READ:
+          # Clients never send anything after the request; readable means closed.
+          if not sock.recv(1024):
+            self._drop(sock)
+            return
+
+        if mask & selectors.EVENT_WRITE:
+          buf = self.clients[sock]
+          sent = sock.send(buf)
+          del buf[:sent]
+
+      except (BlockingIOError, InterruptedError) as retry_err:
+        pass
+      except OSError as sock_err:
+        self._drop(sock)
+
+  def _drop(self, sock):
+    self.clients.pop(sock, None)
+
+    if self.masks.pop(sock, None) is not None:
+      self.selector.unregister(sock)
+
+    try:
+      sock.close()
+    except OSError as close_err:
+      pass
+
+class Response():
+  def __init__(self, status, headers=None):
+    super(Response, self).__init__()
+    self.status = status
+    self.headers = headers or []
+    self.parts = []
+    self.events = None
+    self.on_close = []
+
+  @staticmethod
+  def error(status, message=None):
+    response = Response(status, [('Content-Type', 'text/plain; charset=utf-8'), ('Cache-Control', 'no-store')])
+    response.add_bytes((message or HTTPStatus(status).phrase).encode('utf-8'))
+    return response
+
+  def add_header(self, keyword, value):
+    self.headers.append((keyword, value))
+
+  def get_header(self, keyword):
+    return next((v for k, v in self.headers if k.lower() == keyword.lower()), None)
+
+  def remove_header(self, keyword):
+    self.headers = [(k, v) for k, v in self.headers if k.lower() != keyword.lower()]
+
+  def add_bytes(self, data):
+    self.parts.append(data)
+
+  def add_file(self, path, offset=0, length=None):
+    if length is None:
+      length = os.path.getsize(path) - offset
+
+    self.parts.append(FileSegment(path, offset, length))
+
+  def get_length(self):
+    return sum(len(p) for p in self.parts)
+
+  def get_parts(self, start, end):
+    # The parts covering just the given byte range of the body (still from wherever they are).
+    parts = []
+    offset = 0
+
+    for part in self.parts:
+      part_start, part_end = max(start - offset, 0), min(end - offset, len(part))
+
+      if part_start < part_end:
+        if isinstance(part, FileSegment):
+          parts.append(FileSegment(part.path, part.offset + part_start, part_end - part_start))
+        else:
+          parts.append(part[part_start:part_end])
+
+      offset += len(part)
+
+    return parts
+
+  def close(self):
+    for callback in self.on_close:
+      callback()
+
+    self.on_close = []
+
+class FileSegment():
+  def __init__(self, path, offset, length):
+    super(FileSegment, self).__init__()
+    self.path = path
+    self.offset = offset
+    self.length = length
+
+  def __len__(self):
+    return self.length
+
+class Router():
+  def __init__(self, publisher, variants=None, deltas=None, on_page_request=None, on_error=None):
+    super(Router, self).__init__()
+    self.publisher = publisher
+    self.variants = variants
+    self.deltas = deltas
+    # Called (and may block for a moment) before a page or one of its tiles is served.
+    self.on_page_request = on_page_request
+    # Called with anything that went wrong handling a request (which is answered with a 500).
+    self.on_error = on_error
+
+  def handle(self, method, target, headers):
+    start = time.perf_counter()
+    route = 'other'
+    response = None
+
+    try:
+      url = urlsplit(target)
+      path = unquote(url.path)
+      route = get_route(path)
+      response = self._handle(method, path, parse_qs(url.query), headers)
+
+      if method == 'GET' and response.status == HTTPStatus.OK and headers.get('Range'):
+        self._apply_range(response, headers)
+    except Exception as handle_err:
+      # The client still gets an answer (rather than the connection just closing), and anything
+      # pinned for the response is let go of.
+      if response:
+        response.close()
+
+      if self.on_error:
+        self.on_error(handle_err)
+
+      response = Response.error(HTTPStatus.INTERNAL_SERVER_ERROR)
+
+    response.on_close.append(lambda: self._observe(response, method, route, start))
+
+    return response
+
+  def _handle(self, method, path, query, headers):
+    if method not in ('GET', 'HEAD'):
+      return Response.error(HTTPStatus.NOT_IMPLEMENTED)
+
+    if path == '/events':
+      return self._handle_events()
+
+    if path == '/metrics':
+      return self._handle_metrics()
+
+    page = get_page_name(path)
+
+    if page and self.on_page_request:
+      self.on_page_request(page)
+
+    # Pin the current generation until the response has been sent so that it is served as one
+    # consistent set and isn't cleaned up underneath us.
+    generation = self.publisher.acquire()
+
+    try:
+      response = self._handle_generation(generation, path, query, headers)
+    except Exception as route_err:
+      self.publisher.release(generation)
+      raise route_err
+
+    response.add_header('X-BMSNav-Generation', str(generation.id))
+    response.on_close.append(lambda: self.publisher.release(generation))
+
+    return response
+
+  def _handle_generation(self, generation, path, query, headers):
+    if path == '/':
+      return self._handle_index(generation)
+
+    if path == '/manifest.json':
+      return self._handle_bytes(generation.manifest, 'application/json', generation.manifest_hash, headers, generation.manifest_encoded)
+
+    if path == '/bundle.zip':
+      return self._handle_bundle(generation, query, headers)
+
+    if path in ('/briefings', '/briefings/'):
+      # Each briefing is served by the generic route below (e.g. /briefings/<callsign>briefing.html).
+      return self._handle_bytes(generation.briefings, 'application/json', generation.briefings_hash, headers, generation.briefings_encoded)
+
+    tile_match = TILE_ROUTE.match(path)
+
+    if tile_match:
+      return self._handle_tile(generation, *tile_match.groups(), headers)
+
+    delta_match = DELTA_ROUTE.match(path)
+
+    if delta_match and self.deltas:
+      return self._handle_delta(generation, delta_match.group(1), query, headers)
+
+    # Only files the generation knows about are ever served, which also rules out any path tricks.
+    name = path[1:]
+    content_hash = generation.get_hash(name)
+
+    if not content_hash:
+      return Response.error(HTTPStatus.NOT_FOUND, 'File not found')
+
+    if self.variants and PAGE_ROUTE.match(path):
+      return self._handle_page(generation, name, content_hash, query, headers)
+
+    # Text files were compressed when they were published (if that was worth it).
+    compressed = get_compressed_paths(content_hash, self.publisher.compressed_dir) if is_compressible(name) else None
+
+    return self._handle_file(generation.get_path(name), get_content_type(name), f'"{content_hash}"', headers, compressed)
+
+  def _handle_file(self, file_path, content_type, etag, headers, compressed=None):
+    # Compressed copies are whole representations of their own (with their own ETags), so caches
+    # have to keep them apart by Accept-Encoding.
+    encoding = get_accepted_encoding(headers, compressed) if compressed else None
+
+    if encoding:
+      file_path = compressed[encoding]
+      etag = f'{etag[:-1]}-{encoding}"'
+
+    stat = os.stat(file_path)
+
+    if is_not_modified(headers, etag, stat.st_mtime):
+      response = self._get_cache_response(HTTPStatus.NOT_MODIFIED, etag, stat.st_mtime)
+    else:
+      response = self._get_cache_response(HTTPStatus.OK, etag, stat.st_mtime)
+      response.add_header('Content-Type', content_type)
+      response.add_file(file_path, 0, stat.st_size)
+
+    self._add_encoding_headers(response, encoding, compressed)
+
+    return response
+
+  def _handle_page(self, generation, name, content_hash, query, headers):
+    # Pages keep their .png names whatever they're served as; ?format= picks a variant outright,
+    # otherwise the Accept header does (which caches then have to take into account). ?color= picks
+    # a color transform (in whichever format).
+    variants = self.variants.get_variants()
+    variant = query.get('format', [None])[0]
+    colors = query.get('color', [None])[0]
+
+    if variant is None:
+      variant = get_accepted_variant(headers, variants)
+      negotiated = True
+    elif variant == 'png' or variant in variants:
+      negotiated = False
+    else:
+      return Response.error(HTTPStatus.NOT_FOUND, 'Format not available')
+
+    if colors is not None and colors not in COLOR_TRANSFORMS:
+      return Response.error(HTTPStatus.NOT_FOUND, 'Color transform not available')
+
+    variant_path = None
+
+    if colors:
+      variant = variant or 'png'
+
+      try:
+        variant_path = self.variants.get(content_hash, variant, colors)
+      except Exception as variant_err:
+        # Unlike another format, the page itself is no substitute (e.g. a bright white page at night).
+        return Response.error(HTTPStatus.INTERNAL_SERVER_ERROR, 'Unable to transform page')
+    elif variant not in (None, 'png'):
+      try:
+        variant_path = self.variants.get(content_hash, variant)
+      except Exception as variant_err:
+        # The page itself is always better than no page at all.
+        variant_path = None
+
+    if variant_path:
+      content_type = IMAGE_VARIANTS[variant]['contentType'] if variant in IMAGE_VARIANTS else 'image/png'
+      response = self._handle_file(variant_path, content_type, f'"{content_hash}-{os.path.basename(variant_path)}"', headers)
+    else:
+      response = self._handle_file(generation.get_path(name), 'image/png', f'"{content_hash}"', headers)
+
+    if negotiated:
+      response.add_header('Vary', 'Accept')
+
+    return response
+
+  def _handle_bytes(self, body, content_type, content_hash, headers, encoded=None):
+    encoding = get_accepted_encoding(headers, encoded) if encoded else None
+    etag = f'"{content_hash}-{encoding}"' if encoding else f'"{content_hash}"'
+
+    if is_not_modified(headers, etag):
+      response = self._get_cache_response(HTTPStatus.NOT_MODIFIED, etag)
+    else:
+      response = self._get_cache_response(HTTPStatus.OK, etag)
+      response.add_header('Content-Type', content_type)
+      response.add_bytes(encoded[encoding] if encoding else body)
+
+    self._add_encoding_headers(response, encoding, encoded)
+
+    return response
+
+  def _handle_tile(self, generation, page, info, z, x, y, headers):
+    content_hash = generation.get_hash(f'{page}.png')
+
+    if not content_hash:
+      return Response.error(HTTPStatus.NOT_FOUND, 'Page not found')
+
+    if info:
+      tile_path = os.path.join(TILES_DIR, content_hash, 'info.json')
+    else:
+      tile_path = os.path.join(TILES_DIR, content_hash, str(int(z)), f'{int(x)}_{int(y)}.png')
+
+    if not os.path.isfile(tile_path):
+      return Response.error(HTTPStatus.NOT_FOUND, 'Tile not found')
+
+    # Tiles are derived from the page alone, so the page hash plus position identifies one.
+    etag = f'"{content_hash}-' + ('info' if info else f'{int(z)}-{int(x)}-{int(y)}') + '"'
+
+    if is_not_modified(headers, etag):
+      return self._get_cache_response(HTTPStatus.NOT_MODIFIED, etag)
+
+    response = self._get_cache_response(HTTPStatus.OK, etag)
+    response.add_header('Content-Type', 'application/json' if info else 'image/png')
+    response.add_file(tile_path)
+
+    return response
+
+  def _handle_delta(self, generation, page, query, headers):
+    # Just what changed on the page since the generation the client has it from (if that's still
+    # around), or since the version of it the client has (by content hash); anything else is a 404,
+    # upon which the client simply gets the whole page.
+    name = f'{page}.png'
+    content_hash = generation.get_hash(name)
+
+    if not content_hash:
+      return Response.error(HTTPStatus.NOT_FOUND, 'Page not found')
+
+    base_hash = query.get('have', [None])[0]
+
+    if base_hash is None:
+      try:
+        base_generation = self.publisher.get_generation(int(query.get('base', [''])[0]))
+      except ValueError as base_err:
+        return Response.error(HTTPStatus.BAD_REQUEST, 'Invalid base generation')
+
+      base_hash = base_generation.get_hash(name) if base_generation else None
+
+      if not base_hash:
+        return Response.error(HTTPStatus.NOT_FOUND, 'Base generation not available')
+    elif not CONTENT_HASH.match(base_hash):
+      return Response.error(HTTPStatus.BAD_REQUEST, 'Invalid content hash')
+
+    try:
+      delta_path = self.deltas.get(content_hash, base_hash)
+    except Exception as delta_err:
+      delta_path = None
+
+    if not delta_path:
+      return Response.error(HTTPStatus.NOT_FOUND, 'Delta not available')
+
+    return self._handle_file(delta_path, 'application/json', f'"{content_hash}-{base_hash}"', headers)
+
+  def _handle_bundle(self, generation, query, headers):
+    board = query.get('board', ['both'])[0]
+
+    if board not in BUNDLE_BOARDS:
+      return Response.error(HTTPStatus.BAD_REQUEST, 'Invalid board')
+
+    # Pages the client already has (by content hash) are left out of the bundle.
+    have = set(h for value in query.get('have', []) for h in value.split(',') if h)
+    names = [f'{prefix}{page:02d}.png' for prefix in BUNDLE_BOARDS[board] for page in range(1, 17)]
+    entries = [(n, generation.files[n]) for n in names if n in generation.files and generation.get_hash(n) not in have]
+
+    etag = '"' + hashlib.sha256(' '.join(f'{n}:{e["hash"]}' for n, e in entries).encode('utf-8')).hexdigest() + '"'
+
+    if is_not_modified(headers, etag):
+      return self._get_cache_response(HTTPStatus.NOT_MODIFIED, etag)
+
+    response = self._get_cache_response(HTTPStatus.OK, etag)
+    response.add_header('Content-Type', 'application/zip')
+    response.add_header('Content-Disposition', f'attachment; filename="kneeboards-{board}.zip"')
+
+    offset = 0
+    central_headers = []
+
+    for name, entry in entries:
+      local, central = get_zip_headers(name, entry['crc32'], entry['size'], entry['mtime'], offset)
+
+      response.add_bytes(local)
+      response.add_file(generation.get_path(name), 0, entry['size'])
+      central_headers.append(central)
+
+      offset += len(local) + entry['size']
+
+    central_dir = b''.join(central_headers)
+    response.add_bytes(central_dir + get_zip_end(len(central_headers), len(central_dir), offset))
+
+    return response
+
+  def _handle_index(self, generation):
+    links = ''.join(f'<li><a href="{html.escape(n, True)}">{html.escape(n)}</a></li>\n' for n in sorted(generation.files))
+    body = f'<!DOCTYPE HTML>\n<html>\n<head><title>BMSNavServer</title></head>\n<body>\n<ul>\n{links}</ul>\n</body>\n</html>\n'
+
+    response = Response(HTTPStatus.OK, [('Content-Type', 'text/html; charset=utf-8'), ('Cache-Control', 'no-store')])
+    response.add_bytes(body.encode('utf-8'))
+
+    return response
+
+  def _handle_events(self):
+    generation = self.publisher.get_current()
+
+    response = Response(HTTPStatus.OK, [('Content-Type', 'text/event-stream'), ('Cache-Control', 'no-store')])
+    response.events = format_event('hello', { 'generation': generation.id }, generation.id)
+
+    return response
+
+  def _handle_metrics(self):
+    response = Response(HTTPStatus.OK, [('Content-Type', 'text/plain; version=0.0.4; charset=utf-8'), ('Cache-Control', 'no-store')])
+    response.add_bytes(REGISTRY.render())
+
+    return response
+
+  def _apply_range(self, response, headers):
+    # Works on any response that can be revalidated (i.e. has an ETag), whatever its body is made
+    # of, so that interrupted downloads of pages, bundles, etc. can be resumed.
+    etag = response.get_header('ETag')
+
+    if not etag or not is_range_current(headers, etag, response.get_header('Last-Modified')):
+      return
+
+    size = response.get_length()
+    ranges = get_byte_ranges(headers.get('Range'), size)
+
+    if ranges is None:
+      return
+
+    if not ranges:
+      response.status = HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+      response.remove_header('Content-Type')
+      response.add_header('Content-Range', f'bytes */{size}')
+      response.parts = []
+      return
+
+    response.status = HTTPStatus.PARTIAL_CONTENT
+
+    if len(ranges) == 1:
+      start, end = ranges[0]
+      response.add_header('Content-Range', f'bytes {start}-{end - 1}/{size}')
+      response.parts = response.get_parts(start, end)
+      return
+
+    content_type = response.get_header('Content-Type')
+    boundary = secrets.token_hex(16)
+    parts = []
+
+    for start, end in ranges:
+      parts.append(f'\r\n--{boundary}\r\nContent-Type: {content_type}\r\nContent-Range: bytes {start}-{end - 1}/{size}\r\n\r\n'.encode('utf-8'))
+      parts += response.get_parts(start, end)
+
+    parts.append(f'\r\n--{boundary}--\r\n'.encode('utf-8'))
+
+    response.remove_header('Content-Type')
+    response.add_header('Content-Type', f'multipart/byteranges; boundary={boundary}')
+    response.parts = parts
+
+  def _observe(self, response, method, route, start):
+    HTTP_REQUESTS_TOTAL.inc(route, str(int(response.status)))
+
+    # Event streams stay open indefinitely, so only their count means anything.
+    if response.events is None:
+      HTTP_RESPONSE_BYTES_TOTAL.inc(route, amount=0 if method == 'HEAD' else response.get_length())
+      HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, route)
+
+  def _add_encoding_headers(self, response, encoding, available):
+    if encoding:
+      response.add_header('Content-Encoding', encoding)
+
+    if available:
+      response.add_header('Vary', 'Accept-Encoding')
+
+  def _get_cache_response(self, status, etag, mtime=None):
+    # Page names are reused across generations, so clients may cache but must always revalidate
+    # (which is cheap thanks to the ETag).
+    response = Response(status, [('ETag', etag), ('Cache-Control', 'no-cache'), ('Accept-Ranges', 'bytes')])
+
+    if mtime is not None:
+      response.add_header('Last-Modified', email.utils.formatdate(mtime, usegmt=True))
+
+    return response
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+  # Keep-alive connections may sit idle in their handler threads, which must not hold up shutdown.
+  daemon_threads = True
+  block_on_close = False
+
+  def __init__(self, server_address, handler_class, router, events):
+    super(ThreadingServer, self).__init__(server_address, handler_class)
+    self.router = router
+    self.events = events
+    self.detached = set()
+
+  def detach(self, request):
+    # The request's socket has been handed off (e.g. to the event broker), so it must outlive the
+    # handler thread.
+    self.detached.add(request)
+
+  def shutdown_request(self, request):
+    if request in self.detached:
+      self.detached.discard(request)
+    else:
+      super(ThreadingServer, self).shutdown_request(request)
+
+class HTTPHandler(BaseHTTPRequestHandler):
+  server_version = SERVER_NAME
+  protocol_version = 'HTTP/1.1'
+  timeout = KEEP_ALIVE_TIMEOUT
+
+  def __init__(self, *args, **kwargs):
+    try:
+      super().__init__(*args, **kwargs)
+    except Exception as handler_err:
+      # These are mostly (always?) due to connections being forcibly closed by the app; no big
+      # deal and safe to ignore.
+      # sys.stderr.write('Handler error: ' + str(handler_err) + '\n')
+      pass
+
+  def do_GET(self):
+    self._handle()
+
+  def do_HEAD(self):
+    self._handle()
+
+  def setup(self):
+    super().setup()
+    HTTP_CONNECTIONS.inc()
+
+  def finish(self):
+    try:
+      super().finish()
+    finally:
+      HTTP_CONNECTIONS.dec()
+
+  def log_message(self, format, *args):
+    pass
+
+  def _handle(self):
+    response = self.server.router.handle(self.command, self.path, self.headers)
+
+    try:
+      self.send_response(response.status)
+
+      for keyword, value in response.headers:
+        self.send_header(keyword, value)
+
+      if response.events:
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.flush()
+
+        # Hand the connection over to the broker; this handler thread is done with it.
+        self.close_connection = True
+        self.server.detach(self.request)
+        self.server.events.add(self.request, response.events)
+        return
+
+      # A 304 has no body, and its Content-Length would be taken for that of the cached response.
+      if response.status != HTTPStatus.NOT_MODIFIED:
+        self.send_header('Content-Length', str(response.get_length()))
+
+      self.end_headers()
+
+      if self.command == 'HEAD':
+        return
+
+      for part in response.parts:
+        if isinstance(part, FileSegment):
+          self.wfile.flush()
+
+          with open(part.path, 'rb') as f:
+            self.connection.sendfile(f, part.offset, part.length)
+        else:
+          self.wfile.write(part)
+    finally:
+      response.close()
+
+class Server():
+  def __init__(self, port, publisher, engine=DEFAULT_SERVER_ENGINE, on_started=None, on_error=None, on_page_request=None, on_request_error=None):
+    super(Server, self).__init__()
+    self.port = port
+    self.publisher = publisher
+    self.engine = engine
+    self.on_started = on_started
+    self.on_error = on_error
+    self.router = Router(publisher, VariantCache(publisher.store), DeltaCache(publisher.store), on_page_request, on_request_error)
+    self.events = EventBroker()
+    self.thread = None
+    EVENT_CLIENTS.function = self.events.get_client_count
+    self._server = None
+    self.publisher.add_listener(self._on_publish)
+
+  def start(self):
+    # Bound right away (rather than on the serving thread) so that the port is taken, or the error
+    # reported, by the time this returns.
+    try:
+      self.events.start()
+
+      if self.engine == ServerEngine.ASYNCIO:
+        # Only pulled in when configured; asyncio alone is a noticeable share of startup time.
+        from bmsnav.asyncserver import AsyncHTTPServer
+        self._server = AsyncHTTPServer(('', self.port), self.router, self.events)
+      else:
+        self._server = ThreadingServer(('', self.port), HTTPHandler, self.router, self.events)
+    except Exception as err:
+      self.events.stop()
+
+      if self.on_error:
+        self.on_error(err)
+
+      return False
+
+    if self.on_started:
+      self.on_started()
+
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+    return True
+
+  def run(self):
+    try:
+      with self._server:
+        self._server.serve_forever()
+    except Exception as err:
+      if self.on_error:
+        self.on_error(err)
+    finally:
+      self.events.stop()
+
+  def stop(self):
+    if self._server:
+      self._server.shutdown()
+      self._server.server_close()
+
+    if self.thread:
+      self.thread.join()
+
+  def _on_publish(self, generation, changed):
+    self.events.publish('generation', { 'generation': generation.id, 'changed': changed }, generation.id)
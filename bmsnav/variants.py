@@ -0,0 +1,137 @@
+import os
+import threading
+import time
+
+from bmsnav.config import VARIANTS_DIR, IMAGE_VARIANTS, COLOR_TRANSFORMS
+from bmsnav.metrics import VARIANT_ENCODE_SECONDS
+
+# Alternative encodings (WebP, JPEG) of the published pages, for clients that would rather trade
+# exactness or CPU for size, and color transformed (e.g. night) versions of them. They're produced
+# the first time anyone asks for them and stored next to the blob store (as a derived directory), so
+# they go along with the page they came from.
+#
+# Author: Sean Eidemiller (seidemiller@gmail.com)
+
+# ======== Variants ========
+
+def write_variant(in_path, out_path, variant, colors=None):
+  from PIL import Image
+
+  with Image.open(in_path) as img:
+    if colors:
+      img = transform_colors(img, COLOR_TRANSFORMS[colors])
+
+    # The page itself is served as is, so this is only ever a transformed one.
+    if variant == 'png':
+      img.save(out_path, 'PNG')
+      return
+
+    settings = IMAGE_VARIANTS[variant]
+
+    # Optimized pages may be palette images; JPEG has no alpha at all (pages are opaque anyway).
+    if settings['format'] == 'JPEG':
+      img = img.convert('RGB')
+    elif img.mode not in ('RGB', 'RGBA'):
+      img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+
+    img.save(out_path, settings['format'], **settings['options'])
+
+def transform_colors(img, settings):
+  from PIL import Image
+
+  if img.mode == 'P':
+    # Only the palette needs transforming (which also keeps the page as small as it was).
+    palette = img.getpalette('RGB')
+    colors = transform_rgb(Image.frombytes('RGB', (len(palette) // 3, 1), bytes(palette)), settings)
+    img = img.copy()
+    img.putpalette(colors.tobytes(), 'RGB')
+    return img
+
+  if img.mode == 'RGBA':
+    rgb = transform_rgb(img.convert('RGB'), settings)
+    rgb.putalpha(img.getchannel('A'))
+    return rgb
+
+  return transform_rgb(img.convert('RGB'), settings)
+
+def transform_rgb(img, settings):
+  # A lookup table per band, so each pixel is transformed in one pass (in C).
+  from PIL import Image, ImageOps
+
+  tint = settings.get('tint', [255, 255, 255])
+  brightness = settings.get('brightness', 1)
+  tables = []
+
+  for band in range(3):
+    scale = tint[band] / 255 * brightness
+    tables.append([round((255 - v if settings.get('invert') else v) * scale) for v in range(256)])
+
+  if settings.get('grayscale'):
+    gray = ImageOps.grayscale(img)
+    return Image.merge('RGB', [gray.point(table) for table in tables])
+
+  return img.point(tables[0] + tables[1] + tables[2])
+
+# ======== Classes ========
+
+class VariantCache():
+  def __init__(self, store, path=VARIANTS_DIR):
+    super(VariantCache, self).__init__()
+    self.store = store
+    self.path = path
+    self.lock = threading.Lock()
+    # One lock per variant being produced, so that concurrent requests for it only encode it once.
+    self.pending = {}
+    self.variants = None
+
+  def get_variants(self):
+    # Whatever this build of Pillow can actually encode (checked once, on first use).
+    if self.variants is None:
+      from PIL import features
+
+      codecs = { 'WEBP': features.check('webp'), 'JPEG': features.check('jpg') }
+      self.variants = [v for v, settings in IMAGE_VARIANTS.items() if codecs.get(settings['format'])]
+
+    return self.variants
+
+  def get_path(self, content_hash, variant, colors=None):
+    return os.path.join(self.path, content_hash, f'{colors}-{variant}' if colors else variant)
+
+  def get(self, content_hash, variant, colors=None):
+    # Returns the path of the variant, producing it if need be; the caller must have pinned the
+    # generation showing the page, so that the page can't be removed in the meantime.
+    out_path = self.get_path(content_hash, variant, colors)
+
+    if os.path.isfile(out_path):
+      return out_path
+
+    key = (content_hash, variant, colors)
+
+    with self.lock:
+      entry = self.pending.setdefault(key, [threading.Lock(), 0])
+      entry[1] += 1
+
+    try:
+      with entry[0]:
+        if not os.path.isfile(out_path):
+          start = time.perf_counter()
+          tmp_path = f'{out_path}.{threading.get_ident()}.tmp'
+
+          os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+          try:
+            write_variant(self.store.get_path(content_hash), tmp_path, variant, colors)
+            os.replace(tmp_path, out_path)
+          finally:
+            if os.path.exists(tmp_path):
+              os.remove(tmp_path)
+
+          VARIANT_ENCODE_SECONDS.observe(time.perf_counter() - start, os.path.basename(out_path))
+    finally:
+      with self.lock:
+        entry[1] -= 1
+
+        if not entry[1]:
+          del self.pending[key]
+
+    return out_path
@@ -0,0 +1,67 @@
+import os
+import io
+import random
+import shutil
+import tempfile
+import unittest
+
+from bmsnav.config import SERVER_ROOT
+
+# Shared by the tests: a scratch working directory (everything the server writes is relative to it),
+# small synthetic kneeboard DDS files, and publishing files as they are.
+#
+# Author: Sean Eidemiller (seidemiller@gmail.com)
+
+PAGE_WIDTH = 32
+PAGE_HEIGHT = 32
+
+def get_test_image(seed, size=(PAGE_WIDTH * 2, PAGE_HEIGHT), mode='RGBA'):
+  # Noise, so that every block (and every pixel of it) differs.
+  from PIL import Image
+
+  rng = random.Random(seed)
+  data = bytes(rng.randrange(256) for i in range(size[0] * size[1] * len(mode)))
+
+  return Image.frombytes(mode, size, data)
+
+def get_dds_data(img, pixel_format=None):
+  # None is uncompressed (BGRA, or BGR for an RGB image).
+  buf = io.BytesIO()
+
+  if pixel_format:
+    img.save(buf, 'DDS', pixel_format=pixel_format)
+  else:
+    img.save(buf, 'DDS')
+
+  return buf.getvalue()
+
+def write_dds(path, seed, pixel_format='DXT1'):
+  with open(path, 'wb') as dds_file:
+    dds_file.write(get_dds_data(get_test_image(seed), pixel_format))
+
+def publish(publisher, files, replace=False, **attrs):
+  # Files by name and content (bytes), or None to remove one; anything else stays as it is.
+  staging = publisher.begin()
+
+  for name, value in attrs.items():
+    setattr(staging, name, value)
+
+  for name, content in files.items():
+    if content is None:
+      staging.remove_file(name)
+    else:
+      with open(staging.get_staging_path(name), 'wb') as staged_file:
+        staged_file.write(content)
+
+  return publisher.commit(staging, replace)
+
+class WorkDirTestCase(unittest.TestCase):
+  def setUp(self):
+    self.cwd = os.getcwd()
+    self.work_dir = tempfile.mkdtemp()
+    os.chdir(self.work_dir)
+    os.makedirs(SERVER_ROOT)
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    shutil.rmtree(self.work_dir, ignore_errors=True)
@@ -0,0 +1,132 @@
+import os
+import unittest
+import concurrent.futures
+
+from bmsnav.config import THEATERS_DIR, get_dds_files
+from bmsnav.conversion import ConversionCache, DDSConverter, PageScheduler, convert_dds
+from bmsnav.publishing import BlobStore, Publisher
+from tests.support import WorkDirTestCase, write_dds
+
+# Converting batches of DDS files into the conversion cache and publishing them.
+#
+# Author: Sean Eidemiller (seidemiller@gmail.com)
+
+BATCH_SIZE = 4
+
+class DDSConverterTest(WorkDirTestCase):
+  def setUp(self):
+    super(DDSConverterTest, self).setUp()
+    self.dds_dir = 'dds'
+    self.dds_files = get_dds_files(self.dds_dir)[:BATCH_SIZE]
+    self.store = BlobStore()
+    self.publisher = Publisher(self.store)
+    self.cache = ConversionCache(os.path.join(THEATERS_DIR, 'korea'), self.store)
+
+    os.makedirs(self.dds_dir)
+
+    for index, dds_file in enumerate(self.dds_files):
+      write_dds(dds_file, index)
+
+  def convert(self, pool=None):
+    converter = DDSConverter(self.dds_dir, self.publisher, self.cache, self.dds_files, pool, 'Korea')
+    converter.run()
+
+    return converter
+
+  def get_published_pages(self):
+    return sorted(self.publisher.get_current().get_page_hashes())
+
+  def test_publishes_batch(self):
+    converter = self.convert()
+
+    self.assertEqual(sorted(converter.converted), ['01', '02', '03', '04'])
+    self.assertEqual(converter.errors, {})
+    self.assertTrue(converter.published)
+    self.assertEqual(self.get_published_pages(), [f'{side}{page:02d}.png' for side in 'lr' for page in range(1, 5)])
+    self.assertEqual(self.publisher.get_current().theater, 'Korea')
+
+  def test_skips_unchanged_files(self):
+    self.convert()
+    current = self.publisher.get_current()
+    converter = self.convert()
+
+    self.assertEqual(converter.converted, {})
+    self.assertEqual(converter.skipped, BATCH_SIZE)
+    self.assertFalse(converter.published)
+    self.assertIs(self.publisher.get_current(), current)
+
+  def test_publishes_rest_of_batch_despite_bad_file(self):
+    self.check_bad_file(None)
+
+  def test_publishes_rest_of_batch_despite_bad_file_in_pool(self):
+    with concurrent.futures.ThreadPoolExecutor(2) as pool:
+      self.check_bad_file(pool)
+
+  def test_leaves_out_missing_files(self):
+    self.convert()
+    os.remove(self.dds_files[2])
+    converter = self.convert()
+
+    self.assertEqual(converter.errors, {})
+    self.assertTrue(converter.published)
+    self.assertEqual(self.get_published_pages(), ['l01.png', 'l02.png', 'l04.png', 'r01.png', 'r02.png', 'r04.png'])
+
+  def check_bad_file(self, pool):
+    with open(self.dds_files[1], 'wb') as dds_file:
+      dds_file.write(b'DDS not really')
+
+    converter = self.convert(pool)
+
+    self.assertEqual(list(converter.errors), [self.dds_files[1]])
+    self.assertEqual(sorted(converter.converted), ['01', '03', '04'])
+    self.assertTrue(converter.published)
+    self.assertEqual(self.get_published_pages(), ['l01.png', 'l03.png', 'l04.png', 'r01.png', 'r03.png', 'r04.png'])
+
+class ConvertDDSTest(WorkDirTestCase):
+  def test_times_stages_that_ran(self):
+    write_dds('7982.dds', 0)
+    page, digest, timings, outputs = convert_dds('7982.dds', '.')
+
+    self.assertEqual(page, '01')
+    self.assertEqual(sorted(timings), ['decode', 'encode'])
+    self.assertEqual([os.path.basename(output[0]) for output in outputs], ['l01.png', 'r01.png'])
+
+    page, digest, timings, outputs = convert_dds('7982.dds', '.', None, 'tiles')
+
+    self.assertEqual(sorted(timings), ['decode', 'encode', 'tiles'])
+
+class PageSchedulerTest(unittest.TestCase):
+  def test_remove(self):
+    scheduler = PageScheduler()
+    scheduler.add(['01', '02'])
+    scheduler.remove(['01'])
+
+    self.assertFalse(scheduler.is_stale('01'))
+    self.assertTrue(scheduler.is_stale('02'))
+
+  def test_remove_keeps_pages_marked_again(self):
+    scheduler = PageScheduler()
+    scheduler.add(['01', '02'])
+    marks = scheduler.get_marks(['01', '02'])
+
+    # E.g. edited again while the first batch was converting it.
+    scheduler.add(['01'])
+    scheduler.remove(['01', '02'], marks)
+
+    self.assertTrue(scheduler.is_stale('01'))
+    self.assertFalse(scheduler.is_stale('02'))
+
+  def test_wait(self):
+    scheduler = PageScheduler()
+    scheduler.add(['01'])
+
+    self.assertFalse(scheduler.wait('01', 0.01))
+    self.assertTrue(scheduler.is_waited_for('01'))
+
+    scheduler.remove(['01'])
+
+    self.assertTrue(scheduler.wait('01', 0.01))
+    self.assertFalse(scheduler.is_waited_for('01'))
+
+if __name__ == '__main__':
+  unittest.main()
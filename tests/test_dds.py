@@ -0,0 +1,53 @@
+import io
+import unittest
+
+from bmsnav.dds import open_dds, BlockDecoder, RGBDecoder
+from tests.support import PAGE_WIDTH, PAGE_HEIGHT, get_test_image, get_dds_data
+
+# Decoding kneeboard pages straight from DDS data, compared against what Pillow makes of the file.
+#
+# Author: Sean Eidemiller (seidemiller@gmail.com)
+
+class OpenDDSTest(unittest.TestCase):
+  def check_pages(self, data, decoder_class):
+    from PIL import Image
+
+    decoder = open_dds(data)
+    self.assertIsInstance(decoder, decoder_class)
+
+    with Image.open(io.BytesIO(data)) as img:
+      img.load()
+
+      for index in (0, 1):
+        page_img = decoder.get_page(index)
+        expected = img.crop((index * PAGE_WIDTH, 0, (index + 1) * PAGE_WIDTH, PAGE_HEIGHT))
+
+        self.assertEqual(page_img.size, (PAGE_WIDTH, PAGE_HEIGHT))
+        self.assertEqual(page_img.mode, expected.mode)
+        self.assertEqual(page_img.tobytes(), expected.tobytes())
+
+  def test_dxt1(self):
+    self.check_pages(get_dds_data(get_test_image(1), 'DXT1'), BlockDecoder)
+
+  def test_dxt3(self):
+    self.check_pages(get_dds_data(get_test_image(3), 'DXT3'), BlockDecoder)
+
+  def test_dxt5(self):
+    self.check_pages(get_dds_data(get_test_image(5), 'DXT5'), BlockDecoder)
+
+  def test_bgra(self):
+    self.check_pages(get_dds_data(get_test_image(32)), RGBDecoder)
+
+  def test_bgr(self):
+    self.check_pages(get_dds_data(get_test_image(24, mode='RGB')), RGBDecoder)
+
+  def test_left_to_pillow(self):
+    # Not a DDS file, truncated (e.g. still being written), or pages that aren't whole blocks wide.
+    data = get_dds_data(get_test_image(1), 'DXT1')
+
+    self.assertIsNone(open_dds(b'PNG'))
+    self.assertIsNone(open_dds(data[:len(data) - 1]))
+    self.assertIsNone(open_dds(get_dds_data(get_test_image(1, (PAGE_WIDTH * 2 - 4, PAGE_HEIGHT)), 'DXT1')))
+
+if __name__ == '__main__':
+  unittest.main()
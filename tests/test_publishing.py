@@ -0,0 +1,187 @@
+import os
+import json
+import unittest
+
+from bmsnav.config import SERVER_ROOT
+from bmsnav.publishing import BlobStore, Publisher
+from tests.support import WorkDirTestCase, publish
+
+# Publishing generations by content: storing, rolling back and collecting what's no longer needed.
+#
+# Author: Sean Eidemiller (seidemiller@gmail.com)
+
+def read_file(generation, name):
+  with open(generation.get_path(name), 'rb') as f:
+    return f.read()
+
+class PublisherTest(WorkDirTestCase):
+  def setUp(self):
+    super(PublisherTest, self).setUp()
+    self.store = BlobStore()
+    self.publisher = Publisher(self.store, history=3)
+
+  def test_commit_stores_by_content(self):
+    generation = publish(self.publisher, { 'l01.png': b'same', 'r01.png': b'same', 'briefing.html': b'<p>1</p>' })
+
+    self.assertIs(self.publisher.get_current(), generation)
+    self.assertEqual(generation.get_hash('l01.png'), generation.get_hash('r01.png'))
+    self.assertEqual(read_file(generation, 'briefing.html'), b'<p>1</p>')
+    self.assertEqual(generation.files['l01.png']['size'], 4)
+    self.assertEqual(len(os.listdir(self.store.path)), 2)
+
+    manifest = json.loads(generation.manifest)
+    self.assertEqual(manifest['generation'], generation.id)
+    self.assertEqual([p['name'] for p in manifest['pages']['left']], ['l01.png'])
+    self.assertEqual(manifest['briefing']['name'], 'briefing.html')
+
+  def test_commit_keeps_unchanged_files(self):
+    first = publish(self.publisher, { 'l01.png': b'1', 'l02.png': b'2' })
+    second = publish(self.publisher, { 'l02.png': b'2 again' })
+
+    self.assertEqual(second.get_hash('l01.png'), first.get_hash('l01.png'))
+    self.assertEqual(second.id, first.id + 1)
+    self.assertEqual(read_file(second, 'l02.png'), b'2 again')
+
+  def test_rollback_restores_previous_pages(self):
+    publish(self.publisher, { 'l01.png': b'1', 'briefing.html': b'a' })
+    publish(self.publisher, { 'l01.png': b'2' })
+    publish(self.publisher, { 'briefing.html': b'b' })
+
+    # Back to the pages from before the last kneeboard change; the briefing stays as it is.
+    rolled_back = self.publisher.rollback()
+
+    self.assertEqual(read_file(rolled_back, 'l01.png'), b'1')
+    self.assertEqual(read_file(rolled_back, 'briefing.html'), b'b')
+
+    # Rolling back again undoes it.
+    rolled_back = self.publisher.rollback()
+
+    self.assertEqual(read_file(rolled_back, 'l01.png'), b'2')
+    self.assertEqual(read_file(rolled_back, 'briefing.html'), b'b')
+
+  def test_rollback_removes_pages_added_since(self):
+    publish(self.publisher, { 'l01.png': b'1' }, theater='Korea')
+    publish(self.publisher, { 'l02.png': b'2' }, theater='Balkans')
+
+    rolled_back = self.publisher.rollback()
+
+    self.assertEqual(sorted(rolled_back.get_page_hashes()), ['l01.png'])
+    self.assertEqual(rolled_back.theater, 'Korea')
+
+  def test_rollback_without_previous_pages(self):
+    publish(self.publisher, { 'briefing.html': b'a' })
+    publish(self.publisher, { 'briefing.html': b'b' })
+
+    self.assertIsNone(self.publisher.rollback())
+
+  def test_collects_generations_beyond_history(self):
+    first = publish(self.publisher, { 'l01.png': b'1' })
+    first_hash = first.get_hash('l01.png')
+
+    for content in (b'2', b'3'):
+      publish(self.publisher, { 'l01.png': content })
+
+    self.assertTrue(self.store.exists(first_hash))
+
+    publish(self.publisher, { 'l01.png': b'4' })
+
+    self.assertFalse(self.store.exists(first_hash))
+    self.assertIsNone(self.publisher.get_generation(first.id))
+
+  def test_keeps_acquired_generation(self):
+    first = publish(self.publisher, { 'l01.png': b'1' })
+    first_hash = first.get_hash('l01.png')
+    acquired = self.publisher.acquire()
+
+    for content in (b'2', b'3', b'4', b'5'):
+      publish(self.publisher, { 'l01.png': content })
+
+    # Still being served.
+    self.assertIs(self.publisher.get_generation(first.id), acquired)
+    self.assertTrue(self.store.exists(first_hash))
+
+    self.publisher.release(acquired)
+
+    self.assertIsNone(self.publisher.get_generation(first.id))
+    self.assertFalse(self.store.exists(first_hash))
+
+  def test_keeps_content_still_referenced(self):
+    first = publish(self.publisher, { 'l01.png': b'1', 'l02.png': b'kept' })
+
+    for content in (b'2', b'3', b'4'):
+      publish(self.publisher, { 'l01.png': content })
+
+    self.assertFalse(self.store.exists(first.get_hash('l01.png')))
+    self.assertTrue(self.store.exists(first.get_hash('l02.png')))
+
+  def test_partial_generations_stay_out_of_history(self):
+    publish(self.publisher, { 'l01.png': b'1', 'l02.png': b'1' })
+    publish(self.publisher, { 'l01.png': b'2' }, partial=True)
+    publish(self.publisher, { 'briefing.html': b'a' })
+    publish(self.publisher, { 'l02.png': b'2' }, partial=False)
+
+    # The pages published ahead of the rest of their batch (and the briefing published meanwhile)
+    # don't count as sets of their own.
+    self.assertEqual(len(self.publisher.retained), 3)
+
+    rolled_back = self.publisher.rollback()
+
+    self.assertEqual(read_file(rolled_back, 'l01.png'), b'1')
+    self.assertEqual(read_file(rolled_back, 'l02.png'), b'1')
+    self.assertEqual(read_file(rolled_back, 'briefing.html'), b'a')
+
+  def test_replacement_takes_generations_place(self):
+    publish(self.publisher, { 'l01.png': b'1' })
+    second = publish(self.publisher, { 'l01.png': b'2' })
+    replacement = publish(self.publisher, { 'l01.png': b'2 optimized' }, replace=True)
+
+    self.assertEqual(self.publisher.retained[-2:], [second.id - 1, replacement.id])
+    self.assertEqual(read_file(self.publisher.rollback(), 'l01.png'), b'1')
+
+    for content in (b'3', b'4', b'5'):
+      publish(self.publisher, { 'l01.png': content })
+
+    # Nothing left to follow once the replacement is gone too.
+    self.assertIsNone(self.publisher.get_generation(replacement.id))
+    self.assertIsNone(self.publisher.get_generation(second.id))
+    self.assertEqual(self.publisher.replaced, {})
+
+  def test_replaced_generation_followed(self):
+    # A client that got its pages from the replaced generation still gets to what replaced them.
+    second = publish(self.publisher, { 'l01.png': b'2' })
+    replacement = publish(self.publisher, { 'l01.png': b'2 optimized' }, replace=True)
+
+    self.assertIs(self.publisher.get_generation(second.id), replacement)
+    self.assertIs(self.publisher.get_generation(replacement.id), replacement)
+
+  def test_partial_generation_not_followed(self):
+    partial = publish(self.publisher, { 'l01.png': b'1' }, partial=True)
+    publish(self.publisher, { 'l02.png': b'2' }, partial=False)
+
+    self.assertIsNone(self.publisher.get_generation(partial.id))
+
+  def test_restores_state(self):
+    publish(self.publisher, { 'l01.png': b'1' })
+    current = publish(self.publisher, { 'l01.png': b'2' }, theater='Korea')
+
+    publisher = Publisher(BlobStore(), history=3)
+    restored = publisher.get_current()
+
+    self.assertEqual(restored.id, current.id)
+    self.assertEqual(restored.theater, 'Korea')
+    self.assertEqual(read_file(restored, 'l01.png'), b'2')
+    self.assertEqual(read_file(publisher.rollback(), 'l01.png'), b'1')
+
+  def test_removes_legacy_pages(self):
+    legacy_paths = [os.path.join(SERVER_ROOT, name) for name in ('l01.png', 'briefing.html', 'cache.json')]
+
+    for path in legacy_paths:
+      with open(path, 'wb') as legacy_file:
+        legacy_file.write(b'old')
+
+    Publisher(self.store)
+
+    self.assertFalse(any(os.path.exists(path) for path in legacy_paths))
+
+if __name__ == '__main__':
+  unittest.main()
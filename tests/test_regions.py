@@ -0,0 +1,167 @@
+import io
+import os
+import json
+import base64
+import unittest
+
+from bmsnav.config import REGIONS_DIR
+from bmsnav.publishing import BlobStore, hash_file
+from bmsnav.regions import (
+  DeltaCache,
+  find_changed_regions,
+  merge_regions,
+  get_changed_regions,
+  record_changed_regions,
+  inherit_regions
+)
+from tests.support import WorkDirTestCase, get_test_image
+
+# Finding what changed on a page from one conversion to the next, and the deltas served from that.
+#
+# Author: Sean Eidemiller (seidemiller@gmail.com)
+
+PAGE_SIZE = (100, 70)
+BLOCK_SIZE = 32
+
+def apply_delta(base_img, delta):
+  # What a client does with a delta: draw each patch over its copy of the page.
+  from PIL import Image
+
+  page_img = base_img.copy()
+
+  for patch in delta['patches']:
+    data = base64.b64decode(patch['data'].partition(',')[2])
+
+    with Image.open(io.BytesIO(data)) as patch_img:
+      page_img.paste(patch_img.convert(page_img.mode), (patch['x'], patch['y']))
+
+  return page_img
+
+def change_pixel(img, xy):
+  changed = img.copy()
+  changed.putpixel(xy, tuple(255 - v for v in img.getpixel(xy)))
+
+  return changed
+
+class FindChangedRegionsTest(unittest.TestCase):
+  def test_unchanged(self):
+    img = get_test_image(1, PAGE_SIZE)
+
+    self.assertEqual(find_changed_regions(img, img.copy(), BLOCK_SIZE), [])
+
+  def test_single_pixel(self):
+    img = get_test_image(1, PAGE_SIZE)
+
+    self.assertEqual(find_changed_regions(img, change_pixel(img, (40, 5)), BLOCK_SIZE), [[32, 0, 32, 32]])
+
+  def test_partial_blocks(self):
+    # The last row and column of blocks are cut off at the page's edges.
+    img = get_test_image(1, PAGE_SIZE)
+
+    self.assertEqual(find_changed_regions(img, change_pixel(img, (99, 69)), BLOCK_SIZE), [[96, 64, 4, 6]])
+
+  def test_adjacent_blocks_merged(self):
+    img = get_test_image(1, PAGE_SIZE)
+    changed = change_pixel(change_pixel(img, (0, 0)), (40, 40))
+    changed = change_pixel(change_pixel(changed, (40, 0)), (0, 40))
+
+    self.assertEqual(find_changed_regions(img, changed, BLOCK_SIZE), [[0, 0, 64, 64]])
+
+  def test_resized(self):
+    self.assertIsNone(find_changed_regions(get_test_image(1, PAGE_SIZE), get_test_image(1, (70, 100)), BLOCK_SIZE))
+
+  def test_merge_regions(self):
+    merged = merge_regions([[[0, 0, 32, 32]], [[32, 0, 32, 32], [0, 64, 10, 6]]], PAGE_SIZE, BLOCK_SIZE)
+
+    self.assertEqual(merged, [[0, 0, 64, 32], [0, 64, 32, 6]])
+
+class DeltaCacheTest(WorkDirTestCase):
+  def setUp(self):
+    super(DeltaCacheTest, self).setUp()
+    self.store = BlobStore()
+    self.deltas = DeltaCache(self.store)
+    self.images = {}
+
+  def add_page(self, img, base_hash=None):
+    # Stores the page, recording what changed from the given page (as converting does).
+    path = 'page.png'
+    img.save(path, 'PNG')
+    content_hash, crc = hash_file(path)
+    self.store.add(path, content_hash, crc)
+    self.images[content_hash] = img
+
+    if base_hash:
+      record_changed_regions(img, content_hash, base_hash, self.store.get_path(base_hash), REGIONS_DIR)
+
+    return content_hash
+
+  def get_delta(self, content_hash, base_hash):
+    delta_path = self.deltas.get(content_hash, base_hash)
+
+    if not delta_path:
+      return None
+
+    with open(delta_path, 'r') as delta_file:
+      return json.loads(delta_file.read())
+
+  def test_delta(self):
+    first = get_test_image(1, PAGE_SIZE)
+    first_hash = self.add_page(first)
+    second = change_pixel(first, (50, 50))
+    second_hash = self.add_page(second, first_hash)
+
+    delta = self.get_delta(second_hash, first_hash)
+
+    self.assertEqual((delta['baseHash'], delta['hash']), (first_hash, second_hash))
+    self.assertEqual((delta['width'], delta['height']), PAGE_SIZE)
+    self.assertEqual(len(delta['patches']), 1)
+    self.assertEqual(apply_delta(first, delta).tobytes(), second.tobytes())
+
+  def test_delta_across_conversions(self):
+    first = get_test_image(1, PAGE_SIZE)
+    first_hash = self.add_page(first)
+    second = change_pixel(first, (5, 5))
+    second_hash = self.add_page(second, first_hash)
+    third = change_pixel(second, (90, 60))
+    third_hash = self.add_page(third, second_hash)
+
+    delta = self.get_delta(third_hash, first_hash)
+
+    self.assertEqual(len(delta['patches']), 2)
+    self.assertEqual(apply_delta(first, delta).tobytes(), third.tobytes())
+    self.assertEqual(get_changed_regions(third_hash, first_hash)[0], [[0, 0, 32, 32], [64, 32, 32, 32]])
+
+  def test_delta_across_reencode(self):
+    # The same page encoded again (e.g. optimized in the background) changed from whatever the
+    # previous encode changed from, and not at all from that encode.
+    first = get_test_image(1, PAGE_SIZE)
+    first_hash = self.add_page(first)
+    second = change_pixel(first, (5, 5))
+    second_hash = self.add_page(second, first_hash)
+
+    second.save('page.png', 'PNG', compress_level=0)
+    reencoded_hash, crc = hash_file('page.png')
+    self.store.add('page.png', reencoded_hash, crc)
+    inherit_regions(REGIONS_DIR, reencoded_hash, second_hash, PAGE_SIZE)
+
+    self.assertEqual(self.get_delta(reencoded_hash, second_hash)['patches'], [])
+    self.assertEqual(apply_delta(first, self.get_delta(reencoded_hash, first_hash)).tobytes(), second.tobytes())
+
+  def test_no_delta(self):
+    first_hash = self.add_page(get_test_image(1, PAGE_SIZE))
+    second_hash = self.add_page(get_test_image(2, PAGE_SIZE))
+
+    # Nothing recorded between the two, but nothing to send if the client has the page already.
+    self.assertIsNone(self.get_delta(second_hash, first_hash))
+    self.assertEqual(self.get_delta(second_hash, second_hash)['patches'], [])
+
+  def test_cached(self):
+    first_hash = self.add_page(get_test_image(1, PAGE_SIZE))
+    second_hash = self.add_page(change_pixel(get_test_image(1, PAGE_SIZE), (0, 0)), first_hash)
+    delta_path = self.deltas.get(second_hash, first_hash)
+
+    self.assertTrue(os.path.isfile(delta_path))
+    self.assertEqual(self.deltas.get(second_hash, first_hash), delta_path)
+
+if __name__ == '__main__':
+  unittest.main()
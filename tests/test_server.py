@@ -0,0 +1,167 @@
+import unittest
+import http.client
+
+from http import HTTPStatus
+
+from bmsnav.publishing import BlobStore, Publisher
+from bmsnav.server import Response, FileSegment, Router, get_byte_ranges, is_range_current
+from tests.support import WorkDirTestCase, publish
+
+# Routing requests against the published generation, and the header parsing behind it.
+#
+# Author: Sean Eidemiller (seidemiller@gmail.com)
+
+PAGE_DATA = bytes(range(256)) * 4
+LAST_MODIFIED = 'Sun, 18 Oct 2026 09:00:00 GMT'
+
+def get_headers(**headers):
+  message = http.client.HTTPMessage()
+
+  for keyword, value in headers.items():
+    message[keyword.replace('_', '-')] = value
+
+  return message
+
+def read_body(response):
+  body = b''
+
+  for part in response.parts:
+    if isinstance(part, FileSegment):
+      with open(part.path, 'rb') as f:
+        f.seek(part.offset)
+        body += f.read(part.length)
+    else:
+      body += part
+
+  return body
+
+class ByteRangesTest(unittest.TestCase):
+  def test_single(self):
+    self.assertEqual(get_byte_ranges('bytes=0-99', 1000), [(0, 100)])
+    self.assertEqual(get_byte_ranges('bytes=500-', 1000), [(500, 1000)])
+    self.assertEqual(get_byte_ranges('bytes=-100', 1000), [(900, 1000)])
+
+  def test_clamped_to_size(self):
+    self.assertEqual(get_byte_ranges('bytes=900-1999', 1000), [(900, 1000)])
+    self.assertEqual(get_byte_ranges('bytes=-2000', 1000), [(0, 1000)])
+    self.assertEqual(get_byte_ranges('bytes=0-99999999', 1000), [(0, 1000)])
+
+  def test_multiple(self):
+    self.assertEqual(get_byte_ranges('bytes=0-9, 20-29,-5', 100), [(0, 10), (20, 30), (95, 100)])
+
+  def test_unsatisfiable(self):
+    # Answered with a 416.
+    self.assertEqual(get_byte_ranges('bytes=1000-', 1000), [])
+    self.assertEqual(get_byte_ranges('bytes=2000-2999, 1000-1001', 1000), [])
+
+  def test_ignored(self):
+    # Answered with the whole thing.
+    self.assertIsNone(get_byte_ranges('items=0-9', 1000))
+    self.assertIsNone(get_byte_ranges('bytes=9-0', 1000))
+    self.assertIsNone(get_byte_ranges('bytes=-', 1000))
+    self.assertIsNone(get_byte_ranges('bytes=a-b', 1000))
+    self.assertIsNone(get_byte_ranges('bytes=' + ','.join(f'{n}-{n}' for n in range(100)), 1000))
+
+  def test_if_range(self):
+    self.assertTrue(is_range_current(get_headers(), '"a"'))
+    self.assertTrue(is_range_current(get_headers(If_Range='"a"'), '"a"'))
+    self.assertFalse(is_range_current(get_headers(If_Range='"b"'), '"a"'))
+    self.assertFalse(is_range_current(get_headers(If_Range='W/"a"'), '"a"'))
+    self.assertTrue(is_range_current(get_headers(If_Range=LAST_MODIFIED), '"a"', LAST_MODIFIED))
+    self.assertFalse(is_range_current(get_headers(If_Range=LAST_MODIFIED), '"a"', 'Sun, 18 Oct 2026 09:00:01 GMT'))
+    self.assertFalse(is_range_current(get_headers(If_Range=LAST_MODIFIED), '"a"'))
+
+class ResponseTest(WorkDirTestCase):
+  def test_get_parts(self):
+    with open('body', 'wb') as body_file:
+      body_file.write(b'0123456789')
+
+    response = Response(HTTPStatus.OK)
+    response.add_bytes(b'abc')
+    response.add_file('body')
+    response.add_bytes(b'xyz')
+    response.parts = response.get_parts(2, 15)
+
+    self.assertEqual(read_body(response), b'c0123456789xy')
+
+class RouterTest(WorkDirTestCase):
+  def setUp(self):
+    super(RouterTest, self).setUp()
+    self.publisher = Publisher(BlobStore())
+    self.generation = publish(self.publisher, { 'l01.png': PAGE_DATA })
+    self.router = Router(self.publisher)
+    self.etag = f'"{self.generation.get_hash("l01.png")}"'
+
+  def get(self, target, **headers):
+    response = self.router.handle('GET', target, get_headers(**headers))
+    self.addCleanup(response.close)
+
+    return response
+
+  def test_page(self):
+    response = self.get('/l01.png')
+
+    self.assertEqual(response.status, HTTPStatus.OK)
+    self.assertEqual(response.get_header('ETag'), self.etag)
+    self.assertEqual(response.get_header('Accept-Ranges'), 'bytes')
+    self.assertEqual(read_body(response), PAGE_DATA)
+
+  def test_not_modified(self):
+    response = self.get('/l01.png', If_None_Match=self.etag)
+
+    self.assertEqual(response.status, HTTPStatus.NOT_MODIFIED)
+    self.assertEqual(read_body(response), b'')
+
+  def test_single_range(self):
+    response = self.get('/l01.png', Range='bytes=10-19')
+
+    self.assertEqual(response.status, HTTPStatus.PARTIAL_CONTENT)
+    self.assertEqual(response.get_header('Content-Range'), f'bytes 10-19/{len(PAGE_DATA)}')
+    self.assertEqual(read_body(response), PAGE_DATA[10:20])
+
+  def test_multiple_ranges(self):
+    response = self.get('/l01.png', Range='bytes=0-1,-2')
+    content_type = response.get_header('Content-Type')
+    boundary = content_type.partition('boundary=')[2]
+    body = read_body(response)
+
+    self.assertEqual(response.status, HTTPStatus.PARTIAL_CONTENT)
+    self.assertTrue(content_type.startswith('multipart/byteranges'))
+    self.assertIn(f'Content-Range: bytes 0-1/{len(PAGE_DATA)}\r\n\r\n'.encode('utf-8') + PAGE_DATA[:2], body)
+    self.assertIn(f'Content-Range: bytes {len(PAGE_DATA) - 2}-{len(PAGE_DATA) - 1}/{len(PAGE_DATA)}\r\n\r\n'.encode('utf-8') + PAGE_DATA[-2:], body)
+    self.assertTrue(body.endswith(f'\r\n--{boundary}--\r\n'.encode('utf-8')))
+
+  def test_unsatisfiable_range(self):
+    response = self.get('/l01.png', Range=f'bytes={len(PAGE_DATA)}-')
+
+    self.assertEqual(response.status, HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+    self.assertEqual(response.get_header('Content-Range'), f'bytes */{len(PAGE_DATA)}')
+    self.assertEqual(read_body(response), b'')
+
+  def test_outdated_if_range(self):
+    response = self.get('/l01.png', Range='bytes=10-19', If_Range='"outdated"')
+
+    self.assertEqual(response.status, HTTPStatus.OK)
+    self.assertEqual(read_body(response), PAGE_DATA)
+
+  def test_not_found(self):
+    self.assertEqual(self.get('/l02.png').status, HTTPStatus.NOT_FOUND)
+
+  def test_error(self):
+    errors = []
+
+    def fail(*args):
+      raise RuntimeError('Failed')
+
+    self.router.on_error = errors.append
+    self.router._handle_generation = fail
+    response = self.get('/l01.png')
+
+    self.assertEqual(response.status, HTTPStatus.INTERNAL_SERVER_ERROR)
+    self.assertEqual([str(e) for e in errors], ['Failed'])
+
+    # The generation pinned for the response is let go of.
+    self.assertEqual(self.publisher.get_current().refs, 0)
+
+if __name__ == '__main__':
+  unittest.main()
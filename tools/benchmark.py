@@ -0,0 +1,455 @@
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import statistics
+import http.client
+
+from datetime import datetime, timezone
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+from bmsnav.config import (
+  SERVER_ROOT,
+  TILES_DIR,
+  DDS_OUTPUT_SETTINGS,
+  DEFAULT_WORKERS,
+  DEFAULT_QUIESCENCE_MS,
+  DEFAULT_TILE_SIZE,
+  DEFAULT_SELECTED_THEATER,
+  ServerEngine,
+  get_theater_cache_dir,
+  get_dds_files,
+  get_briefing_dir
+)
+from bmsnav.conversion import ConversionCache, DDSConverter, create_conversion_pool
+from bmsnav.publishing import BlobStore, Publisher
+
+# Benchmarks conversion and serving against a synthetic BMS tree, so it runs anywhere (no BMS, no
+# Qt). Results are written as JSON so that runs can be compared across commits...
+#
+# py tools/benchmark.py --out before.json
+# py tools/benchmark.py --out after.json --compare before.json
+
+DDS_SIZE = 2048
+# Rotated through the sixteen files; None is uncompressed BGRA.
+DDS_FORMATS = ['DXT1', 'DXT5', 'DXT1', None]
+BRIEFING_COUNT = 3
+
+# ======== Fixtures ========
+
+def write_dds(path, variant=0, size=DDS_SIZE):
+  from PIL import Image, ImageDraw
+
+  index = int(os.path.basename(path).split('.')[0])
+  rng = random.Random(f'{index}-{variant}')
+  img = Image.new('RGBA', (size, size), (255, 255, 255, 255))
+  draw = ImageDraw.Draw(img)
+  half = size // 2
+
+  # Left page: a data card (grid and text). Right page: a chart (filled shapes and routes).
+  for y in range(0, size, 64):
+    draw.line((0, y, half, y), fill=(0, 0, 0, 255), width=2)
+
+  for k in range(400):
+    draw.text((rng.randint(0, half - 200), rng.randint(0, size - 20)), f'STPT {k:02d} N37{rng.randint(0, 59):02d}.{rng.randint(0, 999):03d} {variant}', fill=(0, 0, 0, 255))
+
+  for k in range(150):
+    x, y = rng.randint(half, size - 1), rng.randint(0, size - 1)
+    r = rng.randint(20, 200)
+    draw.ellipse((x - r, y - r, x + r, y + r), fill=(rng.randint(80, 200), rng.randint(120, 220), rng.randint(60, 160), 255))
+
+  for k in range(40):
+    points = [(rng.randint(half, size - 1), rng.randint(0, size - 1)) for p in range(6)]
+    draw.line(points, fill=(200, 0, 0, 255), width=4)
+
+  pixel_format = DDS_FORMATS[index % len(DDS_FORMATS)]
+
+  if pixel_format:
+    img.save(path, 'DDS', pixel_format=pixel_format)
+  else:
+    img.save(path, 'DDS')
+
+def write_briefing(path, rows=300):
+  cells = ''.join(f'<tr><td>{r}</td><td>Package {r % 12}</td><td>Flight {r}</td><td>N37 {r % 60:02d}.000</td></tr>\n' for r in range(rows))
+
+  with open(path, 'w') as briefing_file:
+    briefing_file.write(f'<!DOCTYPE HTML>\n<html>\n<body>\n<table>\n{cells}</table>\n</body>\n</html>\n')
+
+def create_fixtures(bms_dir):
+  dds_dir = os.path.join(bms_dir, 'Data', 'TerrData', 'Objects', 'KoreaObj')
+  briefing_dir = get_briefing_dir(bms_dir)
+
+  os.makedirs(dds_dir)
+  os.makedirs(briefing_dir)
+
+  for dds_file in get_dds_files(dds_dir):
+    write_dds(dds_file)
+
+  for i in range(BRIEFING_COUNT):
+    write_briefing(os.path.join(briefing_dir, f'mission-{i}-briefing.html'))
+
+  return dds_dir
+
+# ======== Measurement ========
+
+def summarize(samples):
+  if not samples:
+    return None
+
+  ordered = sorted(samples)
+
+  return {
+    'runs': len(samples),
+    'min': ordered[0],
+    'median': statistics.median(ordered),
+    'mean': statistics.fmean(ordered),
+    'p90': get_percentile(ordered, 90),
+    'p99': get_percentile(ordered, 99),
+    'max': ordered[-1]
+  }
+
+def get_percentile(ordered, percentile):
+  return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+def get_free_port():
+  with socket.socket() as sock:
+    sock.bind(('127.0.0.1', 0))
+    return sock.getsockname()[1]
+
+def reset_server_root():
+  shutil.rmtree(SERVER_ROOT, ignore_errors=True)
+  os.makedirs(SERVER_ROOT)
+
+def get_converter_args(args, store):
+  tile_size = None if args.no_tiles else DEFAULT_TILE_SIZE
+  cache = ConversionCache(get_theater_cache_dir(DEFAULT_SELECTED_THEATER), store, { **DDS_OUTPUT_SETTINGS, 'tileSize': tile_size })
+
+  return cache, tile_size
+
+def run_converter(converter):
+  # A batch publishes whatever did convert; timings of one where something didn't mean nothing.
+  converter.run()
+
+  if converter.errors:
+    raise next(iter(converter.errors.values()))
+
+def bench_conversion(args, dds_dir):
+  cold = []
+  unchanged = []
+  single = []
+
+  for run in range(args.repeat):
+    reset_server_root()
+
+    store = BlobStore()
+    store.add_derived_dir(TILES_DIR)
+    publisher = Publisher(store)
+    cache, tile_size = get_converter_args(args, store)
+
+    # The pool is created (and its workers spawned) inside the timing, just as on a first start.
+    start = time.perf_counter()
+    pool = create_conversion_pool(args.workers)
+    run_converter(DDSConverter(dds_dir, publisher, cache, None, pool, 'Korea', tile_size))
+    cold.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    run_converter(DDSConverter(dds_dir, publisher, cache, None, pool, 'Korea', tile_size))
+    unchanged.append(time.perf_counter() - start)
+
+    dds_file = get_dds_files(dds_dir)[run % 16]
+    write_dds(dds_file, run + 1)
+
+    start = time.perf_counter()
+    run_converter(DDSConverter(dds_dir, publisher, cache, [dds_file], pool, 'Korea', tile_size))
+    single.append(time.perf_counter() - start)
+
+    if pool:
+      pool.shutdown()
+
+  return {
+    'coldBatch': summarize(cold),
+    'unchangedBatch': summarize(unchanged),
+    'singlePage': summarize(single)
+  }
+
+class Daemon():
+  def __init__(self, args, bms_dir, engine):
+    super(Daemon, self).__init__()
+    self.port = get_free_port()
+    self.ready = threading.Event()
+    self.output = []
+
+    config = {
+      'port': self.port,
+      'workers': args.workers,
+      'quiescenceMs': args.quiescence_ms,
+      'serverEngine': engine,
+      'tiles': not args.no_tiles
+    }
+
+    with open('config.json', 'w') as config_file:
+      config_file.write(json.dumps(config, indent=2))
+
+    env = { **os.environ, 'BMS_HOME': bms_dir }
+    cmd = [sys.executable, os.path.join(ROOT_DIR, 'bmsnavserver.py'), '--daemon']
+    self.process = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    self.reader = threading.Thread(target=self._read, daemon=True)
+    self.reader.start()
+
+  def wait_ready(self, timeout=600):
+    if not self.ready.wait(timeout):
+      raise Exception('Daemon did not finish its initial conversion:\n' + ''.join(self.output))
+
+  def stop(self):
+    self.process.terminate()
+    self.process.wait()
+
+  def _read(self):
+    for line in self.process.stdout:
+      self.output.append(line)
+
+      if 'Kneeboard images generated' in line:
+        self.ready.set()
+
+def read_event(response):
+  event = None
+  data = None
+
+  while True:
+    line = response.fp.readline()
+
+    if not line:
+      raise Exception('Event stream closed')
+
+    line = line.decode('utf-8').rstrip('\r\n')
+
+    if line.startswith('event: '):
+      event = line[7:]
+    elif line.startswith('data: '):
+      data = json.loads(line[6:])
+    elif not line and event:
+      return event, data
+
+def bench_write_to_served(args, bms_dir, dds_dir):
+  daemon = Daemon(args, bms_dir, ServerEngine.THREADING)
+  published = []
+  served = []
+
+  try:
+    daemon.wait_ready()
+
+    events = http.client.HTTPConnection('127.0.0.1', daemon.port)
+    events.request('GET', '/events')
+    event_response = events.getresponse()
+    read_event(event_response)
+
+    page_conn = http.client.HTTPConnection('127.0.0.1', daemon.port)
+
+    for run in range(args.repeat):
+      dds_file = get_dds_files(dds_dir)[(run * 5) % 16]
+      name = f'l{(int(os.path.basename(dds_file).split(".")[0]) - 7982) + 1:02d}.png'
+
+      write_dds(dds_file, 100 + run)
+      start = time.perf_counter()
+
+      while True:
+        event, data = read_event(event_response)
+
+        if event == 'generation' and name in data['changed']:
+          break
+
+      published.append(time.perf_counter() - start)
+
+      page_conn.request('GET', f'/{name}')
+      page_response = page_conn.getresponse()
+      page_response.read()
+
+      if int(page_response.getheader('X-BMSNav-Generation')) < data['generation']:
+        raise Exception('Served a page from an older generation')
+
+      served.append(time.perf_counter() - start)
+
+    events.close()
+    page_conn.close()
+  finally:
+    daemon.stop()
+
+  return {
+    'published': summarize(published),
+    'served': summarize(served)
+  }
+
+def run_tablet(port, names, deadline, latencies, stats):
+  # Each tablet has its own keep-alive connection and its own stats (no locking needed).
+  conn = http.client.HTTPConnection('127.0.0.1', port)
+  i = random.randrange(len(names))
+
+  while time.perf_counter() < deadline:
+    name = names[i % len(names)]
+    i += 1
+    start = time.perf_counter()
+
+    try:
+      conn.request('GET', name)
+      body = conn.getresponse().read()
+      latencies.append(time.perf_counter() - start)
+      stats['bytes'] += len(body)
+    except Exception as request_err:
+      stats['errors'] += 1
+      conn.close()
+      conn = http.client.HTTPConnection('127.0.0.1', port)
+
+  conn.close()
+
+def bench_http(args, bms_dir, engine):
+  daemon = Daemon(args, bms_dir, engine)
+
+  try:
+    daemon.wait_ready()
+
+    # What a tablet pulls on connect: the manifest and then every page.
+    names = ['/manifest.json'] + [f'/{side}{page:02d}.png' for side in ('l', 'r') for page in range(1, 17)]
+    deadline = time.perf_counter() + args.duration
+    latencies = []
+    stats = [{ 'bytes': 0, 'errors': 0 } for t in range(args.tablets)]
+
+    tablets = [threading.Thread(target=run_tablet, args=(daemon.port, names, deadline, latencies, s)) for s in stats]
+
+    start = time.perf_counter()
+
+    for tablet in tablets:
+      tablet.start()
+
+    for tablet in tablets:
+      tablet.join()
+
+    elapsed = time.perf_counter() - start
+  finally:
+    daemon.stop()
+
+  return {
+    'tablets': args.tablets,
+    'requests': len(latencies),
+    'errors': sum(s['errors'] for s in stats),
+    'requestsPerSecond': len(latencies) / elapsed,
+    'megabytesPerSecond': sum(s['bytes'] for s in stats) / elapsed / (1024 * 1024),
+    'latency': summarize(latencies)
+  }
+
+# ======== Reporting ========
+
+def flatten(results, prefix=''):
+  flat = {}
+
+  for key, value in results.items():
+    if isinstance(value, dict):
+      flat.update(flatten(value, f'{prefix}{key}.'))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+      flat[f'{prefix}{key}'] = value
+
+  return flat
+
+def print_results(results, baseline=None):
+  flat = flatten(results)
+  previous = flatten(baseline) if baseline else {}
+
+  for key, value in flat.items():
+    line = f'{key:48} {value:14.4f}'
+
+    if previous.get(key):
+      line += f'  ({value / previous[key]:.2f}x)'
+
+    print(line)
+
+def get_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR, text=True, stderr=subprocess.DEVNULL).strip()
+  except Exception as git_err:
+    return None
+
+# ======== Main ========
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark BMSNavServer conversion and serving against synthetic kneeboards.')
+  parser.add_argument('--out', default='benchmark.json', help='where to write the results (default: %(default)s)')
+  parser.add_argument('--compare', help='a previous results file to compare against')
+  parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS, help='conversion worker processes (default: %(default)s)')
+  parser.add_argument('--repeat', type=int, default=3, help='runs of each conversion/latency measurement (default: %(default)s)')
+  parser.add_argument('--tablets', type=int, default=4, help='simulated tablets for the HTTP benchmark (default: %(default)s)')
+  parser.add_argument('--duration', type=float, default=10, help='seconds per HTTP benchmark (default: %(default)s)')
+  parser.add_argument('--quiescence-ms', type=int, default=DEFAULT_QUIESCENCE_MS, help='quiescence period for the write-to-served benchmark (default: %(default)s)')
+  parser.add_argument('--engines', default=','.join(ServerEngine), help='server engines to benchmark (default: %(default)s)')
+  parser.add_argument('--no-tiles', action='store_true', help='benchmark without generating tiles')
+  parser.add_argument('--keep', action='store_true', help='keep the fixture/work directory')
+  args = parser.parse_args()
+
+  out_path = os.path.abspath(args.out)
+  baseline = None
+
+  if args.compare:
+    with open(args.compare, 'r') as baseline_file:
+      baseline = json.loads(baseline_file.read())['results']
+
+  work_dir = tempfile.mkdtemp(prefix='bmsnav-benchmark-')
+  bms_dir = os.path.join(work_dir, 'bms')
+
+  try:
+    print(f'Generating fixtures in {work_dir}...')
+    dds_dir = create_fixtures(bms_dir)
+
+    # Everything the server writes is relative to the working directory.
+    os.chdir(work_dir)
+
+    results = {}
+
+    print('Benchmarking conversion...')
+    results['conversion'] = bench_conversion(args, dds_dir)
+
+    print('Benchmarking write-to-served latency...')
+    results['writeToServed'] = bench_write_to_served(args, bms_dir, dds_dir)
+
+    results['http'] = {}
+
+    for engine in args.engines.split(','):
+      print(f'Benchmarking HTTP ({engine})...')
+      results['http'][engine] = bench_http(args, bms_dir, ServerEngine(engine))
+
+  finally:
+    os.chdir(ROOT_DIR)
+
+    if not args.keep:
+      shutil.rmtree(work_dir, ignore_errors=True)
+
+  report = {
+    'commit': get_commit(),
+    'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'cpus': os.cpu_count(),
+    'settings': {
+      'workers': args.workers,
+      'repeat': args.repeat,
+      'tablets': args.tablets,
+      'duration': args.duration,
+      'quiescenceMs': args.quiescence_ms,
+      'tiles': not args.no_tiles,
+      'ddsSize': DDS_SIZE
+    },
+    'results': results
+  }
+
+  with open(out_path, 'w') as out_file:
+    out_file.write(json.dumps(report, indent=2))
+
+  print_results(results, baseline)
+  print(f'Wrote results to {out_path}')